@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# bot.py در import به این‌ها نیاز دارد ؛ دیتابیس موقت تا دیتابیس اصلی دست نخورد
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("ADMIN_CHAT_ID", "1")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="chaschni-bench-"), "bench.db"))
+
+import bot
+
+
+def per_call_ns(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e9
+
+
+# ---------- ROUTER ----------
+def bench_router(args):
+    # هزینه پیدا کردن مسیر با N مسیر ثبت‌شده ؛ برای مقایسه ، زنجیره if به همان اندازه
+    customer_st = {"step": "qty", "items": []}
+    saved = {kind: dict(table) for kind, table in bot.routes.items()}
+    saved_admin = {kind: dict(table) for kind, table in bot.admin_routes.items()}
+
+    print(f"{'routes':>8} {'text (ns)':>12} {'callback (ns)':>14} {'if-chain (ns)':>14}")
+    for n in args.sizes:
+        for i in range(n):
+            bot.routes["text"][f"dummy text {i}"] = None
+            bot.admin_routes["text"][f"dummy admin {i}"] = None
+            bot.routes["callback"][f"dummy{i}_"] = None
+
+        chain = [f"dummy text {i}" for i in range(n)]
+
+        def if_chain(text="12"):
+            for literal in chain:
+                if text == literal:
+                    return literal
+
+        text_ns = per_call_ns(lambda: bot.resolve_text_route(42, "12", customer_st), args.repeat)
+        callback_ns = per_call_ns(lambda: bot.resolve_callback_route(42, "slot_12:00_12:30"), args.repeat)
+        chain_ns = per_call_ns(if_chain, max(args.repeat // max(n // 100, 1), 1000))
+        print(f"{n:>8} {text_ns:>12.0f} {callback_ns:>14.0f} {chain_ns:>14.0f}")
+
+        for kind in bot.ROUTE_KINDS:
+            bot.routes[kind] = dict(saved[kind])
+            bot.admin_routes[kind] = dict(saved_admin[kind])
+
+
+# ---------- LOAD ----------
+# لایه جعلی تلگرام: هندلرها فقط همین متدها را صدا می‌زنند
+class FakeBot:
+    def __init__(self):
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text=None, **kwargs):
+        with self.lock:
+            self.sent += 1
+
+    def send_document(self, chat_id, **kwargs):
+        with self.lock:
+            self.sent += 1
+
+    def get_chat_member(self, chat_id, user_id, **kwargs):
+        return FakeObject(status="member")
+
+
+class FakeObject:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def noop(*args, **kwargs):
+    pass
+
+
+def text_update(uid, text):
+    user = FakeObject(id=uid)
+    message = FakeObject(text=text, document=None, reply_text=noop)
+    return FakeObject(message=message, callback_query=None, effective_user=user, effective_chat=user)
+
+
+def callback_update(uid, data):
+    user = FakeObject(id=uid)
+    query = FakeObject(
+        data=data,
+        from_user=user,
+        message=FakeObject(text="", reply_text=noop),
+        answer=noop,
+        edit_message_text=noop
+    )
+    return FakeObject(message=None, callback_query=query, effective_user=user, effective_chat=user)
+
+
+def customer_flow(uid, food_key, paypal):
+    # منو → تعداد → قاشق چنگال → کد پستی → تماس → بازه → پرداخت
+    steps = [
+        ("start", bot.start, text_update(uid, "/start")),
+        ("menu", bot.handle_text, text_update(uid, "🍽 شروع سفارش")),
+        ("food_", bot.callbacks, callback_update(uid, f"food_{food_key}")),
+        ("qty", bot.handle_text, text_update(uid, "2")),
+        ("cutlery_yes", bot.callbacks, callback_update(uid, "cutlery_yes")),
+        ("cutlery_qty", bot.handle_text, text_update(uid, "2")),
+        ("continue_order", bot.callbacks, callback_update(uid, "continue_order")),
+        ("postcode", bot.handle_text, text_update(uid, "12345")),
+        ("pickup_yes", bot.callbacks, callback_update(uid, "pickup_yes")),
+        ("name", bot.handle_text, text_update(uid, "Bench Customer")),
+        ("phone", bot.handle_text, text_update(uid, "0123456789")),
+        ("slot_", bot.callbacks, callback_update(uid, "slot_12:00_12:30"))
+    ]
+
+    if paypal:
+        steps += [
+            ("pay_paypal", bot.callbacks, callback_update(uid, "pay_paypal")),
+            ("paid_paypal", bot.callbacks, callback_update(uid, "paid_paypal"))
+        ]
+    else:
+        steps.append(("pay_cash", bot.callbacks, callback_update(uid, "pay_cash")))
+
+    return steps
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def latency_summary(samples):
+    ms = [s * 1000 for s in samples]
+    return {
+        "count": len(ms),
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "max_ms": round(max(ms, default=0), 3)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def prepare_load_db(customers):
+    # ظرفیت غذا و بازه‌ها به اندازه همه مشتری‌ها
+    catalog = json.loads(bot.menu_catalog_json())
+    for items in catalog.values():
+        for item in items:
+            item["daily_capacity"] = customers * 10
+    bot.replace_menu_catalog(bot.parse_menu_catalog(catalog))
+
+    bot.SLOT_CAPACITY = customers * 10
+    conn = bot.get_conn()
+    conn.execute("UPDATE slot_capacity SET capacity = ?", (bot.SLOT_CAPACITY,))
+    conn.commit()
+
+    return next(iter(bot.get_foods_for_target_day()))
+
+
+def bench_load(args):
+    bot.TEST_MODE = True
+    food_key = prepare_load_db(args.customers)
+    threading.Thread(target=bot.log_writer_loop, daemon=True).start()
+
+    context = FakeObject(bot=FakeBot(), args=[])
+    samples = {}
+    sql_counts = []
+    errors = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def count_sql(statement):
+        local.statements += 1
+
+    def run_customer(i):
+        # هر مشتری پشت‌سرهم ، مثل shard های UpdateScheduler
+        if not getattr(local, "traced", False):
+            local.statements = 0
+            bot.get_conn().set_trace_callback(count_sql)
+            local.traced = True
+
+        uid = args.first_uid + i
+        for name, handler, update in customer_flow(uid, food_key, paypal=i % 2 == 1):
+            local.statements = 0
+            start = time.perf_counter()
+            try:
+                handler(update, context)
+                bot.persist_session(update, context)
+            except Exception as e:
+                with lock:
+                    errors.append(f"{uid} {name}: {e!r}")
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                samples.setdefault(name, []).append(elapsed)
+                sql_counts.append(local.statements)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(run_customer, range(args.customers)))
+    wall = time.perf_counter() - start
+
+    bot.flush_logs()
+    cur = bot.get_conn().cursor()
+    cur.execute("SELECT COUNT(*) FROM order_headers WHERE user_id >= ?", (args.first_uid,))
+    orders = cur.fetchone()[0]
+
+    updates = len(sql_counts)
+    all_samples = [s for values in samples.values() for s in values]
+    result = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "customers": args.customers,
+        "workers": args.workers,
+        "updates": updates,
+        "wall_seconds": round(wall, 3),
+        "updates_per_second": round(updates / wall, 1) if wall else 0,
+        "orders_created": orders,
+        "errors": len(errors),
+        "latency": latency_summary(all_samples),
+        "sql_per_update": round(sum(sql_counts) / updates, 2) if updates else 0,
+        "steps": {name: latency_summary(values) for name, values in samples.items()},
+        "sql_by_route": bot.sql_stats_snapshot(),
+        "outbox_pending": bot.outbox.depth()
+    }
+
+    print(f"{updates} updates in {wall:.2f}s → {result['updates_per_second']} updates/s")
+    print(f"latency p50 {result['latency']['p50_ms']} ms | p95 {result['latency']['p95_ms']} ms | "
+          f"p99 {result['latency']['p99_ms']} ms")
+    print(f"SQL per update: {result['sql_per_update']} | orders: {orders}/{args.customers} | errors: {len(errors)}")
+    print(f"{'step':>16} {'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10}")
+    for name, summary in result["steps"].items():
+        print(f"{name:>16} {summary['p50_ms']:>10.2f} {summary['p95_ms']:>10.2f} {summary['p99_ms']:>10.2f}")
+    for line in errors[:10]:
+        print(line)
+
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"saved → {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chaschni bot benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    router = sub.add_parser("router", help="route lookup cost vs number of routes")
+    router.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    router.add_argument("--repeat", type=int, default=200000)
+    router.set_defaults(func=bench_router)
+
+    load = sub.add_parser("load", help="N concurrent customers through the full order flow")
+    load.add_argument("--customers", type=int, default=200)
+    load.add_argument("--workers", type=int, default=bot.UPDATE_SHARDS)
+    load.add_argument("--first-uid", type=int, default=10_000_000)
+    load.add_argument("--output", default=os.path.join(os.path.dirname(os.environ["DB_PATH"]), "bench-load.json"))
+    load.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,23 @@
 import os
 import time
+import atexit
+import csv
+import gzip
+import heapq
+import hmac
+import json
+import queue
+import tempfile
 import threading
 import sqlite3
 import uuid
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from concurrent.futures import Future, ThreadPoolExecutor
 from zoneinfo import ZoneInfo
 from datetime import datetime, timedelta
 
-from flask import Flask
+from flask import Flask, request
 app = Flask(__name__)
 
 @app.route("/")
@@ -23,14 +34,25 @@ from telegram import (
     ReplyKeyboardRemove
 )
 
+from telegram.error import (
+    RetryAfter,
+    Unauthorized,
+    BadRequest,
+    NetworkError
+)
+
 from telegram.ext import (
     Updater,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     Filters,
-    CallbackContext
+    CallbackContext,
+    Dispatcher,
+    DispatcherHandlerStop
 )
+from telegram.utils.request import Request
 
 # 👇 بعدش استفاده
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
@@ -43,7 +65,8 @@ ADMIN_CHAT_ID = int(os.environ.get("ADMIN_CHAT_ID"))
 PAYPAL_BASE_LINK = "https://www.paypal.com/paypalme/Chaschni?country.x=DE&locale.x=de_DE"
 CONTACT_USERNAME = "Chaschni"
 CUTLERY_PRICE = 0.30
-MAX_DAILY = 15
+MAX_DAILY = 15           # ظرفیت پیش‌فرض روزانه هر غذا (اگر در منو تعیین نشده)
+ORDER_TTL_SECONDS = 5 * 60    # سفارش pending بعد از این مدت منقضی می‌شود
 
 TIMEZONE = ZoneInfo("Europe/Berlin")
 
@@ -51,8 +74,10 @@ ENABLE_TIME_LIMIT = True      # حالت واقعی
 TEST_MODE = False            # حالت تست
 
 WORK_DAYS = {0, 3}            # دوشنبه=0 ، پنجشنبه=3
+DELIVERY_DAY_FA = {"monday": "دوشنبه", "thursday": "پنج‌شنبه"}
 START_HOUR = 12
 END_HOUR = 17
+SLOT_CAPACITY = 3             # ظرفیت پیش‌فرض هر بازه (قابل تغییر برای هر بازه در دیتابیس)
 EMERGENCY_MESSAGE = None
 
 # ---------- DELIVERY ----------
@@ -68,102 +93,993 @@ PICKUP_ADDRESS_FULL = "Tannenbergallee 6, 30163 Hannover"
 PICKUP_ADDRESS_SHORT = "List 30163 (Hannover)"
 
 # ---------- DB ----------
-conn = sqlite3.connect("orders.db", check_same_thread=False)
-cur = conn.cursor()
-# --- ADD DELIVERY TIME COLUMNS (SAFE MIGRATION) ---
-try:
-    cur.execute("ALTER TABLE orders ADD COLUMN delivery_day TEXT")
-except sqlite3.OperationalError:
-    pass  # column already exists
-
-try:
-    cur.execute("ALTER TABLE orders ADD COLUMN delivery_slot TEXT")
-except sqlite3.OperationalError:
-    pass  # column already exists
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS discount_codes (
-    code TEXT PRIMARY KEY,
-    percent INTEGER,
-    max_use INTEGER,
-    used_count INTEGER DEFAULT 0
-)
-""")
-conn.commit()
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS orders (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    order_no TEXT,
-    user_id INTEGER,
-    food_key TEXT,
-    food_name TEXT,
-    qty INTEGER,
-    cutlery_qty INTEGER,
-    total REAL,
-    status TEXT,
-    payment_method TEXT,
-    created_at TEXT,
-    payment_checked_at TEXT,
-    delivery_day TEXT,
-    delivery_slot TEXT
-)
-""")
-conn.commit()
+DB_PATH = os.environ.get("DB_PATH", "orders.db")
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_KB = 16 * 1024              # page cache هر کانکشن
+DB_MMAP_BYTES = 128 * 1024 * 1024
+DISPATCHER_WORKERS = int(os.environ.get("DISPATCHER_WORKERS", 8))
+UPDATE_SHARDS = int(os.environ.get("UPDATE_SHARDS", DISPATCHER_WORKERS))   # تعداد thread پردازش آپدیت
 
-# ---------- USERS TABLE ----------
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY
-)
-""")
-
-# ---------- LOGS TABLE ----------
-cur.execute("""
-CREATE TABLE IF NOT EXISTS logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    action TEXT,
-    created_at TEXT
-)
-""")
+# ---------- SQL STATS ----------
+# هر execute زمان‌گیری می‌شود و به مسیر جاری (هندلر) همان thread نسبت داده می‌شود
+# زمان execute برای SELECT فقط تا اولین ردیف است ، نه fetch
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
+STATS_TOKEN = os.environ.get("STATS_TOKEN")          # برای /stats/sql ؛ خالی = غیرفعال
+EXPLAINABLE_SQL = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
 
-conn.commit()
+_sql_local = threading.local()
+_sql_stats_lock = threading.Lock()
+sql_stats = {}      # route → {calls, queries, total_ms, max_ms, slow}
+
+def _route_stats(name):
+    stats = sql_stats.get(name)
+    if stats is None:
+        stats = sql_stats[name] = {"calls": 0, "queries": 0, "total_ms": 0.0, "max_ms": 0.0, "slow": 0}
+    return stats
+
+
+def set_sql_route(name):
+    # None → کارهای پس‌زمینه
+    _sql_local.route = name
+    if name:
+        with _sql_stats_lock:
+            _route_stats(name)["calls"] += 1
+
+
+def current_sql_route():
+    return getattr(_sql_local, "route", None) or "background"
+
+
+def record_sql(conn, sql, params, elapsed):
+    ms = elapsed * 1000
+    route = current_sql_route()
+    slow = ms >= SLOW_QUERY_MS
+
+    with _sql_stats_lock:
+        stats = _route_stats(route)
+        stats["queries"] += 1
+        stats["total_ms"] += ms
+        stats["max_ms"] = max(stats["max_ms"], ms)
+        stats["slow"] += slow
+
+    if slow:
+        print(f"🐢 slow query {ms:.1f} ms [{route}]\n{' '.join(sql.split())}\n{explain_sql(conn, sql, params)}")
+
+
+def explain_sql(conn, sql, params):
+    words = sql.split(None, 1)
+    if params is None or not words or words[0].upper() not in EXPLAINABLE_SQL:
+        return "(no plan)"
+
+    try:
+        # cursor ساده تا خود EXPLAIN شمرده نشود
+        rows = conn.cursor(sqlite3.Cursor).execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error as e:
+        return f"(no plan: {e})"
+
+    return "\n".join(f"  {row[-1]}" for row in rows)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            record_sql(self.connection, sql, params, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_params):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            record_sql(self.connection, sql, None, time.perf_counter() - start)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # conn.execute خودش cursor() را صدا نمی‌زند
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def sql_stats_snapshot():
+    with _sql_stats_lock:
+        return {route: dict(stats) for route, stats in sql_stats.items()}
+
+
+def sql_stats_text(limit=15):
+    routes_by_time = sorted(sql_stats_snapshot().items(), key=lambda kv: kv[1]["total_ms"], reverse=True)
+    if not routes_by_time:
+        return "🗄 هنوز کوئری‌ای ثبت نشده"
+
+    lines = [f"🗄 آمار SQL (کند ≥ {SLOW_QUERY_MS:.0f} ms)\n"]
+    for route, s in routes_by_time[:limit]:
+        per_call = f" ({s['queries'] / s['calls']:.1f}/بار)" if s["calls"] else ""
+        lines.append(
+            f"{route}: {s['calls']} بار | {s['queries']} کوئری{per_call} | "
+            f"مجموع {s['total_ms']:.0f} ms | بیشترین {s['max_ms']:.1f} ms | کند {s['slow']}"
+        )
+    return "\n".join(lines)
+
+
+@app.route("/stats/sql")
+def sql_stats_view():
+    token = request.headers.get("X-Stats-Token", "")
+    if not STATS_TOKEN or not hmac.compare_digest(token, STATS_TOKEN):
+        return "forbidden", 403
+
+    return {"slow_query_ms": SLOW_QUERY_MS, "routes": sql_stats_snapshot()}
+
+
+# هر thread کانکشن مخصوص خودش را دارد
+_db_local = threading.local()
+
+def get_conn():
+    conn = getattr(_db_local, "conn", None)
+
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, factory=InstrumentedConnection)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_BYTES}")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA foreign_keys = ON")
+        _db_local.conn = conn
+
+    return conn
+
+
+# ---------- MIGRATIONS ----------
+# هر migration فقط یکبار اجرا می‌شود (PRAGMA user_version)
+def _has_column(c, table, column):
+    c.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in c.fetchall())
+
+
+def _migration_base_schema(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS discount_codes (
+        code TEXT PRIMARY KEY,
+        percent INTEGER,
+        max_use INTEGER,
+        used_count INTEGER DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_no TEXT,
+        user_id INTEGER,
+        food_key TEXT,
+        food_name TEXT,
+        qty INTEGER,
+        cutlery_qty INTEGER,
+        total REAL,
+        status TEXT,
+        payment_method TEXT,
+        created_at TEXT,
+        payment_checked_at TEXT
+    )
+    """)
+
+    # ---------- USERS TABLE ----------
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY
+    )
+    """)
+
+    # ---------- LOGS TABLE ----------
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        action TEXT,
+        created_at TEXT
+    )
+    """)
+
+    # ---------- DISCOUNT USAGE ----------
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS discount_usage (
+        user_id INTEGER,
+        code TEXT,
+        PRIMARY KEY (user_id, code)
+    )
+    """)
+
+
+def _migration_delivery_columns(c):
+    if not _has_column(c, "orders", "delivery_day"):
+        c.execute("ALTER TABLE orders ADD COLUMN delivery_day TEXT")
+
+    if not _has_column(c, "orders", "delivery_slot"):
+        c.execute("ALTER TABLE orders ADD COLUMN delivery_slot TEXT")
+
+
+def _migration_order_indexes(c):
+    # موجودی غذا: SUM(qty) بدون رفتن سراغ جدول
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_stock
+        ON orders (food_key, delivery_day, status, qty)
+    """)
+    # ظرفیت بازه تحویل: COUNT(DISTINCT order_no)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_slot
+        ON orders (delivery_day, delivery_slot, status, order_no)
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_order_no ON orders (order_no)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, created_at)")
+
+
+def _migration_stock_counters(c):
+    # موجودی فروخته‌شده هر غذا برای هر روز تحویل (فقط pending و approved)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS stock_counters (
+        delivery_day TEXT,
+        food_key TEXT,
+        qty INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (delivery_day, food_key)
+    ) WITHOUT ROWID
+    """)
+
+    c.execute("""
+        INSERT OR REPLACE INTO stock_counters (delivery_day, food_key, qty)
+        SELECT delivery_day, food_key, SUM(qty)
+        FROM orders
+        WHERE status IN ('pending','approved')
+          AND delivery_day IS NOT NULL AND food_key IS NOT NULL   -- سفارش‌های قدیمی بدون روز تحویل
+        GROUP BY delivery_day, food_key
+    """)
+
+
+def _migration_slot_capacity(c):
+    # تعداد سفارش‌های رزروشده و ظرفیت هر بازه تحویل
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS slot_capacity (
+        delivery_day TEXT,
+        slot TEXT,
+        booked INTEGER NOT NULL DEFAULT 0,
+        capacity INTEGER NOT NULL,
+        PRIMARY KEY (delivery_day, slot)
+    ) WITHOUT ROWID
+    """)
+
+    c.execute("""
+        INSERT OR REPLACE INTO slot_capacity (delivery_day, slot, booked, capacity)
+        SELECT delivery_day, delivery_slot, COUNT(DISTINCT order_no), ?
+        FROM orders
+        WHERE status IN ('pending','approved')
+          AND delivery_day IS NOT NULL AND delivery_slot IS NOT NULL   -- سفارش‌های قدیمی بدون بازه
+        GROUP BY delivery_day, delivery_slot
+    """, (SLOT_CAPACITY,))
+
+
+def _migration_order_expiry(c):
+    if not _has_column(c, "orders", "expires_at"):
+        c.execute("ALTER TABLE orders ADD COLUMN expires_at INTEGER")
+
+    # سفارش‌های pending قبلی: created_at به وقت برلین + ORDER_TTL_SECONDS
+    c.execute("""
+        SELECT DISTINCT order_no, created_at FROM orders
+        WHERE status = 'pending'
+    """)
+    for order_no, created_at in c.fetchall():
+        try:
+            created = datetime.strptime(created_at, "%Y-%m-%d %H:%M").replace(tzinfo=TIMEZONE)
+            expires_at = int(created.timestamp()) + ORDER_TTL_SECONDS
+        except (TypeError, ValueError):
+            expires_at = 0
+
+        c.execute(
+            "UPDATE orders SET expires_at = ? WHERE order_no = ?",
+            (expires_at, order_no)
+        )
+
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_expiry
+        ON orders (status, expires_at)
+    """)
+
+
+def _migration_order_headers(c):
+    # هر سفارش یک ردیف در order_headers و هر غذا یک ردیف در order_items
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS order_headers (
+        order_no TEXT PRIMARY KEY,
+        user_id INTEGER,
+        total REAL,
+        status TEXT,
+        payment_method TEXT,
+        created_at TEXT,
+        payment_checked_at TEXT,
+        delivery_day TEXT,
+        delivery_slot TEXT,
+        expires_at INTEGER,
+        fullname TEXT,
+        phone TEXT,
+        address TEXT,
+        postcode TEXT
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS order_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_no TEXT NOT NULL REFERENCES order_headers (order_no),
+        food_key TEXT,
+        food_name TEXT,
+        qty INTEGER,
+        cutlery_qty INTEGER,
+        price REAL
+    )
+    """)
+
+    # انتقال داده‌های قبلی (یک ردیف برای هر غذا → هدر + آیتم)
+    c.execute("""
+        INSERT OR IGNORE INTO order_headers
+        (order_no, user_id, total, status, payment_method, created_at,
+         payment_checked_at, delivery_day, delivery_slot, expires_at)
+        SELECT order_no, MIN(user_id), MAX(total), MIN(status), MIN(payment_method),
+               MIN(created_at), MAX(payment_checked_at), MIN(delivery_day),
+               MIN(delivery_slot), MIN(expires_at)
+        FROM orders
+        WHERE order_no IS NOT NULL
+        GROUP BY order_no
+        ORDER BY MIN(id)
+    """)
+
+    c.execute("""
+        INSERT INTO order_items (order_no, food_key, food_name, qty, cutlery_qty)
+        SELECT order_no, food_key, food_name, qty, cutlery_qty
+        FROM orders
+        WHERE order_no IS NOT NULL
+        ORDER BY id
+    """)
+
+    c.execute("DROP TABLE orders")
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_no)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_headers_user ON order_headers (user_id)")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_headers_slot
+        ON order_headers (delivery_day, delivery_slot, status)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_headers_expiry
+        ON order_headers (status, expires_at)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_headers_created
+        ON order_headers (status, created_at)
+    """)
+
+
+def _migration_report_indexes(c):
+    # هر ایندکس در SQLite به rowid ختم می‌شود → فیلتر + ORDER BY rowid بدون sort
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_headers_status ON order_headers (status)")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_headers_day_status
+        ON order_headers (delivery_day, status)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_headers_created_at
+        ON order_headers (created_at)
+    """)
+
+
+def _migration_export_cache(c):
+    # updated_at با هر تغییر وضعیت عوض می‌شود → تشخیص تغییر داده برای کش خروجی
+    if not _has_column(c, "order_headers", "updated_at"):
+        c.execute("ALTER TABLE order_headers ADD COLUMN updated_at INTEGER DEFAULT 0")
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_created_at ON logs (created_at)")
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS export_cache (
+        cache_key TEXT PRIMARY KEY,
+        fingerprint TEXT,
+        file_id TEXT,
+        created_at TEXT
+    )
+    """)
+
+
+def fill_sales_rollups(c):
+    # بازسازی کامل جدول‌های rollup از روی سفارش‌ها (backfill)
+    c.execute("DELETE FROM rollup_food")
+    c.execute("DELETE FROM rollup_slot")
+    c.execute("DELETE FROM rollup_status")
+
+    c.execute("""
+        INSERT INTO rollup_food (order_date, delivery_day, food_name, status, qty, cutlery_qty)
+        SELECT substr(h.created_at, 1, 10), COALESCE(h.delivery_day, ''), i.food_name, h.status,
+               SUM(i.qty), SUM(COALESCE(i.cutlery_qty, 0))
+        FROM order_items i
+        JOIN order_headers h ON h.order_no = i.order_no
+        GROUP BY 1, 2, 3, 4
+    """)
+    c.execute("""
+        INSERT INTO rollup_slot (order_date, delivery_day, delivery_slot, status, orders)
+        SELECT substr(created_at, 1, 10), COALESCE(delivery_day, ''), COALESCE(delivery_slot, ''),
+               status, COUNT(*)
+        FROM order_headers
+        GROUP BY 1, 2, 3, 4
+    """)
+    c.execute("""
+        INSERT INTO rollup_status (order_date, delivery_day, status, orders, revenue)
+        SELECT substr(created_at, 1, 10), COALESCE(delivery_day, ''), status, COUNT(*), TOTAL(total)
+        FROM order_headers
+        GROUP BY 1, 2, 3
+    """)
+
+
+def _migration_sales_rollups(c):
+    # تجمیع روزانه × غذا ، روزانه × بازه ، روزانه × وضعیت
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS rollup_food (
+        order_date TEXT,
+        delivery_day TEXT,
+        food_name TEXT,
+        status TEXT,
+        qty INTEGER NOT NULL DEFAULT 0,
+        cutlery_qty INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (order_date, delivery_day, food_name, status)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS rollup_slot (
+        order_date TEXT,
+        delivery_day TEXT,
+        delivery_slot TEXT,
+        status TEXT,
+        orders INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (order_date, delivery_day, delivery_slot, status)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS rollup_status (
+        order_date TEXT,
+        delivery_day TEXT,
+        status TEXT,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (order_date, delivery_day, status)
+    ) WITHOUT ROWID
+    """)
+
+    fill_sales_rollups(c)
+
+
+def _migration_log_counters(c):
+    # شمارنده ساعتی هر action (ساعت = 'YYYY-MM-DD HH' به وقت برلین)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS log_counters (
+        hour TEXT,
+        action TEXT,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (hour, action)
+    ) WITHOUT ROWID
+    """)
+
+    c.execute("""
+        INSERT OR REPLACE INTO log_counters (hour, action, count)
+        SELECT substr(created_at, 1, 13), action, COUNT(*)
+        FROM logs
+        GROUP BY 1, 2
+    """)
+
+    # رویدادهای سفارش قبلی از روی خود سفارش‌ها
+    c.execute("""
+        INSERT OR REPLACE INTO log_counters (hour, action, count)
+        SELECT substr(created_at, 1, 13), 'order_created', COUNT(*)
+        FROM order_headers
+        GROUP BY 1
+    """)
+    c.execute("""
+        INSERT OR REPLACE INTO log_counters (hour, action, count)
+        SELECT substr(payment_checked_at, 1, 13), 'order_approved', COUNT(*)
+        FROM order_headers
+        WHERE status = 'approved'
+        AND payment_checked_at IS NOT NULL
+        GROUP BY 1
+    """)
+
+
+def _migration_broadcasts(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT,
+        status TEXT,
+        admin_chat_id INTEGER,
+        progress_message_id INTEGER,
+        created_at TEXT
+    )
+    """)
+
+    # وضعیت ارسال برای هر گیرنده: pending / sent / failed / blocked
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER,
+        user_id INTEGER,
+        state TEXT NOT NULL DEFAULT 'pending',
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_state
+        ON broadcast_recipients (broadcast_id, state)
+    """)
+
+
+def _migration_reminders_sent(c):
+    # هر نوع یادآوری برای هر سفارش فقط یکبار
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS reminders_sent (
+        order_no TEXT,
+        kind TEXT,
+        sent_at TEXT,
+        PRIMARY KEY (order_no, kind)
+    ) WITHOUT ROWID
+    """)
+
+
+def _migration_sessions(c):
+    # سبد خرید / مرحله هر کاربر (JSON) تا بعد از ری‌استارت از دست نرود
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sessions (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT,
+        updated_at INTEGER
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at)")
+
+
+def _migration_delivery_method(c):
+    # روش دریافت (ارسال / حضوری) همراه سفارش ذخیره می‌شود
+    if not _has_column(c, "order_headers", "delivery_method"):
+        c.execute("ALTER TABLE order_headers ADD COLUMN delivery_method TEXT")
+
+
+def _migration_menu_items(c):
+    # منوی هر روز تحویل ؛ با منوی قبلی (که در کد بود) پر می‌شود
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS menu_items (
+        delivery_day TEXT,
+        food_key TEXT,
+        name TEXT,
+        price REAL,
+        daily_capacity INTEGER,
+        position INTEGER,
+        PRIMARY KEY (delivery_day, food_key)
+    ) WITHOUT ROWID
+    """)
+
+    seed = {
+        "monday": [
+            ("farani", "🍮 فرنی", 3.5),
+            ("salad", "🥗 پروتینو (سالاد ماکارونی) ", 5),
+            ("ash", "🍛 قیمه با برنج", 8.5),
+            ("ghorme", "🍛🌿 قرمه سبزی با برنج", 8.5),
+            ("gheyme_to_go", "🥡 قیمه (To Go)\u200f", 4),
+            ("ghorme_to_go", "🥡 قرمه (To Go)\u200f", 4),
+        ],
+        "thursday": [
+            ("farani", "🍮 فرنی", 3.5),
+            ("salad", "🥗 پروتینو (سالاد ماکارونی)", 5),
+            ("ash", "🍛 قیمه با برنج", 8.5),
+            ("zereshk", "🍛🌿 قرمه سبزی با برنج", 8.5),
+            ("gheyme_to_go", "🥡 قیمه (To Go)\u200f", 4),
+            ("ghorme_to_go", "🥡 قرمه (To Go)\u200f", 4),
+        ],
+    }
+    c.executemany("""
+        INSERT OR IGNORE INTO menu_items
+        (delivery_day, food_key, name, price, daily_capacity, position)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [
+        (day, key, name, price, MAX_DAILY, position)
+        for day, items in seed.items()
+        for position, (key, name, price) in enumerate(items)
+    ])
+
+
+def _migration_reminder_state(c):
+    # claimed = رزرو شده ولی هنوز ارسال نشده ، sent = ارسال شده ؛ ردیف‌های قبلی ارسال‌شده حساب می‌شوند
+    if not _has_column(c, "reminders_sent", "state"):
+        c.execute("ALTER TABLE reminders_sent ADD COLUMN state TEXT NOT NULL DEFAULT 'sent'")
+    if not _has_column(c, "reminders_sent", "claimed_at"):
+        c.execute("ALTER TABLE reminders_sent ADD COLUMN claimed_at INTEGER")
+
+
+# ترتیب این لیست هرگز عوض نشود؛ فقط به انتهای آن اضافه کنید
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_delivery_columns,
+    _migration_order_indexes,
+    _migration_stock_counters,
+    _migration_slot_capacity,
+    _migration_order_expiry,
+    _migration_order_headers,
+    _migration_report_indexes,
+    _migration_export_cache,
+    _migration_sales_rollups,
+    _migration_log_counters,
+    _migration_broadcasts,
+    _migration_reminders_sent,
+    _migration_sessions,
+    _migration_delivery_method,
+    _migration_menu_items,
+    _migration_reminder_state,
+]
+
+
+def migrate_db(conn):
+    c = conn.cursor()
+    c.execute("PRAGMA user_version")
+    version = c.fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            migration(c)
+            c.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        print(f"DB migrated to version {number} ({migration.__name__})")
+
+
+migrate_db(get_conn())
+
+# ---------- SESSIONS ----------
+SESSION_MEMORY_MAX = int(os.environ.get("SESSION_MEMORY_MAX", 2000))             # حداکثر session در حافظه
+SESSION_IDLE_SECONDS = int(os.environ.get("SESSION_IDLE_SECONDS", 15 * 60))   # بعد از این مدت از حافظه خارج می‌شود
+SESSION_MAX_AGE_SECONDS = int(os.environ.get("SESSION_MAX_AGE_SECONDS", 24 * 3600))  # بعد از این مدت کلاً حذف می‌شود
+
+class SessionStore:
+    # LRU در حافظه + جدول sessions ؛ بعد از eviction با اولین پیام دوباره لود می‌شود
+    # نوشتن در دیتابیس فقط یکبار در پایان هر آپدیت (save) و فقط اگر state عوض شده باشد
+    def __init__(self):
+        self.sessions = OrderedDict()       # uid → [state, last_seen, آخرین JSON ذخیره‌شده]
+        self.evicted = OrderedDict()        # بیرون‌رفته از LRU که هنوز نوشته نشده‌اند (sweeper می‌نویسد)
+        self.evicted_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def _persist(self, uid, state, saved=None):
+        # saved = JSON قبلی ؛ اگر همان باشد چیزی نوشته نمی‌شود
+        data = json.dumps(state, separators=(",", ":"), ensure_ascii=False)
+        if data == saved:
+            return data
+
+        conn = get_conn()
+        conn.execute("""
+            INSERT OR REPLACE INTO sessions (user_id, data, updated_at)
+            VALUES (?, ?, ?)
+        """, (uid, data, int(time.time())))
+        conn.commit()
+        return data
+
+    def _load(self, uid):
+        row = get_conn().execute(
+            "SELECT data, updated_at FROM sessions WHERE user_id = ?", (uid,)
+        ).fetchone()
+
+        if not row or row[1] < time.time() - SESSION_MAX_AGE_SECONDS:
+            return None, None
+        return json.loads(row[0]), row[0]
+
+    def _remember(self, uid, state, saved=None):
+        # نوشتن eviction در thread هندلر انجام نمی‌شود ؛ فقط در صف sweeper می‌رود
+        with self.lock:
+            old = self.sessions.get(uid)
+            if saved is None and old:
+                saved = old[2]
+            self.sessions[uid] = [state, time.monotonic(), saved]
+            self.sessions.move_to_end(uid)
+            while len(self.sessions) > SESSION_MEMORY_MAX:
+                old_uid, old_entry = self.sessions.popitem(last=False)
+                self.evicted[old_uid] = old_entry
+                self.evicted_event.set()
+
+    def flush_evicted(self):
+        with self.lock:
+            pending = list(self.evicted.items())
+
+        for uid, entry in pending:
+            self._persist(uid, entry[0], entry[2])
+            with self.lock:
+                if self.evicted.get(uid) is entry:
+                    del self.evicted[uid]
+        return len(pending)
+
+    def get(self, uid, default=None):
+        with self.lock:
+            entry = self.sessions.get(uid)
+            if entry:
+                entry[1] = time.monotonic()
+                self.sessions.move_to_end(uid)
+                return entry[0]
+
+            # هنوز در صف نوشتن است ؛ نسخه دیتابیس قدیمی است
+            entry = self.evicted.pop(uid, None)
+
+        if entry:
+            self._remember(uid, entry[0], entry[2])
+            return entry[0]
+
+        state, saved = self._load(uid)
+        if state is None:
+            return default
+
+        self._remember(uid, state, saved)
+        return state
+
+    def __getitem__(self, uid):
+        state = self.get(uid)
+        if state is None:
+            raise KeyError(uid)
+        return state
+
+    def __setitem__(self, uid, state):
+        # dirty تا save در پایان آپدیت
+        self._remember(uid, state)
+
+    def __contains__(self, uid):
+        return self.get(uid) is not None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def pop(self, uid, default=None):
+        with self.lock:
+            entry = self.sessions.pop(uid, None) or self.evicted.pop(uid, None)
+
+        # هرگز ذخیره نشده ؛ ردیفی برای پاک کردن نیست
+        if entry and entry[2] is None:
+            return entry[0]
+
+        conn = get_conn()
+        conn.execute("DELETE FROM sessions WHERE user_id = ?", (uid,))
+        conn.commit()
+        return entry[0] if entry else default
+
+    def save(self, uid):
+        # تغییرات درجا (st["step"] = ...) هم با مقایسه JSON دیده می‌شوند
+        with self.lock:
+            entry = self.sessions.get(uid)
+            if not entry:
+                return
+            state, saved = entry[0], entry[2]
+
+        data = self._persist(uid, state, saved)
+        with self.lock:
+            if self.sessions.get(uid) is entry:
+                entry[2] = data
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - SESSION_IDLE_SECONDS
+        with self.lock:
+            idle = [uid for uid, (_, last_seen, _) in self.sessions.items() if last_seen < cutoff]
+            evicted = [(uid, self.sessions.pop(uid)) for uid in idle]
+
+        for uid, (state, _, saved) in evicted:
+            self._persist(uid, state, saved)
+
+        conn = get_conn()
+        conn.execute(
+            "DELETE FROM sessions WHERE updated_at < ?",
+            (int(time.time()) - SESSION_MAX_AGE_SECONDS,)
+        )
+        conn.commit()
+        return len(evicted)
+
+
+def session_sweeper_loop():
+    # با هر eviction بیدار می‌شود ؛ پاکسازی idle هر ۶۰ ثانیه
+    last_sweep = time.monotonic()
+    while True:
+        user_state.evicted_event.wait(60)
+        user_state.evicted_event.clear()
+        try:
+            user_state.flush_evicted()
+            if time.monotonic() - last_sweep >= 60:
+                last_sweep = time.monotonic()
+                user_state.evict_idle()
+        except Exception as e:
+            print(f"session sweep failed: {e}")
+
+
+def persist_session(update: Update, context: CallbackContext):
+    # گروه آخر dispatcher: بعد از هندلر اصلی اجرا می‌شود
+    if update.effective_user:
+        user_state.save(update.effective_user.id)
 
-# ---------- DISCOUNT USAGE ----------
-cur.execute("""
-CREATE TABLE IF NOT EXISTS discount_usage (
-    user_id INTEGER,
-    code TEXT,
-    PRIMARY KEY (user_id, code)
-)
-""")
-conn.commit()
 
 # ---------- UTILITY ----------
-user_state = {}
-orders_runtime = {}
+user_state = SessionStore()
+
+# وضعیت‌هایی که موجودی غذا را نگه می‌دارند
+HELD_STATUSES = ("pending", "approved")
+
+def get_sold_qty(c, food_key, delivery_day):
+    c.execute("""
+        SELECT qty FROM stock_counters
+        WHERE delivery_day = ?
+        AND food_key = ?
+    """, (delivery_day, food_key))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+
 def get_remaining_stock(food_key, delivery_day):
-    cur.execute("""
-        SELECT SUM(qty) FROM orders
-        WHERE food_key = ?
-        AND delivery_day = ?
-        AND status IN ('pending','approved')
-    """, (food_key, delivery_day))
-    
-    sold = cur.fetchone()[0] or 0
-    remaining = MAX_DAILY - sold
+    sold = get_sold_qty(get_conn().cursor(), food_key, delivery_day)
+    remaining = get_food_capacity(food_key, delivery_day) - sold
     return max(remaining, 0)
     
 
-def get_slot_count(delivery_day, slot):
-    cur.execute("""
-        SELECT COUNT(DISTINCT order_no) FROM orders
+def get_slot_usage(c, delivery_day, slot):
+    c.execute("""
+        SELECT booked, capacity FROM slot_capacity
         WHERE delivery_day = ?
-          AND delivery_slot = ?
-          AND status IN ('pending','approved')
+          AND slot = ?
     """, (delivery_day, slot))
-    return cur.fetchone()[0] or 0
+    row = c.fetchone()
+    return row if row else (0, SLOT_CAPACITY)
+
+
+def is_slot_full(delivery_day, slot):
+    booked, capacity = get_slot_usage(get_conn().cursor(), delivery_day, slot)
+    return booked >= capacity
+
+
+def set_slot_capacity(delivery_day, starts, capacity):
+    # starts = شروع بازه‌ها (مثلاً 12:00) ؛ booked دست نمی‌خورد
+    slots = [f"{start} – {end}" for start, end in get_delivery_slots() if start in starts]
+
+    conn = get_conn()
+    conn.executemany("""
+        INSERT INTO slot_capacity (delivery_day, slot, booked, capacity)
+        VALUES (?, ?, 0, ?)
+        ON CONFLICT (delivery_day, slot) DO UPDATE SET capacity = excluded.capacity
+    """, [(delivery_day, slot, capacity) for slot in slots])
+    conn.commit()
+
+    invalidate_day_keyboards(delivery_day)
+    return slots
+
+
+def slot_capacity_text():
+    cur = get_conn().cursor()
+    cur.execute("SELECT delivery_day, slot, booked, capacity FROM slot_capacity")
+    usage = {(day, slot): (booked, capacity) for day, slot, booked, capacity in cur.fetchall()}
+
+    lines = []
+    for day_en, day in DELIVERY_DAY_FA.items():
+        lines.append(f"📅 {day} ({day_en})")
+        for start, end in get_delivery_slots():
+            slot = f"{start} – {end}"
+            booked, capacity = usage.get((day, slot), (0, SLOT_CAPACITY))
+            lines.append(f"  ⏰ {slot}: {booked}/{capacity}")
+    return "\n".join(lines)
+
+
+def get_delivery_slots():
+    # بازه‌های نیم‌ساعته بین START_HOUR و END_HOUR
+    slots = []
+    hour = START_HOUR
+    minute = 0
+
+    while hour < END_HOUR:
+        start = f"{hour:02d}:{minute:02d}"
+
+        minute += 30
+        if minute == 60:
+            hour += 1
+            minute = 0
+
+        end = f"{hour:02d}:{minute:02d}"
+        slots.append((start, end))
+
+    return slots
+
+
+# ---------- EVENT LOG (WRITE-BEHIND) ----------
+# هندلرها فقط رویداد را در صف می‌گذارند؛ نوشتن در جدول logs در پس‌زمینه انجام می‌شود
+LOG_QUEUE_MAX = 10000
+LOG_FLUSH_EVERY = 50          # بعد از این تعداد رویداد فوراً نوشته شود
+LOG_FLUSH_MS = 500            # حداکثر تأخیر نوشتن
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+log_stats = {"queued": 0, "written": 0, "dropped": 0}
+_log_stats_lock = threading.Lock()
+_log_flush_lock = threading.Lock()
+_log_wakeup = threading.Event()
+
+def log_event(uid, action):
+    event = (uid, action, datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"))
+
+    try:
+        log_queue.put_nowait(event)
+    except queue.Full:
+        with _log_stats_lock:
+            log_stats["dropped"] += 1
+        return
+
+    with _log_stats_lock:
+        log_stats["queued"] += 1
+
+    if log_queue.qsize() >= LOG_FLUSH_EVERY:
+        _log_wakeup.set()
+
+
+def flush_logs():
+    with _log_flush_lock:
+        rows = []
+        while True:
+            try:
+                rows.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if not rows:
+            return 0
+
+        # شمارنده ساعتی هر action در همان تراکنش
+        hourly = {}
+        for _, action, created_at in rows:
+            key = (created_at[:13], action)
+            hourly[key] = hourly.get(key, 0) + 1
+
+        conn = get_conn()
+        try:
+            conn.executemany(
+                "INSERT INTO logs (user_id, action, created_at) VALUES (?, ?, ?)",
+                rows
+            )
+            conn.executemany("""
+                INSERT INTO log_counters (hour, action, count)
+                VALUES (?, ?, ?)
+                ON CONFLICT (hour, action) DO UPDATE SET count = count + excluded.count
+            """, [(hour, action, count) for (hour, action), count in hourly.items()])
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            with _log_stats_lock:
+                log_stats["dropped"] += len(rows)
+            print(f"log flush failed ({len(rows)} events dropped): {e}")
+            return 0
+
+        with _log_stats_lock:
+            log_stats["written"] += len(rows)
+        return len(rows)
+
+
+def log_writer_loop():
+    while True:
+        _log_wakeup.wait(LOG_FLUSH_MS / 1000)
+        _log_wakeup.clear()
+        try:
+            flush_logs()
+        except Exception as e:
+            print(f"log writer error: {e}")
+
+
+# رویدادهای باقی‌مانده در صف هنگام خروج نوشته شوند
+atexit.register(flush_logs)
 
 
 def send_payment_message(context, uid, st):
@@ -190,11 +1106,14 @@ def send_payment_message(context, uid, st):
         "🙏 پس از پرداخت PayPal روی «پرداخت انجام شد» بزنید."
     )
 
-    context.bot.send_message(uid, text)
+    # دو پیام پشت‌سرهم → یک پیام با دکمه‌ها
+    outbox.send(context.bot, uid, text, coalesce=True)
 
-    context.bot.send_message(
-        chat_id=uid,
-        text="💳 برای پرداخت روی دکمه زیر بزنید:",
+    outbox.send(
+        context.bot,
+        uid,
+        "💳 برای پرداخت روی دکمه زیر بزنید:",
+        coalesce=True,
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("💳 پرداخت با PayPal", url=f"{PAYPAL_BASE_LINK}/{round(st['total'],2)}")],
             [InlineKeyboardButton("✅ پرداخت انجام شد", callback_data="paid_paypal")],
@@ -202,13 +1121,7 @@ def send_payment_message(context, uid, st):
         ])
     )
     
-# ---------- ANTI-SPAM ----------
-user_last_msgs = {}     # آخرین زمان پیام کاربر
-user_msg_count = {}     # تعداد پیام‌های اخیر
-user_discount_attempts = {}
-SPAM_WINDOW = 4         # بازه زمانی (ثانیه)
-SPAM_LIMIT = 5          # حداکثر پیام مجاز در این بازه
-
+# ---------- HELPERS ----------
 def reset_user(uid):
     user_state.pop(uid, None)
 
@@ -268,83 +1181,349 @@ def get_target_delivery_day():
 
     return None  # دوشنبه یا پنج‌شنبه (روز تحویل → سفارش بسته)
     
+# ---------- CHANNEL MEMBERSHIP CACHE ----------
+MEMBER_TTL_SECONDS = 10 * 60        # جواب مثبت
+NON_MEMBER_TTL_SECONDS = 30         # جواب منفی (تا بعد از عضویت زود دیده شود)
+MEMBER_CACHE_MAX = 10000
+MEMBER_CHECK_TIMEOUT = 3
+MEMBER_OUTAGE_BACKOFF = 30          # بعد از خطای تلگرام، تا این مدت از جواب قدیمی استفاده شود
+
+member_cache = OrderedDict()        # user_id → (is_member, expires_at)
+member_cache_stats = {"hits": 0, "misses": 0, "stale": 0, "errors": 0}
+_member_lock = threading.Lock()
+_member_inflight = {}               # user_id → Event ؛ درخواست‌های همزمان یکی می‌شوند
+_member_outage_until = 0
+
+def invalidate_membership(user_id):
+    with _member_lock:
+        member_cache.pop(user_id, None)
+
+
+def _store_membership(user_id, is_member):
+    ttl = MEMBER_TTL_SECONDS if is_member else NON_MEMBER_TTL_SECONDS
+    with _member_lock:
+        member_cache[user_id] = (is_member, time.monotonic() + ttl)
+        member_cache.move_to_end(user_id)
+        while len(member_cache) > MEMBER_CACHE_MAX:
+            member_cache.popitem(last=False)
+
+
 def is_user_member(bot, user_id):
+    global _member_outage_until
+
+    now = time.monotonic()
+    with _member_lock:
+        entry = member_cache.get(user_id)
+
+        if entry and entry[1] > now:
+            member_cache_stats["hits"] += 1
+            member_cache.move_to_end(user_id)
+            return entry[0]
+
+        # تلگرام در دسترس نیست → جواب قدیمی بهتر از انتظار است
+        if entry and now < _member_outage_until:
+            member_cache_stats["stale"] += 1
+            return entry[0]
+
+        member_cache_stats["misses"] += 1
+        event = _member_inflight.get(user_id)
+        leader = event is None
+        if leader:
+            event = threading.Event()
+            _member_inflight[user_id] = event
+
+    if not leader:
+        event.wait(MEMBER_CHECK_TIMEOUT)
+        with _member_lock:
+            entry = member_cache.get(user_id)
+        return entry[0] if entry else False
+
     try:
-        member = bot.get_chat_member(CHANNEL_USERNAME, user_id)
-        return member.status in ["member", "administrator", "creator"]
-    except:
+        member = bot.get_chat_member(CHANNEL_USERNAME, user_id, timeout=MEMBER_CHECK_TIMEOUT)
+        result = member.status in ["member", "administrator", "creator"]
+        _store_membership(user_id, result)
+        return result
+    except BadRequest:
+        # کاربر در کانال پیدا نشد
+        _store_membership(user_id, False)
         return False
-        
-def create_order(user_id, food_key, food_name, qty, total, cutlery_qty, payment_method, delivery_day, delivery_slot, order_no=None):
-    from random import randint
+    except Exception:
+        with _member_lock:
+            member_cache_stats["errors"] += 1
+            _member_outage_until = time.monotonic() + MEMBER_OUTAGE_BACKOFF
+            entry = member_cache.get(user_id)
+            if entry:
+                member_cache_stats["stale"] += 1
+        return entry[0] if entry else False
+    finally:
+        with _member_lock:
+            _member_inflight.pop(user_id, None)
+        event.set()
+
+
+def update_queue_status_text():
+    if not update_scheduler:
+        return "⚙️ صف آپدیت: غیرفعال"
+
+    stats = update_scheduler.stats()
+    return (
+        f"⚙️ صف آپدیت: {stats['depth']} در انتظار (بیشترین shard {stats['max_shard_depth']}) | "
+        f"{stats['processed']} پردازش‌شده | انتظار p50 {stats['wait_p50_ms']}ms | "
+        f"p95 {stats['wait_p95_ms']}ms | max {stats['wait_max_ms']}ms"
+    )
 
-    if order_no is None:
-        today = datetime.now(TIMEZONE).strftime("%Y%m%d")
-        rand = randint(100, 999)
-        order_no = f"CH-{today}-{uuid.uuid4().hex[:6]}"
 
-    cur.execute("""
-        INSERT INTO orders
-        (order_no, user_id, food_key, food_name, qty, cutlery_qty, total, status, payment_method, created_at, delivery_day, delivery_slot)
-        VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?, ?, ?)
-    """, (
-        order_no,
-        user_id,
-        food_key,
-        food_name,
-        qty,
-        cutlery_qty,
-        total,
-        payment_method,
-        datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"),
-        delivery_day,
-        delivery_slot
-    ))
-    conn.commit()
-    return order_no
+def outbox_status_text():
+    depth = outbox.depth()
+    return (
+        f"📤 صف ارسال: urgent {depth['urgent']} | bulk {depth['bulk']} | "
+        f"ارسال {outbox.stats['sent']} | ادغام {outbox.stats['coalesced']} | "
+        f"ناموفق {outbox.stats['failed']} | بلاک {outbox.stats['blocked']} | RetryAfter {outbox.stats['retry_after']}"
+    )
 
-def close_order(order_no, status):
-    cur.execute("""
-        UPDATE orders SET status=?, payment_checked_at=?
-        WHERE order_no=?
-    """, (
-        status,
-        datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"),
-        order_no
-    ))
-    conn.commit()
 
-def safe_create_order(user_id, items, delivery_day, delivery_slot, total, payment_method, discount_code=None):
-    try:
-        conn.execute("BEGIN IMMEDIATE")  # 🔒 قفل دیتابیس
+def system_status_text():
+    return (
+        "📈 وضعیت سیستم\n\n"
+        f"🛒 session در حافظه: {len(user_state)}\n"
+        f"🚦 ضد اسپم: {len(update_limiter.buckets)} کاربر | {update_limiter.dropped} آپدیت ردشده | "
+        f"{discount_limiter.dropped} حدس کد ردشده\n"
+        f"⌨️ کش کیبورد: {len(keyboard_cache)} | hit {keyboard_cache_stats['hits']} | "
+        f"ساخت {keyboard_cache_stats['builds']}\n"
+        f"👥 کش عضویت: {len(member_cache)} کاربر | "
+        f"hit {member_cache_stats['hits']} | miss {member_cache_stats['misses']} | "
+        f"stale {member_cache_stats['stale']} | خطا {member_cache_stats['errors']}\n"
+        f"{update_queue_status_text()}\n"
+        f"{outbox_status_text()}\n"
+        f"🌐 حالت: {BOT_MODE} | webhook پذیرفته {webhook_stats['accepted']} | "
+        f"ردشده (صف پر) {webhook_stats['shed']} | توکن نامعتبر {webhook_stats['forbidden']} | "
+        f"بدنه نامعتبر {webhook_stats['invalid']}\n"
+        f"📝 صف لاگ: {log_queue.qsize()} در انتظار | "
+        f"{log_stats['written']} نوشته‌شده | {log_stats['dropped']} ازدست‌رفته"
+    )
+
+
+# ---------- STOCK LEDGER ----------
+def adjust_stock_counters(c, order_no, sign):
+    # sign = 1 → رزرو موجودی ، sign = -1 → آزاد کردن موجودی
+    c.execute("""
+        INSERT INTO stock_counters (delivery_day, food_key, qty)
+        SELECT h.delivery_day, i.food_key, ? * SUM(i.qty)
+        FROM order_items i
+        JOIN order_headers h ON h.order_no = i.order_no
+        WHERE i.order_no = ?
+          AND h.delivery_day IS NOT NULL AND i.food_key IS NOT NULL
+        GROUP BY h.delivery_day, i.food_key
+        ON CONFLICT (delivery_day, food_key)
+        DO UPDATE SET qty = qty + excluded.qty
+    """, (sign, order_no))
+
+
+def adjust_slot_booking(c, order_no, sign):
+    c.execute("""
+        INSERT INTO slot_capacity (delivery_day, slot, booked, capacity)
+        SELECT delivery_day, delivery_slot, ?, ?
+        FROM order_headers
+        WHERE order_no = ?
+          AND delivery_day IS NOT NULL AND delivery_slot IS NOT NULL
+        ON CONFLICT (delivery_day, slot)
+        DO UPDATE SET booked = booked + excluded.booked
+    """, (sign, SLOT_CAPACITY, order_no))
+
+
+def adjust_order_holds(c, order_no, sign):
+    adjust_stock_counters(c, order_no, sign)
+    adjust_slot_booking(c, order_no, sign)
+
+
+def set_order_status(c, order_no, status, checked_at=None):
+    # باید داخل تراکنش صدا زده شود
+    c.execute("SELECT status, user_id FROM order_headers WHERE order_no = ?", (order_no,))
+    row = c.fetchone()
+    if not row:
+        return None
+
+    old_status, user_id = row
+
+    c.execute("""
+        UPDATE order_headers
+        SET status = ?,
+            payment_checked_at = COALESCE(?, payment_checked_at),
+            updated_at = ?
+        WHERE order_no = ?
+    """, (status, checked_at, int(time.time()), order_no))
+
+    was_held = old_status in HELD_STATUSES
+    is_held = status in HELD_STATUSES
+
+    if was_held and not is_held:
+        adjust_order_holds(c, order_no, -1)
+    elif is_held and not was_held:
+        adjust_order_holds(c, order_no, 1)
+
+    if old_status != status:
+        apply_sales_rollups(c, order_no, old_status, -1)
+        apply_sales_rollups(c, order_no, status, 1)
+        log_event(user_id, f"order_{status}")
+
+    return old_status
+
+
+# ---------- SALES ROLLUPS ----------
+def apply_sales_rollups(c, order_no, status, sign):
+    # سهم یک سفارش را با وضعیت داده‌شده به rollup ها اضافه (sign=1) یا کم (sign=-1) می‌کند
+    c.execute("""
+        INSERT INTO rollup_food (order_date, delivery_day, food_name, status, qty, cutlery_qty)
+        SELECT substr(h.created_at, 1, 10), COALESCE(h.delivery_day, ''), i.food_name, ?,
+               ? * SUM(i.qty), ? * SUM(COALESCE(i.cutlery_qty, 0))
+        FROM order_items i
+        JOIN order_headers h ON h.order_no = i.order_no
+        WHERE i.order_no = ?
+        GROUP BY i.food_name
+        ON CONFLICT (order_date, delivery_day, food_name, status)
+        DO UPDATE SET qty = qty + excluded.qty,
+                      cutlery_qty = cutlery_qty + excluded.cutlery_qty
+    """, (status, sign, sign, order_no))
+
+    c.execute("""
+        INSERT INTO rollup_slot (order_date, delivery_day, delivery_slot, status, orders)
+        SELECT substr(created_at, 1, 10), COALESCE(delivery_day, ''), COALESCE(delivery_slot, ''), ?, ?
+        FROM order_headers
+        WHERE order_no = ?
+        ON CONFLICT (order_date, delivery_day, delivery_slot, status)
+        DO UPDATE SET orders = orders + excluded.orders
+    """, (status, sign, order_no))
+
+    c.execute("""
+        INSERT INTO rollup_status (order_date, delivery_day, status, orders, revenue)
+        SELECT substr(created_at, 1, 10), COALESCE(delivery_day, ''), ?, ?, ? * COALESCE(total, 0)
+        FROM order_headers
+        WHERE order_no = ?
+        ON CONFLICT (order_date, delivery_day, status)
+        DO UPDATE SET orders = orders + excluded.orders,
+                      revenue = revenue + excluded.revenue
+    """, (status, sign, sign, order_no))
+
+
+def rebuild_sales_rollups():
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        fill_sales_rollups(cur)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def reconcile_counters():
+    # شمارنده‌های موجودی و ظرفیت را از روی سفارش‌ها از نو می‌سازد و اختلاف‌ها را برمی‌گرداند
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+
+        cur.execute("""
+            SELECT h.delivery_day, i.food_key, SUM(i.qty)
+            FROM order_items i
+            JOIN order_headers h ON h.order_no = i.order_no
+            WHERE h.status IN ('pending','approved')
+              AND h.delivery_day IS NOT NULL AND i.food_key IS NOT NULL
+            GROUP BY h.delivery_day, i.food_key
+        """)
+        expected = {(day, key): qty for day, key, qty in cur.fetchall()}
+
+        cur.execute("SELECT delivery_day, food_key, qty FROM stock_counters")
+        actual = {(day, key): qty for day, key, qty in cur.fetchall()}
+
+        drift = [
+            (day, key, actual.get((day, key), 0), expected.get((day, key), 0))
+            for day, key in sorted(set(expected) | set(actual), key=str)
+            if actual.get((day, key), 0) != expected.get((day, key), 0)
+        ]
+
+        cur.execute("DELETE FROM stock_counters")
+        cur.executemany(
+            "INSERT INTO stock_counters (delivery_day, food_key, qty) VALUES (?, ?, ?)",
+            [(day, key, qty) for (day, key), qty in expected.items()]
+        )
+
+        cur.execute("""
+            SELECT delivery_day, delivery_slot, COUNT(*)
+            FROM order_headers
+            WHERE status IN ('pending','approved')
+              AND delivery_day IS NOT NULL AND delivery_slot IS NOT NULL
+            GROUP BY delivery_day, delivery_slot
+        """)
+        expected = {(day, slot): count for day, slot, count in cur.fetchall()}
+
+        cur.execute("SELECT delivery_day, slot, booked FROM slot_capacity")
+        actual = {(day, slot): booked for day, slot, booked in cur.fetchall()}
+
+        drift += [
+            (day, slot, actual.get((day, slot), 0), expected.get((day, slot), 0))
+            for day, slot in sorted(set(expected) | set(actual), key=str)
+            if actual.get((day, slot), 0) != expected.get((day, slot), 0)
+        ]
+
+        # ظرفیت تعریف‌شده هر بازه حفظ می‌شود، فقط booked بازسازی می‌شود
+        cur.execute("UPDATE slot_capacity SET booked = 0")
+        cur.executemany("""
+            INSERT INTO slot_capacity (delivery_day, slot, booked, capacity)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (delivery_day, slot) DO UPDATE SET booked = excluded.booked
+        """, [(day, slot, count, SLOT_CAPACITY) for (day, slot), count in expected.items()])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    invalidate_day_keyboards()
+    return drift
+
+
+def close_order(order_no, status):
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT delivery_day FROM order_headers WHERE order_no = ?", (order_no,))
+        row = cur.fetchone()
+        set_order_status(
+            cur,
+            order_no,
+            status,
+            datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M")
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if row:
+        invalidate_day_keyboards(row[0])
+
+def safe_create_order(user_id, items, delivery_day, delivery_slot, total, payment_method, discount_code=None, contact=None):
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        conn.execute("BEGIN IMMEDIATE")  # 🔒 قفل دیتابیس
 
         # 1. چک موجودی
         for item in items:
             if item["food_key"] == "gift_farani":
                 continue
-            cur.execute("""
-                SELECT SUM(qty) FROM orders
-                WHERE food_key = ?
-                AND delivery_day = ?
-                AND status IN ('pending','approved')
-            """, (item["food_key"], delivery_day))
-
-            sold = cur.fetchone()[0] or 0
-            if sold + item["qty"] > MAX_DAILY:
+
+            sold = get_sold_qty(cur, item["food_key"], delivery_day)
+            if sold + item["qty"] > get_food_capacity(item["food_key"], delivery_day):
                 conn.rollback()
                 return False, "❌ موجودی غذا کافی نیست"
 
         # 2. چک ظرفیت تایم
-        cur.execute("""
-            SELECT COUNT(DISTINCT order_no) FROM orders
-            WHERE delivery_day = ?
-            AND delivery_slot = ?
-            AND status IN ('pending','approved')
-        """, (delivery_day, delivery_slot))
+        booked, capacity = get_slot_usage(cur, delivery_day, delivery_slot)
 
-        count = cur.fetchone()[0] or 0
-
-        if count >= 3:
+        if booked >= capacity:
             conn.rollback()
             return False, "❌ این بازه زمانی پر شده"
 
@@ -362,121 +1541,400 @@ def safe_create_order(user_id, items, delivery_day, delivery_slot, total, paymen
                 conn.rollback()
                 return False, "❌ کد تخفیف نامعتبر شد"
 
-            percent, max_use, used = row
+            _, max_use, used = row
 
             if used >= max_use:
                 conn.rollback()
                 return False, "❌ ظرفیت کد تخفیف تمام شد"
         
         # 3. ثبت سفارش
-        from random import randint
         today = datetime.now(TIMEZONE).strftime("%Y%m%d")
-        rand = randint(100, 999)
         order_no = f"CH-{today}-{uuid.uuid4().hex[:6]}"
+        expires_at = int(time.time()) + ORDER_TTL_SECONDS
+        contact = contact or {}
 
-        for item in items:
-            cur.execute("""
-                INSERT INTO orders
-                (order_no, user_id, food_key, food_name, qty, cutlery_qty, total, status, payment_method, created_at, delivery_day, delivery_slot)
-                VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?, ?, ?)
-            """, (
+        cur.execute("""
+            INSERT INTO order_headers
+            (order_no, user_id, total, status, payment_method, created_at, delivery_day, delivery_slot,
+             expires_at, fullname, phone, address, postcode, delivery_method, updated_at)
+            VALUES (?, ?, ?, 'pending', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            order_no,
+            user_id,
+            total,
+            payment_method,
+            datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"),
+            delivery_day,
+            delivery_slot,
+            expires_at,
+            contact.get("fullname"),
+            contact.get("phone"),
+            contact.get("address"),
+            contact.get("postcode"),
+            contact.get("delivery_method"),
+            int(time.time())
+        ))
+
+        cur.executemany("""
+            INSERT INTO order_items
+            (order_no, food_key, food_name, qty, cutlery_qty, price)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [
+            (
                 order_no,
-                user_id,
                 item["food_key"],
                 item["food_name"],
                 item["qty"],
-                item.get("cutlery_qty", 0),
-                total,
-                payment_method,
-                datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"),
-                delivery_day,
-                delivery_slot
-            ))
-
+                item.get("cutlery_qty") or 0,
+                item.get("price")
+            )
+            for item in items
+        ])
 
+        if discount_code:
             cur.execute("""
                 INSERT OR IGNORE INTO discount_usage (user_id, code)
                 VALUES (?, ?)
             """, (user_id, discount_code))
+
+        adjust_order_holds(cur, order_no, 1)
+        apply_sales_rollups(cur, order_no, "pending", 1)
         conn.commit()
+        invalidate_day_keyboards(delivery_day)
+        schedule_expiry(order_no, expires_at)
+        log_event(user_id, "order_created")
         return True, order_no
 
     except Exception as e:
         conn.rollback()
         return False, str(e)
 
-def expire_pending_orders():
+# ---------- ORDER EXPIRY SCHEDULER ----------
+# heap از (expires_at, order_no)؛ فقط سفارش‌هایی که موعدشان رسیده منقضی می‌شوند
+_expiry_heap = []
+_expiry_cond = threading.Condition()
+
+def schedule_expiry(order_no, expires_at):
+    with _expiry_cond:
+        heapq.heappush(_expiry_heap, (expires_at, order_no))
+        _expiry_cond.notify()
+
+
+def load_pending_expiries():
+    conn = get_conn()
+    cur = conn.cursor()
     cur.execute("""
-        UPDATE orders
-        SET status = 'expired'
+        SELECT order_no, expires_at FROM order_headers
         WHERE status = 'pending'
-        AND datetime(created_at) < datetime('now','-5 minutes','localtime')
     """)
-    conn.commit()
+
+    with _expiry_cond:
+        for order_no, expires_at in cur.fetchall():
+            heapq.heappush(_expiry_heap, (expires_at or 0, order_no))
+        _expiry_cond.notify()
+
+
+def expire_order(order_no):
+    # فقط اگر هنوز pending باشد؛ user_id را برای اطلاع‌رسانی برمی‌گرداند
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        cur.execute("""
+            SELECT user_id, status, delivery_day FROM order_headers
+            WHERE order_no = ?
+        """, (order_no,))
+        row = cur.fetchone()
+
+        if not row or row[1] != "pending":
+            conn.rollback()
+            return None
+
+        set_order_status(cur, order_no, "expired")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    invalidate_day_keyboards(row[2])
+    return row[0]
+
+
+def expire_loop():
+    load_pending_expiries()
+
+    while True:
+        with _expiry_cond:
+            while not _expiry_heap:
+                _expiry_cond.wait()
+
+            expires_at, order_no = _expiry_heap[0]
+            delay = expires_at - time.time()
+            if delay > 0:
+                _expiry_cond.wait(delay)
+                continue
+
+            heapq.heappop(_expiry_heap)
+
+        try:
+            user_id = expire_order(order_no)
+        except Exception as e:
+            print(f"expire {order_no} failed: {e}")
+            schedule_expiry(order_no, time.time() + 30)
+            continue
+
+        if user_id is None:
+            continue
+
+        outbox.send(
+            bot,
+            user_id,
+            f"⏰ سفارش {order_no} به علت پایان مهلت پرداخت/تأیید منقضی شد.\n"
+            "در صورت تمایل می‌توانید مجدداً سفارش ثبت کنید 🙏"
+        )
 
 # ---------- MENU BASED ON DAY ----------
+# ---------- MENU CATALOG ----------
+# منو یکبار از menu_items خوانده و به ساختار فقط‌خواندنی تبدیل می‌شود:
+# day → food_key → {name, price, daily_capacity} ؛ تعویض منو فقط یک انتساب است
+DELIVERY_DAY_EN = {fa: en for en, fa in DELIVERY_DAY_FA.items()}
+MENU_MAX_UPLOAD_BYTES = 64 * 1024
+EMPTY_MENU = MappingProxyType({})
+menu_catalog = None
+
+def load_menu_catalog():
+    global menu_catalog
+    cur = get_conn().cursor()
+    cur.execute("""
+        SELECT delivery_day, food_key, name, price, daily_capacity
+        FROM menu_items
+        ORDER BY delivery_day, position
+    """)
+
+    days = {}
+    for day, key, name, price, capacity in cur.fetchall():
+        days.setdefault(day, {})[key] = MappingProxyType({
+            "name": name,
+            "price": price,
+            "daily_capacity": capacity
+        })
+
+    menu_catalog = MappingProxyType({day: MappingProxyType(items) for day, items in days.items()})
+    return menu_catalog
+
+
+def get_menu_catalog():
+    return menu_catalog if menu_catalog is not None else load_menu_catalog()
+
+
 def get_foods_for_target_day():
-    target = get_target_delivery_day()
+    return get_menu_catalog().get(get_target_delivery_day(), EMPTY_MENU)
+
+
+def get_food_capacity(food_key, delivery_day):
+    # delivery_day فارسی (مثل سفارش‌ها) یا انگلیسی
+    foods = get_menu_catalog().get(DELIVERY_DAY_EN.get(delivery_day, delivery_day), EMPTY_MENU)
+    food = foods.get(food_key)
+    return food["daily_capacity"] if food else MAX_DAILY
+
+
+def parse_menu_catalog(data):
+    # {"monday": [{"key", "name", "price", "daily_capacity"}, ...], "thursday": [...]}
+    if not isinstance(data, dict) or not data:
+        raise ValueError("ساختار باید {روز: [غذاها]} باشد")
+
+    rows = []
+    for day, items in data.items():
+        if day not in DELIVERY_DAY_FA:
+            raise ValueError(f"روز نامعتبر: {day}")
+        if not isinstance(items, list):
+            raise ValueError(f"منوی {day} باید لیست باشد")
+
+        seen = set()
+        for position, item in enumerate(items):
+            key = str(item.get("key", "")) if isinstance(item, dict) else ""
+            if not key or not key.replace("_", "").isalnum() or not key.isascii() or len(key) > 40:
+                raise ValueError(f"{day}: کلید نامعتبر در ردیف {position + 1}")
+            if key in seen:
+                raise ValueError(f"{day}: کلید تکراری {key}")
+            seen.add(key)
+
+            name = item.get("name")
+            price = item.get("price")
+            capacity = item.get("daily_capacity", MAX_DAILY)
+            if not isinstance(name, str) or not name.strip():
+                raise ValueError(f"{day}/{key}: نام خالی است")
+            if isinstance(price, bool) or not isinstance(price, (int, float)) or price < 0:
+                raise ValueError(f"{day}/{key}: قیمت نامعتبر")
+            if isinstance(capacity, bool) or not isinstance(capacity, int) or capacity < 0:
+                raise ValueError(f"{day}/{key}: ظرفیت نامعتبر")
+
+            rows.append((day, key, name, price, capacity, position))
+
+    return rows
+
+
+def replace_menu_catalog(rows):
+    # جایگزینی کامل منو در یک تراکنش ، بعد تعویض ساختار حافظه و کش کیبورد
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM menu_items")
+        conn.executemany("""
+            INSERT INTO menu_items
+            (delivery_day, food_key, name, price, daily_capacity, position)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
-    if target == "monday":
-        return {
-            "farani": {"name": "🍮 فرنی", "price": 3.5},
-            "salad": {"name": "🥗 پروتینو (سالاد ماکارونی) ", "price": 5},
-            "ash": {"name": "🍛 قیمه با برنج", "price": 8.5},
-            "ghorme": {"name": "🍛🌿 قرمه سبزی با برنج", "price": 8.5},
-            "gheyme_to_go": {"name": "🥡 قیمه (To Go)\u200f", "price": 4},
-            "ghorme_to_go": {"name": "🥡 قرمه (To Go)\u200f", "price": 4},
-        }
+    load_menu_catalog()
+    invalidate_day_keyboards()
 
-    if target == "thursday":
-        return {
-            "farani": {"name": "🍮 فرنی", "price": 3.5},
-            "salad": {"name": "🥗 پروتینو (سالاد ماکارونی)", "price": 5},
-            "ash": {"name": "🍛 قیمه با برنج", "price": 8.5},
-            "zereshk": {"name": "🍛🌿 قرمه سبزی با برنج", "price": 8.5},
-            "gheyme_to_go": {"name": "🥡 قیمه (To Go)\u200f", "price": 4},
-            "ghorme_to_go": {"name": "🥡 قرمه (To Go)\u200f", "price": 4},
-        }
 
-    return {}
+def menu_catalog_json():
+    return json.dumps({
+        day: [
+            {"key": key, "name": f["name"], "price": f["price"], "daily_capacity": f["daily_capacity"]}
+            for key, f in foods.items()
+        ]
+        for day, foods in get_menu_catalog().items()
+    }, ensure_ascii=False, indent=2)
+
+
+def handle_menu_upload(update: Update, context: CallbackContext):
+    uid = update.effective_user.id
+    st = user_state.get(uid)
+    if uid != ADMIN_CHAT_ID or not st or st.get("step") != "menu_upload":
+        return
+
+    document = update.message.document
+    if document.file_size and document.file_size > MENU_MAX_UPLOAD_BYTES:
+        update.message.reply_text("❌ فایل خیلی بزرگ است")
+        return
+
+    try:
+        data = json.loads(bytes(document.get_file().download_as_bytearray()).decode("utf-8"))
+        rows = parse_menu_catalog(data)
+    except ValueError as e:
+        update.message.reply_text(f"❌ منو ذخیره نشد:\n{e}")
+        return
+
+    replace_menu_catalog(rows)
+    reset_user(uid)
+    update.message.reply_text(f"✅ منو به‌روز شد ({len(rows)} غذا)")
 
 # ---------- KEYBOARDS ----------
-def join_channel_keyboard():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📢 عضویت در کانال", url="https://t.me/Chaschnii")],
-        [InlineKeyboardButton("✅ بررسی عضویت", callback_data="check_join")]
-    ])
+# کیبوردهای ثابت یکبار ساخته می‌شوند
+JOIN_CHANNEL_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📢 عضویت در کانال", url="https://t.me/Chaschnii")],
+    [InlineKeyboardButton("✅ بررسی عضویت", callback_data="check_join")]
+])
+
+PERSISTENT_MENU = ReplyKeyboardMarkup(
+    [["🍽 شروع سفارش"], ["❌ لغو سفارش", "📞 تماس با ما"]],
+    resize_keyboard=True
+)
 
+PICKUP_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📍 تحویل حضوری", callback_data="pickup_yes"),
+        InlineKeyboardButton("❌ لغو سفارش", callback_data="pickup_no")
+    ]
+])
+
+PAYMENT_METHOD_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💳 پرداخت با PayPal", callback_data="pay_paypal")],
+    [InlineKeyboardButton("💵 پرداخت نقدی", callback_data="pay_cash")]
+])
+
+NO_ACTIVE_ORDER_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ فعلاً سفارشی فعال نیست", callback_data="noop")]
+])
+
+ADMIN_PANEL_KEYBOARD = ReplyKeyboardMarkup(
+    [
+        ["📊 ریپورت"],
+        ["📊 گزارش فردا"],
+        ["🎁 مدیریت تخفیف"],
+        ["❌ حذف کد تخفیف"],
+        ["📊 تحلیل"],
+        ["📊 تحلیل رفتار"],
+        ["🧮 بازسازی موجودی", "📈 بازسازی آمار"],
+        ["📣 ارسال پیام"],
+        ["📣 ارسال یادآوری تحویل"],
+        ["📤 خروجی داده", "📈 وضعیت سیستم"],
+        ["🗄 آمار SQL"],
+        ["🍽 ویرایش منو", "⏰ ظرفیت بازه‌ها"],
+        ["⚠️ پیام اضطراری", "🟢 حذف پیام اضطراری"],
+        ["🔵 فعال‌کردن تست", "⚪ غیرفعال‌کردن تست"]
+    ],
+    resize_keyboard=True
+)
 
 
-def persistent_menu():
-    return ReplyKeyboardMarkup(
-        [["🍽 شروع سفارش"], ["❌ لغو سفارش", "📞 تماس با ما"]],
-        resize_keyboard=True
-    )
+# ---------- KEYBOARD CACHE ----------
+# کیبوردهای وابسته به موجودی/ظرفیت برای هر روز تحویل نگه داشته می‌شوند
+# و فقط وقتی سفارشی از همان روز تغییر وضعیت دهد دور ریخته می‌شوند
+keyboard_cache = {}         # (kind, delivery_day) → markup
+keyboard_versions = {}      # delivery_day → نسخه ؛ ساخته‌شده‌های قدیمی ذخیره نمی‌شوند
+keyboard_cache_lock = threading.Lock()
+keyboard_cache_stats = {"hits": 0, "builds": 0}
+
+def cached_day_keyboard(kind, delivery_day, build):
+    with keyboard_cache_lock:
+        markup = keyboard_cache.get((kind, delivery_day))
+        if markup is not None:
+            keyboard_cache_stats["hits"] += 1
+            return markup
+        version = keyboard_versions.get(delivery_day, 0)
+
+    markup = build(delivery_day)
+
+    with keyboard_cache_lock:
+        keyboard_cache_stats["builds"] += 1
+        if keyboard_versions.get(delivery_day, 0) == version:
+            keyboard_cache[(kind, delivery_day)] = markup
+    return markup
+
+
+def invalidate_day_keyboards(delivery_day=None):
+    # بعد از commit صدا زده شود ؛ None → همه روزها
+    with keyboard_cache_lock:
+        days = [delivery_day] if delivery_day else {day for _, day in keyboard_cache} | set(keyboard_versions)
+        for day in days:
+            keyboard_versions[day] = keyboard_versions.get(day, 0) + 1
+            keyboard_cache.pop(("food", day), None)
+            keyboard_cache.pop(("slot", day), None)
+
 
 def food_keyboard():
+    target = get_target_delivery_day()
+    day = DELIVERY_DAY_FA.get(target)
+    if not day:
+        return NO_ACTIVE_ORDER_KEYBOARD
+
+    return cached_day_keyboard("food", day, build_food_keyboard)
+
+
+def delivery_slot_keyboard(delivery_day):
+    return cached_day_keyboard("slot", delivery_day, build_delivery_slot_keyboard)
+
+
+def build_food_keyboard(day):
     foods = get_foods_for_target_day()
     buttons = []
 
-    # ✅ اینجا باشه (فقط یکبار)
-    target = get_target_delivery_day()
-
-    if target == "monday":
-        day = "دوشنبه"
-    elif target == "thursday":
-        day = "پنج‌شنبه"
-    else:
-        day = None
-    if not day:
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("❌ فعلاً سفارشی فعال نیست", callback_data="noop")]
-        ])    
+    # یک کوئری برای موجودی همه غذاهای این روز
+    sold = dict(get_conn().execute(
+        "SELECT food_key, qty FROM stock_counters WHERE delivery_day = ?", (day,)
+    ).fetchall())
 
-    # 👇 حالا loop
     for k, f in foods.items():
 
-        remaining = get_remaining_stock(k, day)
+        remaining = max(f["daily_capacity"] - sold.get(k, 0), 0)
 
         # اگر موجودی تموم شده → اصلاً نمایش نده
         if remaining <= 0:
@@ -512,41 +1970,24 @@ def admin_keyboard(order_no):
         ]
     ])
 
-def pickup_keyboard():
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("📍 تحویل حضوری", callback_data="pickup_yes"),
-            InlineKeyboardButton("❌ لغو سفارش", callback_data="pickup_no")
-        ]
-    ])
-
-
-def payment_method_keyboard():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("💳 پرداخت با PayPal", callback_data="pay_paypal")],
-        [InlineKeyboardButton("💵 پرداخت نقدی", callback_data="pay_cash")]
-    ])
-
-
-def delivery_slot_keyboard(delivery_day):
+def build_delivery_slot_keyboard(delivery_day):
+    conn = get_conn()
+    cur = conn.cursor()
     buttons = []
 
-    hour = START_HOUR
-    minute = 0
-
-    while hour < END_HOUR:
-        start = f"{hour:02d}:{minute:02d}"
-
-        minute += 30
-        if minute == 60:
-            hour += 1
-            minute = 0
+    # یک کوئری برای همه بازه‌های این روز
+    cur.execute("""
+        SELECT slot, booked, capacity FROM slot_capacity
+        WHERE delivery_day = ?
+    """, (delivery_day,))
+    usage = {slot: (booked, capacity) for slot, booked, capacity in cur.fetchall()}
 
-        end = f"{hour:02d}:{minute:02d}"
+    for start, end in get_delivery_slots():
         slot = f"{start} – {end}"
 
-        # ⛔ محدودیت ظرفیت (۳ سفارش)
-        if get_slot_count(delivery_day, slot) >= 3:
+        # ⛔ محدودیت ظرفیت بازه
+        booked, capacity = usage.get(slot, (0, SLOT_CAPACITY))
+        if booked >= capacity:
             continue
 
         buttons.append([
@@ -562,1603 +2003,2935 @@ def delivery_slot_keyboard(delivery_day):
         ])
 
     return InlineKeyboardMarkup(buttons)
-# ---------- COMMANDS ----------
-def send_welcome(bot, chat_id, is_admin=False):
-    bot.send_message(
-        chat_id,
-    "👋 خوش آمدید به ربات تهیه غذا در هانوفر!\n\n"
+# ---------- SALES REPORT (PAGINATED) ----------
+REPORT_PAGE_SIZE = 10
+REPORT_DAYS = ["all", "monday", "thursday"]
+REPORT_STATUSES = ["all", "pending", "approved", "canceled", "expired"]
+REPORT_RANGES = [0, 1, 7, 30]          # روز؛ 0 = همه
+
+def _next_option(options, current):
+    return options[(options.index(current) + 1) % len(options)]
+
+
+def build_report_page(day="all", status="all", days=0, direction="f", cursor=0):
+    # keyset روی (created_at, rowid) ؛ cursor = rowid سفارش مرزی
+    # direction f = صفحه اول ، n = قدیمی‌تر از cursor ، p = جدیدتر از cursor
+    conn = get_conn()
+    cur = conn.cursor()
+
+    where = []
+    params = []
+
+    if day != "all":
+        where.append("delivery_day = ?")
+        params.append(DELIVERY_DAY_FA[day])
+
+    if status != "all":
+        where.append("status = ?")
+        params.append(status)
+
+    if days:
+        since = (datetime.now(TIMEZONE) - timedelta(days=days)).strftime("%Y-%m-%d %H:%M")
+        where.append("created_at >= ?")
+        params.append(since)
+
+    boundary = "(SELECT created_at, rowid FROM order_headers WHERE rowid = ?)"
+    if direction == "n" and cursor:
+        where.append(f"(created_at, rowid) < {boundary}")
+        params.append(cursor)
+    elif direction == "p":
+        where.append(f"(created_at, rowid) > {boundary}")
+        params.append(cursor)
+
+    order = "ASC" if direction == "p" else "DESC"
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+
+    cur.execute(f"""
+        SELECT rowid, order_no, user_id, payment_method, total, created_at, status
+        FROM order_headers
+        {where_sql}
+        ORDER BY created_at {order}, rowid {order}
+        LIMIT ?
+    """, params + [REPORT_PAGE_SIZE + 1])
+    rows = cur.fetchmany(REPORT_PAGE_SIZE + 1)
+
+    has_more = len(rows) > REPORT_PAGE_SIZE
+    rows = rows[:REPORT_PAGE_SIZE]
+
+    if direction == "p":
+        rows.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = direction == "n" and bool(cursor), has_more
+
+    items = {}
+    if rows:
+        order_nos = [r[1] for r in rows]
+        cur.execute(f"""
+            SELECT order_no, food_name, qty, cutlery_qty
+            FROM order_items
+            WHERE order_no IN ({','.join('?' * len(order_nos))})
+            ORDER BY id
+        """, order_nos)
+        for order_no, food, qty, cutlery in cur.fetchall():
+            items.setdefault(order_no, []).append((food, qty, cutlery or 0))
+
+    filters_text = (
+        f"📅 روز: {DELIVERY_DAY_FA.get(day, 'همه')} | "
+        f"📦 وضعیت: {status if status != 'all' else 'همه'} | "
+        f"🗓 بازه: {f'{days} روز اخیر' if days else 'همه'}"
+    )
 
-    "🍽 سیستم سفارش‌دهی ما به‌صورت *پیش‌سفارش* انجام می‌شود.\n\n"
+    if not rows:
+        report = f"📊 گزارش فروش:\n{filters_text}\n\nهیچ سفارشی پیدا نشد."
+    else:
+        report = f"📊 گزارش فروش:\n{filters_text}\n\n"
+        for _, order_no, user_id, payment, total, created_at, st_status in rows:
+            order_items = items.get(order_no, [])
+            foods = "، ".join(f"{food} × {qty}" for food, qty, _ in order_items)
+            cutlery = sum(c for _, _, c in order_items)
+            report += (
+                f"📌 سفارش: {order_no}\n"
+                f"👤 کاربر: {user_id}\n"
+                f"🍽 غذا: {foods}\n"
+                f"🥄 قاشق/چنگال: {cutlery}\n"
+                f"💳 پرداخت: {payment}\n"
+                f"💶 مبلغ: €{total}\n"
+                f"📅 زمان: {created_at}\n"
+                f"📦 وضعیت: {st_status}\n"
+                "---------------------------\n"
+            )
 
-    "🚚 تحویل غذا فقط در روزهای:\n"
-    "• دوشنبه\n"
-    "• پنج‌شنبه\n\n"
+    # محدودیت ۴۰۹۶ کاراکتر تلگرام
+    if len(report) > 4000:
+        report = report[:4000] + "\n…"
 
-    "🗓 ثبت سفارش:\n"
-    "• سه‌شنبه و چهارشنبه → برای تحویل پنج‌شنبه\n"
-    "• جمعه، شنبه و یکشنبه → برای تحویل دوشنبه\n\n"
+    def cb(d, c, day=day, status=status, days=days):
+        return f"rpt_{d}_{c}_{day}_{status}_{days}"
 
-    "⏰ آخرین زمان ثبت سفارش:\n"
-    "روز قبل از تحویل تا ساعت 18\n\n"
+    buttons = [
+        [
+            InlineKeyboardButton(
+                f"📅 {DELIVERY_DAY_FA.get(day, 'همه روزها')}",
+                callback_data=cb("f", 0, day=_next_option(REPORT_DAYS, day))
+            ),
+            InlineKeyboardButton(
+                f"📦 {status if status != 'all' else 'همه وضعیت‌ها'}",
+                callback_data=cb("f", 0, status=_next_option(REPORT_STATUSES, status))
+            ),
+            InlineKeyboardButton(
+                f"🗓 {f'{days} روز' if days else 'همه زمان‌ها'}",
+                callback_data=cb("f", 0, days=_next_option(REPORT_RANGES, days))
+            ),
+        ]
+    ]
+
+    nav = []
+    if rows and has_newer:
+        nav.append(InlineKeyboardButton("⬅️ جدیدتر", callback_data=cb("p", rows[0][0])))
+    if rows and has_older:
+        nav.append(InlineKeyboardButton("قدیمی‌تر ➡️", callback_data=cb("n", rows[-1][0])))
+    if nav:
+        buttons.append(nav)
+
+    return report, InlineKeyboardMarkup(buttons)
+
+
+# ---------- FUNNEL ANALYTICS ----------
+FUNNEL_STEPS = [
+    ("start", "🚪 ورود به ربات"),
+    ("start_order", "🍽 شروع سفارش"),
+    ("select_food", "🥗 انتخاب غذا"),
+    ("order_created", "🧾 ثبت سفارش"),
+    ("order_approved", "✅ تأیید سفارش"),
+]
+FUNNEL_WINDOWS = [24, 24 * 7, 24 * 30, 0]      # ساعت؛ 0 = همه
 
-    "🚗 محدوده ارسال: 30163 + برخی خیابان‌های 30165\n"
-    "🎒 اگر خارج از محدوده باشید، امکان تحویل حضوری نیز وجود دارد.\n\n"
+def _window_label(hours):
+    if not hours:
+        return "همه زمان‌ها"
+    if hours < 48:
+        return f"{hours} ساعت"
+    return f"{hours // 24} روز"
 
-    "🙏 لطفاً سفارش خود را از قبل ثبت فرمایید.\n"
-    "برای شروع، از دکمه‌های زیر استفاده کنید:",
-        reply_markup=persistent_menu()
-    )
 
-    if is_admin:
-        status = "🔵 تست فعال است" if TEST_MODE else "⚪ حالت واقعی فعال است"
-        bot.send_message(
-            chat_id,
-            f"⚙️ پنل مدیریت\n{status}",
-            reply_markup=ReplyKeyboardMarkup(
-                [
-                     ["📊 ریپورت"],
-                     ["📊 گزارش فردا"],
-                     ["🎁 مدیریت تخفیف"],
-                     ["❌ حذف کد تخفیف"],
-                     ["📊 تحلیل"],
-                     ["📊 تحلیل رفتار"],
-                     ["📣 ارسال پیام"],
-                     ["📣 ارسال یادآوری تحویل"],
-                     ["⚠️ پیام اضطراری", "🟢 حذف پیام اضطراری"],
-                     ["🔵 فعال‌کردن تست", "⚪ غیرفعال‌کردن تست"]
-                ],
-                resize_keyboard=True
-            )
-        )
+def get_action_counts(hours):
+    # فقط از log_counters (ایندکس روی hour) ؛ بدون اسکن جدول logs
+    conn = get_conn()
+    cur = conn.cursor()
 
-def start(update: Update, context: CallbackContext):
-    uid = update.effective_user.id
+    if hours:
+        since = (datetime.now(TIMEZONE) - timedelta(hours=hours)).strftime("%Y-%m-%d %H")
+        cur.execute("""
+            SELECT action, SUM(count) FROM log_counters
+            WHERE hour >= ?
+            GROUP BY action
+        """, (since,))
+    else:
+        cur.execute("SELECT action, SUM(count) FROM log_counters GROUP BY action")
 
-    # ذخیره کاربر
-    cur.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (uid,))
-    conn.commit()
+    return dict(cur.fetchall())
 
-    # لاگ ورود
-    cur.execute(
-        "INSERT INTO logs (user_id, action, created_at) VALUES (?, ?, ?)",
-        (uid, "start", datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"))
-    )
-    conn.commit()
 
-    if not is_user_member(context.bot, uid):
-        update.message.reply_text(
-            "📢 برای استفاده از ربات، ابتدا عضو کانال ما شوید 🌱\n\n"
-            "👇 بعد از عضویت، روی «بررسی عضویت» بزنید",
-            reply_markup=join_channel_keyboard()
-        )
-        return
+def build_funnel_report(hours):
+    # رویدادهای داخل صف هم در گزارش باشند
+    flush_logs()
+    counts = get_action_counts(hours)
 
-    send_welcome(
-        context.bot,
-        uid,
-        uid == ADMIN_CHAT_ID
+    msg = f"📊 قیف تبدیل ({_window_label(hours)}):\n\n"
+
+    first = counts.get(FUNNEL_STEPS[0][0], 0)
+    previous = None
+    for action, label in FUNNEL_STEPS:
+        count = counts.get(action, 0)
+        msg += f"{label}: {count}"
+        if previous:
+            msg += f" | {round(count * 100 / previous, 1)}٪ از مرحله قبل"
+        if first and action != FUNNEL_STEPS[0][0]:
+            msg += f" | {round(count * 100 / first, 1)}٪ از ورود"
+        msg += "\n"
+        previous = count
+
+    msg += "\n📋 همه رویدادها:\n"
+    for action, count in sorted(counts.items(), key=lambda x: -x[1]):
+        msg += f"{action} → {count}\n"
+
+    msg += (
+        f"\n📝 صف لاگ: {log_queue.qsize()} در انتظار | "
+        f"{log_stats['written']} نوشته‌شده | {log_stats['dropped']} ازدست‌رفته"
     )
-    
-    # ⚙️ پنل ادمین
-    if update.effective_user.id == ADMIN_CHAT_ID:
-        status = "🔵 تست فعال است" if TEST_MODE else "⚪ حالت واقعی فعال است"
 
-        update.message.reply_text(
-            f"⚙️ پنل مدیریت\n{status}",
-            reply_markup=ReplyKeyboardMarkup(
-                [
-                     ["📊 ریپورت"],
-                     ["📊 گزارش فردا"],
-                     ["🎁 مدیریت تخفیف"],
-                     ["❌ حذف کد تخفیف"],
-                     ["📊 تحلیل"],
-                     ["📊 تحلیل رفتار"],
-                     ["📣 ارسال پیام"],
-                     ["📣 ارسال یادآوری تحویل"],
-                     ["⚠️ پیام اضطراری", "🟢 حذف پیام اضطراری"],
-                     ["🔵 فعال‌کردن تست", "⚪ غیرفعال‌کردن تست"]
-                ],
-                resize_keyboard=True
-            )
+    markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton(
+            ("• " if h == hours else "") + _window_label(h),
+            callback_data=f"fnl_{h}"
         )
+        for h in FUNNEL_WINDOWS
+    ]])
+    return msg, markup
+
+
+# ---------- EXPORT (CSV / JSONL) ----------
+EXPORT_COLUMNS = {
+    "orders": [
+        "order_no", "user_id", "status", "payment_method", "total", "created_at",
+        "payment_checked_at", "delivery_day", "delivery_slot", "fullname", "phone",
+        "address", "postcode", "food_key", "food_name", "qty", "cutlery_qty", "price"
+    ],
+    "logs": ["id", "user_id", "action", "created_at"],
+}
+EXPORT_FETCH_SIZE = 500
+EXPORT_STATUSES = REPORT_STATUSES[1:]    # بدون "all"
+EXPORT_USAGE = (
+    "❗ استفاده:\n"
+    "/export orders csv|jsonl [از 2024-01-01] [تا 2024-02-01] [status]\n"
+    "/export logs csv|jsonl [از 2024-01-01] [تا 2024-02-01] [action]\n\n"
+    f"status: {' | '.join(EXPORT_STATUSES)}\n"
+    "action: نام رویداد لاگ (مثلاً start یا select_food)"
+)
 
+def _export_queries(dataset, date_from, date_to, status=None, action=None):
+    # (کوئری داده، کوئری fingerprint، پارامترها) ؛ فیلترها روی ستون‌های ایندکس‌دار
+    # status فقط برای orders ، action فقط برای logs
+    if (dataset == "orders" and action) or (dataset == "logs" and status):
+        raise ValueError(f"{dataset}: فیلتر نامعتبر")
+
+    where = []
+    params = []
+
+    if dataset == "orders":
+        if date_from:
+            where.append("h.created_at >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("h.created_at < ?")
+            params.append(date_to)
+        if status:
+            where.append("h.status = ?")
+            params.append(status)
+
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+        data_sql = f"""
+            SELECT h.order_no, h.user_id, h.status, h.payment_method, h.total, h.created_at,
+                   h.payment_checked_at, h.delivery_day, h.delivery_slot, h.fullname, h.phone,
+                   h.address, h.postcode, i.food_key, i.food_name, i.qty, i.cutlery_qty, i.price
+            FROM order_headers h
+            JOIN order_items i ON i.order_no = h.order_no
+            {where_sql}
+            ORDER BY h.rowid, i.id
+        """
+        fingerprint_sql = f"""
+            SELECT COUNT(*), MAX(h.rowid), MAX(h.updated_at)
+            FROM order_headers h
+            {where_sql}
+        """
+        return data_sql, fingerprint_sql, params
+
+    if date_from:
+        where.append("created_at >= ?")
+        params.append(date_from)
+    if date_to:
+        where.append("created_at < ?")
+        params.append(date_to)
+    if action:
+        where.append("action = ?")
+        params.append(action)
+
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+    data_sql = f"""
+        SELECT id, user_id, action, created_at
+        FROM logs
+        {where_sql}
+        ORDER BY id
+    """
+    fingerprint_sql = f"SELECT COUNT(*), MAX(id) FROM logs {where_sql}"
+    return data_sql, fingerprint_sql, params
+
+
+def _write_export(cur, path, dataset, fmt):
+    columns = EXPORT_COLUMNS[dataset]
+    rows_written = 0
+
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer:
+            writer.writerow(columns)
+
+        while True:
+            rows = cur.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
 
-# ---------- CALLBACK HANDLER ----------
-def callbacks(update: Update, context: CallbackContext):
-    expire_pending_orders()
-    q = update.callback_query
-    uid = q.from_user.id
-    q.answer()
+            for row in rows:
+                if writer:
+                    writer.writerow(row)
+                else:
+                    f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                    f.write("\n")
+            rows_written += len(rows)
 
-    st = user_state.get(uid)
+    return rows_written
 
-    # ---------------- FOOD SELECTION ----------------
-    if q.data.startswith("food_"):
-        key = q.data.replace("food_", "")
-        foods = get_foods_for_target_day()   # ✅ این خط اصلاح شد
 
-        cur.execute(
-            "INSERT INTO logs (user_id, action, created_at) VALUES (?, ?, ?)",
-            (uid, "select_food", datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"))
-        )
-        conn.commit()
-        
-        if key not in foods:
-            q.answer("این غذا در منوی امروز نیست", show_alert=True)
-            return
+def export_data(bot, chat_id, dataset, fmt, date_from=None, date_to=None, status=None, action=None):
+    if dataset == "logs":
+        flush_logs()
 
-        f = foods[key]
-        if not user_state.get(uid):
-            user_state[uid] = {
-                "step": "qty",
-                "items": []
-            }
-
-        user_state[uid]["current_item"] = {
-            "food_key": key,
-            "food_name": f["name"],
-            "price": f["price"]
-        }
+    conn = get_conn()
+    cur = conn.cursor()
+
+    data_sql, fingerprint_sql, params = _export_queries(dataset, date_from, date_to, status, action)
+    cache_key = f"{dataset}|{fmt}|{date_from or ''}|{date_to or ''}|status={status or ''}|action={action or ''}"
+    caption = (
+        f"📤 {dataset} ({fmt})\n"
+        f"🗓 {date_from or '…'} → {date_to or '…'}"
+        + (f"\n📦 {status}" if status else "")
+        + (f"\n🔎 {action}" if action else "")
+    )
 
-        user_state[uid]["step"] = "qty"
+    cur.execute(fingerprint_sql, params)
+    fingerprint = json.dumps(cur.fetchone())
 
-        q.edit_message_text(
-            f"{f['name']} انتخاب شد.\n"
-            "📦 لطفاً تعداد موردنظر را وارد کنید:"
-        )
+    # داده تغییر نکرده → همان فایل قبلی بدون آپلود دوباره
+    cur.execute(
+        "SELECT file_id FROM export_cache WHERE cache_key = ? AND fingerprint = ?",
+        (cache_key, fingerprint)
+    )
+    cached = cur.fetchone()
+    if cached:
+        bot.send_document(chat_id, document=cached[0], caption=caption)
         return
-   
-    if q.data == "check_join":
-        if is_user_member(context.bot, uid):
-            q.edit_message_text(
-                "✅ عضویت شما تأیید شد 🌱\n\n"
-                "خوش آمدید 👇"
-            )
 
-        # ⬅️ این خط کلیدی است
-            send_welcome(
-                context.bot,
-                uid,
-                uid == ADMIN_CHAT_ID
-            )
+    tmp = tempfile.NamedTemporaryFile(suffix=f".{fmt}.gz", delete=False)
+    tmp.close()
 
-        else:
-            q.answer(show_alert=True)
-            context.bot.send_message(
-                uid,
-                "❌ هنوز عضو کانال نیستید.\n\n"
-                "📢 لطفاً ابتدا عضو کانال شوید 👇",
-                reply_markup=join_channel_keyboard()
+    try:
+        cur.execute(data_sql, params)
+        count = _write_export(cur, tmp.name, dataset, fmt)
+
+        with open(tmp.name, "rb") as f:
+            message = bot.send_document(
+                chat_id,
+                document=f,
+                filename=f"{dataset}-{datetime.now(TIMEZONE).strftime('%Y%m%d-%H%M')}.{fmt}.gz",
+                caption=f"{caption}\n🔢 {count} ردیف"
             )
+    finally:
+        os.remove(tmp.name)
+
+    cur.execute("""
+        INSERT OR REPLACE INTO export_cache (cache_key, fingerprint, file_id, created_at)
+        VALUES (?, ?, ?, ?)
+    """, (
+        cache_key,
+        fingerprint,
+        message.document.file_id,
+        datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M")
+    ))
+    conn.commit()
+
+
+def export_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📦 سفارش‌ها CSV (۷ روز)", callback_data="exp_orders_csv_7")],
+        [InlineKeyboardButton("📦 سفارش‌ها CSV (۳۰ روز)", callback_data="exp_orders_csv_30")],
+        [InlineKeyboardButton("📦 سفارش‌ها JSONL (همه)", callback_data="exp_orders_jsonl_0")],
+        [InlineKeyboardButton("📝 لاگ‌ها CSV (۷ روز)", callback_data="exp_logs_csv_7")],
+        [InlineKeyboardButton("📝 لاگ‌ها JSONL (همه)", callback_data="exp_logs_jsonl_0")],
+    ])
+
+
+def export_command(update: Update, context: CallbackContext):
+    # /export orders csv|jsonl [از YYYY-MM-DD] [تا YYYY-MM-DD] [status]
+    # /export logs csv|jsonl [از YYYY-MM-DD] [تا YYYY-MM-DD] [action]
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        return
+
+    set_sql_route("export")
+    args = context.args or []
+    dataset = args[0] if len(args) > 0 else "orders"
+    fmt = args[1] if len(args) > 1 else "csv"
+    filter_value = args[4] if len(args) > 4 else None
+
+    if (
+        dataset not in EXPORT_COLUMNS
+        or fmt not in ("csv", "jsonl")
+        or (dataset == "orders" and filter_value and filter_value not in EXPORT_STATUSES)
+    ):
+        update.message.reply_text(EXPORT_USAGE)
         return
-    
-    if q.data == "no_discount":
-        st = user_state.get(uid)
 
-        if not st:
-            q.answer("خطا", show_alert=True)
+    dates = []
+    for value in args[2:4]:
+        try:
+            dates.append(datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d"))
+        except ValueError:
+            update.message.reply_text(f"❗ تاریخ نامعتبر: {value}")
             return
 
-        st["discount"] = 0
-        st["discount_code"] = None
+    date_from = dates[0] if len(dates) > 0 else None
+    date_to = dates[1] if len(dates) > 1 else None
+    status = filter_value if dataset == "orders" else None
+    action = filter_value if dataset == "logs" else None
 
-        total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
-        total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
+    update.message.reply_text("⏳ فایل خروجی در حال آماده شدن است...")
+    run_admin_job(
+        context.bot, update.effective_chat.id, "export",
+        export_data, context.bot, update.effective_chat.id, dataset, fmt, date_from, date_to, status, action
+    )
 
-        st["discount_amount"] = 0
-        st["total"] = round(total, 2)
 
-        q.edit_message_text("❌ بدون کد تخفیف ادامه داده شد")
+# ---------- TELEGRAM RATE LIMIT ----------
+TELEGRAM_GLOBAL_RATE = 25          # پیام در ثانیه (سقف تلگرام حدود ۳۰ است)
+SEND_MAX_ATTEMPTS = 5
 
-        send_payment_message(context, uid, st)
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+telegram_limiter = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+
+
+# ---------- ANTI-SPAM ----------
+SPAM_WINDOW = 4                 # بازه زمانی (ثانیه)
+SPAM_LIMIT = 5                  # حداکثر پیام مجاز در این بازه
+DISCOUNT_GUESS_LIMIT = 5        # حداکثر امتحان کد تخفیف
+DISCOUNT_GUESS_WINDOW = 3600    # در این بازه (ثانیه)
+RATE_LIMIT_MAX_USERS = 5000     # حداکثر کاربر در حافظه
+
+class UserRateLimiter:
+    # یک TokenBucket برای هر کاربر ؛ حافظه محدود (LRU) و باکت‌های پرشده دور ریخته می‌شوند
+    def __init__(self, limit, window, max_users=RATE_LIMIT_MAX_USERS):
+        self.rate = limit / window
+        self.capacity = limit
+        self.idle_seconds = window
+        self.max_users = max_users
+        self.buckets = OrderedDict()    # uid → [bucket, رد پشت‌سرهم]
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def _entry(self, uid):
+        # زیر self.lock صدا زده می‌شود
+        entry = self.buckets.get(uid)
+        if entry is None or time.monotonic() - entry[0].updated > self.idle_seconds:
+            entry = [TokenBucket(self.rate, self.capacity), 0]
+            self.buckets[uid] = entry
+            if len(self.buckets) > self.max_users:
+                self.buckets.popitem(last=False)
+        self.buckets.move_to_end(uid)
+        return entry
+
+    def exhausted(self, uid):
+        # فقط نگاه می‌کند ، توکنی مصرف نمی‌شود
+        with self.lock:
+            bucket = self._entry(uid)[0]
+            with bucket.lock:
+                bucket._refill(time.monotonic())
+                if bucket.tokens >= 1:
+                    return False
+            self.dropped += 1
+            return True
+
+    def check(self, uid):
+        # 0 → مجاز ، n → n امین رد پشت‌سرهم
+        with self.lock:
+            entry = self._entry(uid)
+
+            if entry[0].try_acquire():
+                entry[1] = 0
+                return 0
+
+            entry[1] += 1
+            self.dropped += 1
+            return entry[1]
+
+
+update_limiter = UserRateLimiter(SPAM_LIMIT, SPAM_WINDOW)
+discount_limiter = UserRateLimiter(DISCOUNT_GUESS_LIMIT, DISCOUNT_GUESS_WINDOW)
+
+
+def rate_limit_gate(update: Update, context: CallbackContext):
+    # گروه -1 ؛ قبل از هر هندلر و هر کار دیتابیسی
+    user = update.effective_user
+    if not user or user.id == ADMIN_CHAT_ID:
+        return
+
+    denied = update_limiter.check(user.id)
+    if not denied:
+        return
+
+    # فقط بار اول هشدار ؛ بقیه بی‌صدا دور ریخته می‌شوند
+    if denied == 1:
+        try:
+            if update.callback_query:
+                update.callback_query.answer("⚠️ لطفاً آهسته‌تر 🙏")
+            elif update.message:
+                update.message.reply_text("⚠️ لطفاً پیام‌ها را پشت‌سرهم ارسال نکنید 🙏")
+        except Exception:
+            pass
+
+    raise DispatcherHandlerStop()
+
+
+# ---------- OUTBOX ----------
+# همه پیام‌های خروجی غیرتعاملی از این صف می‌روند تا هندلر منتظر HTTP نماند
+#   urgent → پیام‌های مشتری (رسید، تأیید، لغو، انقضا)
+#   bulk   → اطلاع‌رسانی ادمین ، پیام همگانی ، یادآوری
+# urgent همیشه جلوتر است ؛ پیام‌های یک چت به ترتیب و یکی‌یکی ارسال می‌شوند
+OUTBOX_PRIORITIES = ("urgent", "bulk")
+OUTBOX_WORKERS = 4
+OUTBOX_CHAT_RATE = 1                # پیام در ثانیه برای هر چت
+OUTBOX_CHAT_BURST = 3
+OUTBOX_MAX_CHATS = 5000
+OUTBOX_COALESCE_SECONDS = 0.05      # پیام coalesce این مدت صبر می‌کند تا پیام بعدی همان چت برسد
+OUTBOX_IDLE_WAIT = 1
+TELEGRAM_MAX_TEXT = 4096
+
+class Outbox:
+    def __init__(self, workers):
+        self.workers = workers
+        self.queues = {priority: deque() for priority in OUTBOX_PRIORITIES}
+        self.cond = threading.Condition()
+        self.busy = set()               # چت‌هایی که پیامشان در حال ارسال است
+        self.chat_buckets = OrderedDict()
+        self.paused_until = 0           # RetryAfter کل ربات را متوقف می‌کند
+        self.threads = []
+        self.stats = {"sent": 0, "blocked": 0, "failed": 0, "coalesced": 0, "retry_after": 0}
+
+    def send(self, bot, chat_id, text, priority="urgent", coalesce=False, **kwargs):
+        # Future با نتیجه sent / blocked / failed
+        future = Future()
+        msg = {
+            "bot": bot,
+            "chat_id": chat_id,
+            "text": text,
+            "kwargs": kwargs,
+            "futures": [future],
+            "coalesce": coalesce,
+            "ready_at": time.monotonic() + (OUTBOX_COALESCE_SECONDS if coalesce else 0),
+            "attempt": 0
+        }
+
+        with self.cond:
+            if not self.threads:
+                self._start()
+            self.queues[priority].append(msg)
+            self.cond.notify()
+        return future
+
+    def _start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+            if len(self.chat_buckets) > OUTBOX_MAX_CHATS:
+                self.chat_buckets.popitem(last=False)
+        self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _can_merge(self, first, second):
+        return (
+            first["coalesce"] and second["coalesce"]
+            and not first["kwargs"]
+            and first["bot"] is second["bot"]
+            and len(first["text"]) + len(second["text"]) + 2 <= TELEGRAM_MAX_TEXT
+        )
+
+    def _take(self, now):
+        # اولین پیام قابل ارسال ؛ None و زمان انتظار اگر چیزی آماده نیست
+        wait = None
+        for priority in OUTBOX_PRIORITIES:
+            q = self.queues[priority]
+            skipped = set()
+
+            for i, msg in enumerate(q):
+                chat_id = msg["chat_id"]
+                if chat_id in skipped or chat_id in self.busy:
+                    skipped.add(chat_id)
+                    continue
+
+                if msg["ready_at"] > now:
+                    skipped.add(chat_id)
+                    wait = min(wait or OUTBOX_IDLE_WAIT, msg["ready_at"] - now)
+                    continue
+
+                if not self._chat_bucket(chat_id).try_acquire():
+                    skipped.add(chat_id)
+                    wait = min(wait or OUTBOX_IDLE_WAIT, 1 / OUTBOX_CHAT_RATE)
+                    continue
+
+                del q[i]
+
+                # پیام‌های پشت‌سرهم همین چت در یک پیام
+                rest = [m for m in q if m["chat_id"] == chat_id]
+                for nxt in rest:
+                    if not self._can_merge(msg, nxt):
+                        break
+                    q.remove(nxt)
+                    msg = dict(
+                        msg,
+                        text=msg["text"] + "\n\n" + nxt["text"],
+                        kwargs=nxt["kwargs"],
+                        futures=msg["futures"] + nxt["futures"]
+                    )
+                    self.stats["coalesced"] += 1
+
+                self.busy.add(chat_id)
+                return msg, priority, None
+
+        return None, None, wait
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    if now < self.paused_until:
+                        self.cond.wait(self.paused_until - now)
+                        continue
+
+                    msg, priority, wait = self._take(now)
+                    if msg:
+                        break
+                    self.cond.wait(wait)
+
+            state = self._deliver(msg, priority)
+
+            with self.cond:
+                self.busy.discard(msg["chat_id"])
+                if state:
+                    self.stats[state] += 1
+                self.cond.notify_all()
+
+            if state:
+                for future in msg["futures"]:
+                    future.set_result(state)
+
+    def _deliver(self, msg, priority):
+        # None یعنی دوباره در صف گذاشته شد
+        telegram_limiter.acquire()
+        try:
+            msg["bot"].send_message(msg["chat_id"], msg["text"], **msg["kwargs"])
+            return "sent"
+        except RetryAfter as e:
+            with self.cond:
+                self.stats["retry_after"] += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                self.queues[priority].appendleft(msg)
+            return None
+        except Unauthorized:
+            return "blocked"
+        except BadRequest:
+            return "failed"
+        except NetworkError:
+            msg["attempt"] += 1
+            if msg["attempt"] >= SEND_MAX_ATTEMPTS:
+                return "failed"
+            msg["ready_at"] = time.monotonic() + 2 ** msg["attempt"]
+            with self.cond:
+                self.queues[priority].appendleft(msg)
+            return None
+        except Exception as e:
+            print(f"outbox send to {msg['chat_id']} failed: {e}")
+            return "failed"
+
+    def depth(self):
+        return {priority: len(q) for priority, q in self.queues.items()}
+
+    def drain(self, timeout=10):
+        # هنگام خروج: تا خالی شدن صف صبر می‌کند
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while any(self.queues.values()) or self.busy:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+
+outbox = Outbox(OUTBOX_WORKERS)
+
+
+def send_with_retry(bot, chat_id, text, **kwargs):
+    # نتیجه: sent / blocked / failed
+    return outbox.send(bot, chat_id, text, priority="bulk", **kwargs).result()
+
+
+# ---------- ADMIN JOBS ----------
+# کارهای طولانی ادمین (خروجی، شروع پیام همگانی، بازسازی‌ها) روی thread جدا
+# تا shard ادمین و مشتری‌های هم‌shard پشت آن‌ها منتظر نمانند ؛ هندلر فقط «شروع شد» را جواب می‌دهد
+ADMIN_JOB_WORKERS = 2
+admin_jobs = ThreadPoolExecutor(max_workers=ADMIN_JOB_WORKERS, thread_name_prefix="admin-job")
+
+def run_admin_job(bot, chat_id, name, fn, *args):
+    def job():
+        set_sql_route(name)
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"admin job {name} failed: {e}")
+            try:
+                bot.send_message(chat_id, f"❌ خطا در «{name}»: {e}")
+            except Exception:
+                pass
+        finally:
+            set_sql_route(None)
+
+    return admin_jobs.submit(job)
+
+
+# ---------- BROADCAST ----------
+BROADCAST_WORKERS = 8
+BROADCAST_BATCH = 500
+BROADCAST_PROGRESS_SECONDS = 3
+
+def start_broadcast(bot, admin_chat_id, text):
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        cur.execute("""
+            INSERT INTO broadcasts (text, status, admin_chat_id, created_at)
+            VALUES (?, 'running', ?, ?)
+        """, (text, admin_chat_id, datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M")))
+        broadcast_id = cur.lastrowid
+
+        cur.execute("""
+            INSERT INTO broadcast_recipients (broadcast_id, user_id)
+            SELECT ?, user_id FROM users
+        """, (broadcast_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    message = bot.send_message(admin_chat_id, f"📣 ارسال پیام #{broadcast_id} شروع شد...")
+
+    cur.execute(
+        "UPDATE broadcasts SET progress_message_id = ? WHERE id = ?",
+        (message.message_id, broadcast_id)
+    )
+    conn.commit()
+
+    threading.Thread(target=run_broadcast, args=(bot, broadcast_id), daemon=True).start()
+    return broadcast_id
+
+
+def _deliver_broadcast(bot, broadcast_id, user_id, text):
+    state = send_with_retry(bot, user_id, text)
+
+    # وضعیت هر گیرنده فوراً ذخیره می‌شود تا بعد از کرش از همین‌جا ادامه پیدا کند
+    conn = get_conn()
+    conn.execute("""
+        UPDATE broadcast_recipients SET state = ?
+        WHERE broadcast_id = ? AND user_id = ?
+    """, (state, broadcast_id, user_id))
+
+    # کاربری که ربات را بلاک کرده از لیست حذف می‌شود
+    if state == "blocked":
+        conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+    conn.commit()
+    return state
+
+
+def _mark_broadcast_failed(broadcast_id, user_id):
+    conn = get_conn()
+    try:
+        conn.rollback()
+        conn.execute("""
+            UPDATE broadcast_recipients SET state = 'failed'
+            WHERE broadcast_id = ? AND user_id = ?
+        """, (broadcast_id, user_id))
+        conn.commit()
+    except Exception as e:
+        print(f"broadcast #{broadcast_id}: could not mark {user_id} failed: {e}")
+
+
+def _broadcast_progress_text(broadcast_id, counts, done=False, aborted=False):
+    total = sum(counts.values())
+    finished = total - counts.get("pending", 0)
+    if aborted:
+        title = "⚠️ ارسال پیام متوقف شد"
+    else:
+        title = "✅ ارسال پیام تمام شد" if done else "📣 در حال ارسال پیام"
+
+    return (
+        f"{title} #{broadcast_id}\n\n"
+        f"📊 پیشرفت: {finished}/{total}\n"
+        f"✅ ارسال‌شده: {counts.get('sent', 0)}\n"
+        f"⛔ بلاک‌کرده (حذف شد): {counts.get('blocked', 0)}\n"
+        f"❌ ناموفق: {counts.get('failed', 0)}"
+    )
+
+
+def run_broadcast(bot, broadcast_id):
+    conn = get_conn()
+    cur = conn.cursor()
+
+    cur.execute(
+        "SELECT text, admin_chat_id, progress_message_id FROM broadcasts WHERE id = ?",
+        (broadcast_id,)
+    )
+    text, admin_chat_id, progress_message_id = cur.fetchone()
+
+    cur.execute("""
+        SELECT state, COUNT(*) FROM broadcast_recipients
+        WHERE broadcast_id = ?
+        GROUP BY state
+    """, (broadcast_id,))
+    counts = dict(cur.fetchall())
+    counts.setdefault("pending", 0)
+    counts_lock = threading.Lock()
+    last_progress = 0
+
+    def report(done=False, aborted=False):
+        if not progress_message_id:
+            return
+        try:
+            bot.edit_message_text(
+                _broadcast_progress_text(broadcast_id, counts, done, aborted),
+                chat_id=admin_chat_id,
+                message_id=progress_message_id
+            )
+        except Exception:
+            pass
+
+    def deliver(user_id):
+        try:
+            state = _deliver_broadcast(bot, broadcast_id, user_id, text)
+        except Exception as e:
+            # خطای یک گیرنده کل ارسال را متوقف نمی‌کند
+            print(f"broadcast #{broadcast_id} to {user_id} failed: {e}")
+            state = "failed"
+            _mark_broadcast_failed(broadcast_id, user_id)
+
+        with counts_lock:
+            counts["pending"] -= 1
+            counts[state] = counts.get(state, 0) + 1
+
+    status = "failed"
+    try:
+        with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) as pool:
+            last_user = 0
+            while True:
+                # فقط گیرنده‌های باقی‌مانده (keyset روی user_id)
+                cur.execute("""
+                    SELECT user_id FROM broadcast_recipients
+                    WHERE broadcast_id = ? AND state = 'pending' AND user_id > ?
+                    ORDER BY user_id
+                    LIMIT ?
+                """, (broadcast_id, last_user, BROADCAST_BATCH))
+                batch = [row[0] for row in cur.fetchall()]
+                if not batch:
+                    break
+
+                futures = [pool.submit(deliver, user_id) for user_id in batch]
+                for future in futures:
+                    future.result()
+                    if time.monotonic() - last_progress >= BROADCAST_PROGRESS_SECONDS:
+                        last_progress = time.monotonic()
+                        report()
+
+                last_user = batch[-1]
+        status = "done"
+    except Exception as e:
+        print(f"broadcast #{broadcast_id} stopped: {e}")
+    finally:
+        # failed دیگر خودکار ادامه پیدا نمی‌کند (resume فقط running را برمی‌دارد)
+        try:
+            conn.rollback()
+            cur.execute("UPDATE broadcasts SET status = ? WHERE id = ?", (status, broadcast_id))
+            conn.commit()
+        except Exception as e:
+            print(f"broadcast #{broadcast_id} status update failed: {e}")
+        report(done=True, aborted=status != "done")
+
+
+# ---------- DELIVERY REMINDERS ----------
+REMINDER_CLAIM_LEASE_SECONDS = 15 * 60
+def claim_delivery_reminders(delivery_day, kind="delivery"):
+    # گروه‌بندی در SQL و رزرو اتمیک ؛ دابل‌کلیک چیزی برای ارسال پیدا نمی‌کند
+    # رزروی که بعد از REMINDER_CLAIM_LEASE_SECONDS هنوز sent نشده (کرش وسط ارسال) دوباره برداشته می‌شود
+    conn = get_conn()
+    cur = conn.cursor()
+    now = datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M")
+    claimed_at = int(time.time())
+
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # فقط سفارش‌هایی که هنوز یادآوری نگرفته‌اند در متن می‌آیند (GROUP_CONCAT و SUM مقدار NULL را نادیده می‌گیرند)
+        # r.order_no IS NULL ← بدون رزرو یا رزرو منقضی (شرط LEFT JOIN)
+        cur.execute("""
+            SELECT
+                h.user_id,
+                h.delivery_day,
+                h.delivery_slot,
+                GROUP_CONCAT(DISTINCT CASE WHEN r.order_no IS NULL THEN h.order_no END),
+                GROUP_CONCAT(
+                    CASE WHEN r.order_no IS NULL THEN
+                        '🍽 ' || i.food_name || ' × ' || i.qty || ' | 🥄 ' || COALESCE(i.cutlery_qty, 0)
+                    END,
+                    char(10)
+                ),
+                SUM(CASE WHEN r.order_no IS NULL THEN COALESCE(i.cutlery_qty, 0) ELSE 0 END)
+            FROM order_headers h
+            JOIN order_items i ON i.order_no = h.order_no
+            LEFT JOIN reminders_sent r
+              ON r.order_no = h.order_no AND r.kind = ?
+             AND (r.state = 'sent' OR r.claimed_at >= ?)
+            WHERE h.delivery_day = ?
+              AND h.status = 'approved'
+            GROUP BY h.user_id, h.delivery_day, h.delivery_slot
+        """, (kind, claimed_at - REMINDER_CLAIM_LEASE_SECONDS, delivery_day))
+        groups = cur.fetchall()
+
+        jobs = []
+        skipped = 0
+        for user_id, day, slot, order_nos, foods_text, total_cutlery in groups:
+            if not order_nos:
+                skipped += 1
+                continue
+
+            # داخل BEGIN IMMEDIATE ← همه این‌ها همین حالا رزرو می‌شوند
+            order_nos = order_nos.split(",")
+            cur.executemany("""
+                INSERT INTO reminders_sent (order_no, kind, sent_at, state, claimed_at)
+                VALUES (?, ?, ?, 'claimed', ?)
+                ON CONFLICT (order_no, kind)
+                DO UPDATE SET state = 'claimed', claimed_at = excluded.claimed_at, sent_at = excluded.sent_at
+            """, [(order_no, kind, now, claimed_at) for order_no in order_nos])
+
+            jobs.append((user_id, day, slot, order_nos, foods_text, total_cutlery))
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return jobs, skipped
+
+
+def _deliver_reminder(bot, job, kind):
+    user_id, day, slot, order_nos, foods_text, total_cutlery = job
+
+    msg = (
+        "⏰ یادآوری تحویل غذا\n\n"
+        f"{foods_text}\n"
+        f"🥄 مجموع قاشق/چنگال: {total_cutlery}\n"
+        f"📅 تحویل: فردا ({day})\n"
+        f"⏰ بازه تحویل: {slot}\n\n"
+        "🙏 لطفاً در بازه انتخاب‌شده آماده باشید"
+    )
+    state = send_with_retry(bot, user_id, msg)
+
+    conn = get_conn()
+    if state == "sent":
+        conn.executemany("""
+            UPDATE reminders_sent SET state = 'sent', sent_at = ?
+            WHERE order_no = ? AND kind = ?
+        """, [(datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"), order_no, kind) for order_no in order_nos])
+    else:
+        # ارسال ناموفق → رزرو آزاد شود تا دفعه بعد دوباره تلاش شود
+        conn.executemany(
+            "DELETE FROM reminders_sent WHERE order_no = ? AND kind = ?",
+            [(order_no, kind) for order_no in order_nos]
+        )
+    conn.commit()
+
+    return state
+
+
+def run_delivery_reminders(bot, admin_chat_id, delivery_day, kind="delivery"):
+    try:
+        jobs, skipped = claim_delivery_reminders(delivery_day, kind)
+    except Exception as e:
+        print(f"reminder claim for {delivery_day} failed: {e}")
+        outbox.send(bot, admin_chat_id, f"❌ یادآوری تحویل {delivery_day} شروع نشد: {e}", priority="bulk")
         return
+
+    def deliver(job):
+        try:
+            return _deliver_reminder(bot, job, kind)
+        except Exception as e:
+            # رزرو claimed می‌ماند و بعد از lease در اجرای بعدی دوباره ارسال می‌شود
+            print(f"reminder to {job[0]} failed: {e}")
+            return "failed"
+
+    with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) as pool:
+        states = list(pool.map(deliver, jobs))
+
+    sent = states.count("sent")
+    outbox.send(
+        bot,
+        admin_chat_id,
+        f"📣 یادآوری تحویل {delivery_day}\n\n"
+        f"✅ ارسال‌شده: {sent}\n"
+        f"❌ ناموفق: {len(states) - sent}\n"
+        f"↩️ قبلاً ارسال شده: {skipped}",
+        priority="bulk"
+    )
+
+
+def resume_broadcasts(bot):
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM broadcasts WHERE status = 'running'")
+
+    for (broadcast_id,) in cur.fetchall():
+        print(f"resuming broadcast #{broadcast_id}")
+        threading.Thread(target=run_broadcast, args=(bot, broadcast_id), daemon=True).start()
+
+
+# ---------- COMMANDS ----------
+def send_welcome(bot, chat_id, is_admin=False):
+    bot.send_message(
+        chat_id,
+    "👋 خوش آمدید به ربات تهیه غذا در هانوفر!\n\n"
+
+    "🍽 سیستم سفارش‌دهی ما به‌صورت *پیش‌سفارش* انجام می‌شود.\n\n"
+
+    "🚚 تحویل غذا فقط در روزهای:\n"
+    "• دوشنبه\n"
+    "• پنج‌شنبه\n\n"
+
+    "🗓 ثبت سفارش:\n"
+    "• سه‌شنبه و چهارشنبه → برای تحویل پنج‌شنبه\n"
+    "• جمعه، شنبه و یکشنبه → برای تحویل دوشنبه\n\n"
+
+    "⏰ آخرین زمان ثبت سفارش:\n"
+    "روز قبل از تحویل تا ساعت 18\n\n"
+
+    "🚗 محدوده ارسال: 30163 + برخی خیابان‌های 30165\n"
+    "🎒 اگر خارج از محدوده باشید، امکان تحویل حضوری نیز وجود دارد.\n\n"
+
+    "🙏 لطفاً سفارش خود را از قبل ثبت فرمایید.\n"
+    "برای شروع، از دکمه‌های زیر استفاده کنید:",
+        reply_markup=PERSISTENT_MENU
+    )
+
+    if is_admin:
+        status = "🔵 تست فعال است" if TEST_MODE else "⚪ حالت واقعی فعال است"
+        bot.send_message(
+            chat_id,
+            f"⚙️ پنل مدیریت\n{status}",
+            reply_markup=ADMIN_PANEL_KEYBOARD
+        )
+
+def start(update: Update, context: CallbackContext):
+    set_sql_route("start")
+    conn = get_conn()
+    cur = conn.cursor()
+    uid = update.effective_user.id
+
+    # ذخیره کاربر
+    cur.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (uid,))
+    conn.commit()
+
+    # لاگ ورود
+    log_event(uid, "start")
+
+    if not is_user_member(context.bot, uid):
+        update.message.reply_text(
+            "📢 برای استفاده از ربات، ابتدا عضو کانال ما شوید 🌱\n\n"
+            "👇 بعد از عضویت، روی «بررسی عضویت» بزنید",
+            reply_markup=JOIN_CHANNEL_KEYBOARD
+        )
+        return
+
+    send_welcome(
+        context.bot,
+        uid,
+        uid == ADMIN_CHAT_ID
+    )
     
-    if q.data == "pay_paypal":
-        st["payment_method"] = "PayPal"
-        send_payment_message(context, uid, st)
+    # ⚙️ پنل ادمین
+    if update.effective_user.id == ADMIN_CHAT_ID:
+        status = "🔵 تست فعال است" if TEST_MODE else "⚪ حالت واقعی فعال است"
+
+        update.message.reply_text(
+            f"⚙️ پنل مدیریت\n{status}",
+            reply_markup=ADMIN_PANEL_KEYBOARD
+        )
+
+
+# ---------- ROUTER ----------
+# هر مسیر با یک lookup در dict پیدا می‌شود ؛ مسیرهای ادمین در جدول جدا ثبت می‌شوند
+# و برای بقیه اصلاً دیده نمی‌شوند
+#   text     → متن دقیق دکمه
+#   escape   → متنی که هر مرحله‌ای را قطع می‌کند (لغو سفارش)
+#   capture  → مرحله‌ای که کل پیام را می‌گیرد (دلیل لغو، متن پیام همگانی، کد تخفیف...)
+#   step     → مراحل عادی سفارش ، بعد از دکمه‌های منو
+#   callback → callback_data دقیق یا پیشوند تا اولین _ (مثلاً food_)
+ROUTE_KINDS = ["text", "escape", "capture", "step", "callback"]
+routes = {kind: {} for kind in ROUTE_KINDS}
+admin_routes = {kind: {} for kind in ROUTE_KINDS}
+
+def route(kind, *keys, admin=False):
+    table = (admin_routes if admin else routes)[kind]
+
+    def register(handler):
+        for key in keys:
+            table[key] = handler
+        return handler
+    return register
+
+
+def resolve_text_route(uid, text, st):
+    key = text.strip()
+    step = st.get("step") if st else None
+    is_admin = uid == ADMIN_CHAT_ID
+
+    return (
+        (is_admin and admin_routes["text"].get(key))
+        or routes["escape"].get(key)
+        or (is_admin and admin_routes["capture"].get(step))
+        or routes["capture"].get(step)
+        or routes["text"].get(key)
+        or routes["step"].get(step)
+    )
+
+
+def resolve_callback_route(uid, data):
+    # (handler, مجاز؟) ؛ handler=None یعنی مسیری نیست
+    prefix = data.split("_", 1)[0] + "_"
+
+    handler = admin_routes["callback"].get(data) or admin_routes["callback"].get(prefix)
+    if handler:
+        return handler, uid == ADMIN_CHAT_ID
+
+    return routes["callback"].get(data) or routes["callback"].get(prefix), True
+
+
+# ---------- CALLBACK ROUTES ----------
+@route("callback", "food_")
+def on_food_selected(update: Update, context: CallbackContext, q, uid, st):
+    key = q.data.replace("food_", "")
+    foods = get_foods_for_target_day()
+
+    log_event(uid, "select_food")
+    
+    if key not in foods:
+        q.answer("این غذا در منوی امروز نیست", show_alert=True)
         return
 
-    if q.data == "pay_cash":
-        st = user_state.get(uid)
+    f = foods[key]
+    if not user_state.get(uid):
+        user_state[uid] = {
+            "step": "qty",
+            "items": []
+        }
+
+    user_state[uid]["current_item"] = {
+        "food_key": key,
+        "food_name": f["name"],
+        "price": f["price"]
+    }
+
+    user_state[uid]["step"] = "qty"
+
+    q.edit_message_text(
+        f"{f['name']} انتخاب شد.\n"
+        "📦 لطفاً تعداد موردنظر را وارد کنید:"
+    )
+
+
+@route("callback", "check_join")
+def on_check_join(update: Update, context: CallbackContext, q, uid, st):
+    # کاربر همین الان عضو شده → جواب کش‌شده قبلی معتبر نیست
+    invalidate_membership(uid)
+    if is_user_member(context.bot, uid):
+        q.edit_message_text(
+            "✅ عضویت شما تأیید شد 🌱\n\n"
+            "خوش آمدید 👇"
+        )
+
+    # ⬅️ این خط کلیدی است
+        send_welcome(
+            context.bot,
+            uid,
+            uid == ADMIN_CHAT_ID
+        )
+
+    else:
+        q.answer(show_alert=True)
+        context.bot.send_message(
+            uid,
+            "❌ هنوز عضو کانال نیستید.\n\n"
+            "📢 لطفاً ابتدا عضو کانال شوید 👇",
+            reply_markup=JOIN_CHANNEL_KEYBOARD
+        )
+
+
+@route("callback", "no_discount")
+def on_no_discount(update: Update, context: CallbackContext, q, uid, st):
+    st = user_state.get(uid)
+
+    if not st:
+        q.answer("خطا", show_alert=True)
+        return
+
+    st["discount"] = 0
+    st["discount_code"] = None
+
+    total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
+    total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
+
+    st["discount_amount"] = 0
+    st["total"] = round(total, 2)
+
+    q.edit_message_text("❌ بدون کد تخفیف ادامه داده شد")
+
+    send_payment_message(context, uid, st)
+
+
+@route("callback", "pay_paypal")
+def on_pay_paypal(update: Update, context: CallbackContext, q, uid, st):
+    st["payment_method"] = "PayPal"
+    send_payment_message(context, uid, st)
+
+
+@route("callback", "pay_cash")
+def on_pay_cash(update: Update, context: CallbackContext, q, uid, st):
+    conn = get_conn()
+    cur = conn.cursor()
+
+    st = user_state.get(uid)
+
+    if not st:
+        q.answer("خطا", show_alert=True)
+        return
+
+    # جلوگیری از دوبار ثبت
+    if st.get("paid"):
+        q.answer("⚠️ این سفارش قبلاً ثبت شده", show_alert=True)
+        return
+
+    st["payment_method"] = "Cash"
+
+    # 🎁 بررسی اولین سفارش (مثل PayPal)
+    cur.execute("SELECT COUNT(*) FROM order_headers WHERE user_id = ?", (uid,))
+    order_count = cur.fetchone()[0]
+    first_order = order_count == 0
+
+    if first_order:
+        st["items"].append({
+            "food_key": "gift_farani",
+            "food_name": "🍮 فرنی (هدیه اولین سفارش)",
+            "qty": 1,
+            "price": 0,
+            "food_total": 0,
+            "cutlery_qty": 0
+        })
+
+    # ثبت سفارش
+    success, result = safe_create_order(
+        uid,
+        st["items"],
+        st["delivery_day"],
+        st["delivery_slot"],
+        st["total"],
+        "Cash",
+        st.get("discount_code"),
+        contact=st
+    )
+
+    if not success:
+        outbox.send(context.bot, uid, result)
+        reset_user(uid)
+        return
+
+    # ✅ جلوگیری از دوبار ثبت
+    st["paid"] = True
+
+    order_no = result
+
+    # ================== دقیقاً کپی PayPal ==================
+
+    foods_text = "\n".join(
+        f"🍽 {i['food_name']} × {i['qty']} | 🥄 {i.get('cutlery_qty', 0)}"
+        for i in st["items"]
+    )
+
+    total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
+
+    discount_text = ""
+    if st.get("discount", 0) > 0:
+        discount_text = f"\n🎁 تخفیف: {st['discount']}٪ (-€{st.get('discount_amount', 0)})"
+
+    base_total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
+
+    # ---------- پیام مشتری ----------
+    msg = (
+        f"💳 ثبت سفارش (پرداخت نقدی)\n"
+        f"🧾 شماره سفارش: {order_no}\n\n"
+        f"{foods_text}\n"
+        f"🥄 مجموع قاشق/چنگال: {total_cutlery}\n"
+        f"📅 روز تحویل: {st['delivery_day']}\n"
+        f"⏰ بازه تحویل: {st['delivery_slot']}\n\n"
+        f"💰 مبلغ اولیه: €{round(base_total,2)}\n"
+    )
+
+    if st.get("discount", 0) > 0:
+        msg += f"🎁 تخفیف ({st['discount']}٪): -€{round(st.get('discount_amount',0),2)}\n"
+
+    msg += f"💵 مبلغ قابل پرداخت در محل: €{st['total']}\n\n"
+
+    msg += (
+        "⏳ سفارش شما ثبت شد و در انتظار تأیید است.\n"
+        "🕒 سفارش‌ها معمولاً در مدت کوتاهی تأیید می‌شوند.\n"
+        "⚠️ در صورت ثبت خارج از ساعات کاری، صبح روز بعد تأیید می‌شود 🙏"
+        "💵 پرداخت به‌صورت نقدی در محل انجام می‌شود."
+    )
+
+    outbox.send(context.bot, uid, msg)
+
+    # ---------- پیام ادمین ----------
+    admin_foods_text = "\n".join(
+        f"🍽 {i['food_name']} × {i['qty']} | 🥄 {i.get('cutlery_qty', 0)}"
+        for i in st["items"]
+    )
+
+    admin_total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
+
+    base_total = st["food_total"] + (admin_total_cutlery * CUTLERY_PRICE)
+
+    admin_msg = (
+        f"💵 سفارش جدید (نقدی)\n\n"
+        f"🧾 شماره سفارش: {order_no}\n"
+        f"👤 نام: {st['fullname']}\n"
+        f"📞 تلفن: {st['phone']}\n"
+        f"📍 آدرس: {st['address']}\n"
+        f"📮 کد پستی: {st['postcode']}\n"
+        f"📅 روز تحویل: {st['delivery_day']}\n"
+        f"⏰ بازه تحویل: {st['delivery_slot']}\n\n"
+        f"{admin_foods_text}\n"
+        f"🥄 مجموع قاشق/چنگال: {admin_total_cutlery}\n\n"
+        f"💰 مبلغ اولیه: €{round(base_total,2)}\n"
+    )
+
+    if st.get("discount", 0) > 0:
+        admin_msg += f"🎁 تخفیف ({st['discount']}٪): -€{round(st.get('discount_amount',0),2)}\n"
+
+    admin_msg += f"💵 مبلغ قابل دریافت: €{st['total']}"
+
+    outbox.send(
+        context.bot,
+        ADMIN_CHAT_ID,
+        admin_msg,
+        priority="bulk",
+        reply_markup=admin_keyboard(order_no)
+    )
+
+    reset_user(uid)
+
+
+# ---------------- CUTLERY YES ----------------
+@route("callback", "cutlery_yes")
+def on_cutlery_yes(update: Update, context: CallbackContext, q, uid, st):
+    st["step"] = "cutlery_qty"
+    q.edit_message_text(
+        f"🥄 هر عدد: {CUTLERY_PRICE}€\n"
+        "لطفاً تعداد موردنیاز را وارد کنید:"
+    )
+
+
+# ---------------- CUTLERY NO ----------------
+@route("callback", "cutlery_no")
+def on_cutlery_no(update: Update, context: CallbackContext, q, uid, st):
+    st["items"][-1]["cutlery_qty"] = 0
+    st["step"] = "ask_more"
+
+    q.edit_message_text(
+        "🛒 آیا سفارش دیگری دارید؟",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("➕ سفارش دیگر", callback_data="more_order")],
+            [InlineKeyboardButton("✅ ادامه خرید", callback_data="continue_order")]
+        ])
+    )
+
+
+# ---------------- PICKUP YES ----------------
+@route("callback", "pickup_yes")
+def on_pickup_yes(update: Update, context: CallbackContext, q, uid, st):
+    st["delivery_method"] = "pickup"
+    st["step"] = "fullname"
+    q.edit_message_text("👤 لطفاً نام کامل خود را وارد کنید:")
+
+
+# ---------------- PICKUP NO ----------------
+@route("callback", "pickup_no")
+def on_pickup_no(update: Update, context: CallbackContext, q, uid, st):
+    reset_user(uid)
+    q.edit_message_text("❌ سفارش لغو شد.")
+    context.bot.send_message(uid, "منوی اصلی:", reply_markup=PERSISTENT_MENU)
+
+
+
+# ---------------- PAYMENT CONFIRM ----------------
+@route("callback", "paid_paypal")
+def on_paid_paypal(update: Update, context: CallbackContext, q, uid, st):
+    conn = get_conn()
+    cur = conn.cursor()
+
+    st = user_state.get(uid)
+    if st and st.get("paid"):
+        q.answer("⚠️ این سفارش قبلاً ثبت شده", show_alert=True)
+        return
+    
+
+    # اگر state وجود نداشت
+    if not st:
+        q.answer("خطا در سفارش", show_alert=True)
+        return
+
+    # اگر زمان ذخیره نشده بود
+    created_str = st.get("created_at")
+
+    if not created_str:
+        reset_user(uid)
+        outbox.send(context.bot, uid, "❌ خطا در سفارش. لطفاً دوباره تلاش کنید.")
+        return
+
+    created_at = datetime.strptime(created_str, "%Y-%m-%d %H:%M").replace(tzinfo=TIMEZONE)
+
+    # اگر بیشتر از ۵ دقیقه گذشته بود
+    if datetime.now(TIMEZONE) - created_at > timedelta(minutes=5):
+        q.answer("⏰ زمان پرداخت تمام شد", show_alert=True)
+
+        outbox.send(
+            context.bot,
+            uid,
+            "⏰ سفارش شما لغو شد، به علت رعایت نکردن زمان پرداخت.\n\n"
+            "❗ اگر پرداخت انجام داده‌اید، مبلغ شما تا دقایقی دیگر بازگردانده می‌شود.\n"
+            "📩 در صورت نیاز با پشتیبانی تماس بگیرید."
+        )
+
+        # 👇 این قسمت جدید (برای ادمین)
+        # ساخت متن غذاها 👇
+        foods_text = "\n".join(
+            f"🍽 {i['food_name']} × {i['qty']} | 🥄 {i.get('cutlery_qty', 0)}"
+            for i in st["items"]
+        )
+
+        # بعدش پیام ادمین 👇
+        outbox.send(
+            context.bot,
+            ADMIN_CHAT_ID,
+            f"⚠️ پرداخت نامشخص\n\n"
+            f"👤 کاربر: {uid}\n"
+            f"💰 مبلغ: €{st.get('total')}\n"
+            f"📅 روز: {st.get('delivery_day')}\n"
+            f"⏰ بازه: {st.get('delivery_slot')}\n\n"
+            f"🍽 آیتم‌ها:\n{foods_text}\n\n"
+            "❗ کاربر بعد از ۵ دقیقه پرداخت را زده\n"
+            "👉 احتمال دارد پرداخت انجام شده باشد",
+            priority="bulk"
+        )
+
+        reset_user(uid)
+        return
+
+    # جلوگیری از دابل کلیک
+    if st.get("paid"):
+        q.answer("⚠️ این سفارش قبلاً ثبت شده", show_alert=True)
+        return
+
+    st["payment_method"] = "PayPal"
+
+    # بررسی اولین سفارش
+    cur.execute("SELECT COUNT(*) FROM order_headers WHERE user_id = ?", (uid,))
+    order_count = cur.fetchone()[0]
+    first_order = order_count == 0
+
+    # هدیه اولین سفارش
+    if first_order:
+        st["items"].append({
+            "food_key": "gift_farani",
+            "food_name": "🍮 فرنی (هدیه اولین سفارش)",
+            "qty": 1,
+            "price": 0,
+            "food_total": 0,
+            "cutlery_qty": 0
+        })
+
+    # ثبت امن سفارش
+    success, result = safe_create_order(
+        uid,
+        st["items"],
+        st["delivery_day"],
+        st["delivery_slot"],
+        st["total"],
+        "PayPal",
+        st.get("discount_code"),
+        contact=st
+    )
+    
+    
+    if not success:
+        outbox.send(context.bot, uid, result)
+        reset_user(uid)
+        return
+
+        
+    log_event(uid, "paid")
+
+    # ✅ فقط بعد از موفقیت
+    st["paid"] = True
+
+    order_no = result
+
+    foods_text = "\n".join(
+        f"🍽 {i['food_name']} × {i['qty']} | 🥄 {i.get('cutlery_qty', 0)}"
+        for i in st["items"]
+    )
+
+    total_cutlery = sum(
+        i.get("cutlery_qty", 0) for i in st["items"]
+    )
+
+    discount_text = ""
+    if st.get("discount", 0) > 0:
+        discount_text = f"\n🎁 تخفیف: {st['discount']}٪ (-€{st.get('discount_amount', 0)})"
+    
+    base_total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
+
+    msg = (
+        f"💳 پرداخت ثبت شد.\n"
+        f"🧾 شماره سفارش: {order_no}\n\n"
+        f"{foods_text}\n"
+        f"🥄 مجموع قاشق/چنگال: {total_cutlery}\n"
+        f"📅 روز تحویل: {st['delivery_day']}\n"
+        f"⏰ بازه تحویل: {st['delivery_slot']}\n\n"
+        f"💰 مبلغ اولیه: €{round(base_total,2)}\n"
+    )
+
+    if st.get("discount", 0) > 0:
+        msg += f"🎁 تخفیف ({st['discount']}٪): -€{round(st.get('discount_amount',0),2)}\n"
+        
+    msg += f"💳 مبلغ نهایی پرداخت‌ شده: €{st['total']}\n\n"
+
+    msg += (
+        "⏳ سفارش شما ثبت شد و در انتظار تأیید است.\n\n"
+        "🕒 سفارش‌ها معمولاً در مدت کوتاهی تأیید می‌شوند.\n"
+        "⚠️ در صورت ثبت خارج از ساعات کاری، صبح روز بعد تأیید می‌شود 🙏"
+    )
+
+    outbox.send(context.bot, uid, msg)
+
+    # پیام ادمین
+    admin_foods_text = "\n".join(
+        f"🍽 {i['food_name']} × {i['qty']} | 🥄 {i.get('cutlery_qty', 0)}"
+        for i in st["items"]
+    )
+
+    admin_total_cutlery = sum(
+        i.get("cutlery_qty", 0) for i in st["items"]
+    )
+
+    discount_text = ""
+    if st.get("discount", 0) > 0:
+        discount_text = f"\n🎁 تخفیف: {st.get('discount',0)}٪ (-€{st.get('discount_amount',0)})"
+
+    base_total = st["food_total"] + (admin_total_cutlery * CUTLERY_PRICE)
+
+    admin_msg = (
+        f"🆕 سفارش جدید\n\n"
+        f"🧾 شماره سفارش: {order_no}\n"
+        f"👤 نام: {st['fullname']}\n"
+        f"📞 تلفن: {st['phone']}\n"
+        f"📍 آدرس: {st['address']}\n"
+        f"📮 کد پستی: {st['postcode']}\n"
+        f"📅 روز تحویل: {st['delivery_day']}\n"
+        f"⏰ بازه تحویل: {st['delivery_slot']}\n\n"
+        f"{admin_foods_text}\n"
+        f"🥄 مجموع قاشق/چنگال: {admin_total_cutlery}\n\n"
+        f"💰 مبلغ اولیه: €{round(base_total,2)}\n"
+    )
+
+    if st.get("discount", 0) > 0:
+        admin_msg += f"🎁 تخفیف ({st.get('discount',0)}٪): -€{round(st.get('discount_amount',0),2)}\n"
+
+    admin_msg += f"💳 مبلغ دریافتی: €{st['total']}"
+
+    outbox.send(
+        context.bot,
+        ADMIN_CHAT_ID,
+        admin_msg,
+        priority="bulk",
+        reply_markup=admin_keyboard(order_no)
+    )
+    reset_user(uid)
+
+
+# ---------------- DELIVERY SLOT ----------------
+@route("callback", "slot_")
+def on_slot_selected(update: Update, context: CallbackContext, q, uid, st):
+    conn = get_conn()
+    cur = conn.cursor()
+
+    _, start, end = q.data.split("_")
+    slot = f"{start} – {end}"
+
+    if is_slot_full(st["delivery_day"], slot):
+        q.answer("❌ این بازه زمانی پر شده", show_alert=True)
+        return
+
+    st["delivery_slot"] = slot
+
+    log_event(uid, "go_to_payment")
+
+# محاسبه مبلغ نهایی
+    total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
+
+    base_total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
+
+    discount = st.get("discount", 0)
+    discount_amount = base_total * discount / 100
+
+    total = base_total - discount_amount
+
+    st["discount_amount"] = round(discount_amount, 2)
+    st["total"] = round(total, 2)
+    
+    # بررسی وجود کد تخفیف
+    cur.execute("""
+    SELECT code FROM discount_codes
+    WHERE used_count < max_use
+    LIMIT 1
+    """)
 
-        if not st:
-            q.answer("خطا", show_alert=True)
-            return
+    has_discount = cur.fetchone()
 
-        # جلوگیری از دوبار ثبت
-        if st.get("paid"):
-            q.answer("⚠️ این سفارش قبلاً ثبت شده", show_alert=True)
-            return
+    if has_discount:
+        st["step"] = "discount_code"
 
-        st["payment_method"] = "Cash"
-
-        # 🎁 بررسی اولین سفارش (مثل PayPal)
-        cur.execute("SELECT COUNT(*) FROM orders WHERE user_id = ?", (uid,))
-        order_count = cur.fetchone()[0]
-        first_order = order_count == 0
-
-        if first_order:
-            st["items"].append({
-                "food_key": "gift_farani",
-                "food_name": "🍮 فرنی (هدیه اولین سفارش)",
-                "qty": 1,
-                "price": 0,
-                "food_total": 0,
-                "cutlery_qty": 0
-            })
-
-        # ثبت سفارش
-        success, result = safe_create_order(
+        context.bot.send_message(
             uid,
-            st["items"],
-            st["delivery_day"],
-            st["delivery_slot"],
-            st["total"],
-            "Cash",
-            st.get("discount_code")
+            "🎁 اگر کد تخفیف دارید وارد کنید\nیا روی دکمه زیر بزنید",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ کد ندارم", callback_data="no_discount")]
+            ])
         )
+        return
 
-        if not success:
-            context.bot.send_message(uid, result)
-            reset_user(uid)
-            return
+    st["step"] = "choose_payment"
+
+    context.bot.send_message(
+        uid,
+        "💳 روش پرداخت رو انتخاب کن:",
+        reply_markup=PAYMENT_METHOD_KEYBOARD
+    )
 
-        # ✅ جلوگیری از دوبار ثبت
-        st["paid"] = True
 
-        order_no = result
+# ---------------- ADD MORE OR CONTINUE ORDER ----------------
+@route("callback", "more_order")
+def on_more_order(update: Update, context: CallbackContext, q, uid, st):
+    st = user_state.get(uid)
+    if not st:
+        q.answer()
+        return
 
-        # ✅ خیلی مهم برای ادمین
-        import copy
-        orders_runtime[order_no] = copy.deepcopy(st)
-        orders_runtime[order_no]["user_id"] = uid
+    st["step"] = "qty"
+    q.edit_message_text("🍽 لطفاً غذای بعدی را انتخاب کنید:")
+    context.bot.send_message(
+        uid,
+        "منوی غذا:",
+        reply_markup=food_keyboard()
+    )
 
-        # ================== دقیقاً کپی PayPal ==================
 
-        foods_text = "\n".join(
-            f"🍽 {i['food_name']} × {i['qty']} | 🥄 {i.get('cutlery_qty', 0)}"
-            for i in st["items"]
-        )
+@route("callback", "continue_order")
+def on_continue_order(update: Update, context: CallbackContext, q, uid, st):
+    st = user_state.get(uid)
+    if not st:
+        q.answer()
+        return
 
-        total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
+    st["step"] = "postcode"
+    q.edit_message_text("📮 لطفاً کد پستی را وارد کنید:")
 
-        discount_text = ""
-        if st.get("discount", 0) > 0:
-            discount_text = f"\n🎁 تخفیف: {st['discount']}٪ (-€{st.get('discount_amount', 0)})"
 
-        base_total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
+# ---------------- ADMIN APPROVAL ----------------
+@route("callback", "admin_", admin=True)
+def on_admin_decision(update: Update, context: CallbackContext, q, uid, st):
+    conn = get_conn()
+    cur = conn.cursor()
 
-        # ---------- پیام مشتری ----------
-        msg = (
-            f"💳 ثبت سفارش (پرداخت نقدی)\n"
-            f"🧾 شماره سفارش: {order_no}\n\n"
-            f"{foods_text}\n"
-            f"🥄 مجموع قاشق/چنگال: {total_cutlery}\n"
-            f"📅 روز تحویل: {st['delivery_day']}\n"
-            f"⏰ بازه تحویل: {st['delivery_slot']}\n\n"
-            f"💰 مبلغ اولیه: €{round(base_total,2)}\n"
-        )
+    _, action, order_no = q.data.split("_")
 
-        if st.get("discount", 0) > 0:
-            msg += f"🎁 تخفیف ({st['discount']}٪): -€{round(st.get('discount_amount',0),2)}\n"
+    # هدر + آیتم‌ها با یک کوئری (PK و idx_order_items_order)
+    cur.execute("""
+        SELECT h.user_id, h.delivery_day, h.delivery_slot, h.total,
+               h.address, h.phone, h.delivery_method,
+               i.food_name, i.qty, i.cutlery_qty
+        FROM order_headers h
+        LEFT JOIN order_items i ON i.order_no = h.order_no
+        WHERE h.order_no = ?
+        ORDER BY i.id
+    """, (order_no,))
+    rows = cur.fetchall()
+
+    if not rows:
+        q.answer("❌ سفارش پیدا نشد", show_alert=True)
+        return
+
+    user_id, delivery_day, delivery_slot, total, address, phone, delivery_method = rows[0][:7]
+    order = {
+        "delivery_day": delivery_day,
+        "delivery_slot": delivery_slot,
+        "total": total,
+        "address": address,
+        "phone": phone,
+        "delivery_method": delivery_method,
+        "items": [
+            {"food_name": r[7], "qty": r[8], "cutlery_qty": r[9] or 0}
+            for r in rows if r[7] is not None
+        ]
+    }
 
-        msg += f"💵 مبلغ قابل پرداخت در محل: €{st['total']}\n\n"
+    if action == "ok":
+        close_order(order_no, "approved")
 
-        msg += (
-            "⏳ سفارش شما ثبت شد و در انتظار تأیید است.\n"
-            "🕒 سفارش‌ها معمولاً در مدت کوتاهی تأیید می‌شوند.\n"
-            "⚠️ در صورت ثبت خارج از ساعات کاری، صبح روز بعد تأیید می‌شود 🙏"
-            "💵 پرداخت به‌صورت نقدی در محل انجام می‌شود."
+        delivery_text = (
+            "🚗 روش دریافت: ارسال"
+            if order["delivery_method"] == "delivery"
+            else f"🎒 روش دریافت: تحویل حضوری\n📍 آدرس: {PICKUP_ADDRESS_FULL}"
         )
 
-        context.bot.send_message(uid, msg)
+        approved_total_cutlery = sum(
+            i.get("cutlery_qty", 0) for i in order["items"]
+        )
 
-        # ---------- پیام ادمین ----------
-        admin_foods_text = "\n".join(
-            f"🍽 {i['food_name']} × {i['qty']} | 🥄 {i.get('cutlery_qty', 0)}"
-            for i in st["items"]
+        foods_text = "\n".join(
+            f"🍽 {i['food_name']} × {i['qty']}"
+            for i in order["items"]
         )
 
-        admin_total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
-
-        base_total = st["food_total"] + (admin_total_cutlery * CUTLERY_PRICE)
-
-        admin_msg = (
-            f"💵 سفارش جدید (نقدی)\n\n"
-            f"🧾 شماره سفارش: {order_no}\n"
-            f"👤 نام: {st['fullname']}\n"
-            f"📞 تلفن: {st['phone']}\n"
-            f"📍 آدرس: {st['address']}\n"
-            f"📮 کد پستی: {st['postcode']}\n"
-            f"📅 روز تحویل: {st['delivery_day']}\n"
-            f"⏰ بازه تحویل: {st['delivery_slot']}\n\n"
-            f"{admin_foods_text}\n"
-            f"🥄 مجموع قاشق/چنگال: {admin_total_cutlery}\n\n"
-            f"💰 مبلغ اولیه: €{round(base_total,2)}\n"
+        msg = (
+            "✅ سفارش شما تأیید شد 🙏\n\n"
+            "🧾 خلاصه سفارش:\n"
+            f"{foods_text}\n"
+            f"🥄 مجموع قاشق/چنگال: {approved_total_cutlery}\n"
+            f"📅 روز تحویل: {order['delivery_day']}\n"
+            f"⏰ بازه تحویل: {order['delivery_slot']}\n"
+            f"{delivery_text}\n"
+            f"🏠 آدرس: {order['address']}\n"
+            f"📞 تماس: {order['phone']}\n\n"
+            f"💶 مبلغ کل: €{order['total']}\n\n"
+            "🙏 ممنون از اعتماد شما"
         )
 
-        if st.get("discount", 0) > 0:
-            admin_msg += f"🎁 تخفیف ({st['discount']}٪): -€{round(st.get('discount_amount',0),2)}\n"
+        outbox.send(context.bot, user_id, msg)
+        q.edit_message_text(q.message.text + "\n\n✔️ تایید شد")
+        q.answer("✅ انجام شد")
 
-        admin_msg += f"💵 مبلغ قابل دریافت: €{st['total']}"
+    else:
+        user_state[uid] = {
+            "step": "admin_cancel_reason",
+            "order_no": order_no,
+            "target_user": user_id
+        }
 
-        context.bot.send_message(
-            ADMIN_CHAT_ID,
-            admin_msg,
-            reply_markup=admin_keyboard(order_no)
-        )
+        q.edit_message_text(q.message.text + "\n\n📝 لطفاً دلیل لغو را بنویسید:")
 
-        reset_user(uid)
-        return
-    
-    # ---------------- CUTLERY YES ----------------
-    if q.data == "cutlery_yes":
-        st["step"] = "cutlery_qty"
-        q.edit_message_text(
-            f"🥄 هر عدد: {CUTLERY_PRICE}€\n"
-            "لطفاً تعداد موردنیاز را وارد کنید:"
-        )
-        return
+        context.bot.send_message(uid, "✍️ لطفاً دلیل را بنویسید:")
 
-    # ---------------- CUTLERY NO ----------------
-    if q.data == "cutlery_no":
-        st["items"][-1]["cutlery_qty"] = 0
-        st["step"] = "ask_more"
 
-        q.edit_message_text(
-            "🛒 آیا سفارش دیگری دارید؟",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("➕ سفارش دیگر", callback_data="more_order")],
-                [InlineKeyboardButton("✅ ادامه خرید", callback_data="continue_order")]
-            ])
-        )
-        return
 
-    # ---------------- PICKUP YES ----------------
-    if q.data == "pickup_yes":
-        st["delivery_method"] = "pickup"
-        st["step"] = "fullname"
-        q.edit_message_text("👤 لطفاً نام کامل خود را وارد کنید:")
-        return
+# ---------------- SALES REPORT PAGES ----------------
+@route("callback", "rpt_", admin=True)
+def on_report_page(update: Update, context: CallbackContext, q, uid, st):
+    _, direction, cursor, day, status, days = q.data.split("_")
+    report, markup = build_report_page(day, status, int(days), direction, int(cursor))
+    q.edit_message_text(report, reply_markup=markup)
 
-    # ---------------- PICKUP NO ----------------
-    if q.data == "pickup_no":
-        reset_user(uid)
-        q.edit_message_text("❌ سفارش لغو شد.")
-        context.bot.send_message(uid, "منوی اصلی:", reply_markup=persistent_menu())
 
-        return
+# ---------------- FUNNEL WINDOW ----------------
+@route("callback", "fnl_", admin=True)
+def on_funnel_window(update: Update, context: CallbackContext, q, uid, st):
+    msg, markup = build_funnel_report(int(q.data.split("_")[1]))
+    q.edit_message_text(msg, reply_markup=markup)
 
-    # ---------------- PAYMENT CONFIRM ----------------
-    if q.data == "paid_paypal":
-        st = user_state.get(uid)
-        if st and st.get("paid"):
-            q.answer("⚠️ این سفارش قبلاً ثبت شده", show_alert=True)
-            return
-        
 
-        # اگر state وجود نداشت
-        if not st:
-            q.answer("خطا در سفارش", show_alert=True)
-            return
+# ---------------- EXPORT ----------------
+@route("callback", "exp_", admin=True)
+def on_export_selected(update: Update, context: CallbackContext, q, uid, st):
+    _, dataset, fmt, days = q.data.split("_")
+    date_from = None
+    if int(days):
+        date_from = (datetime.now(TIMEZONE) - timedelta(days=int(days))).strftime("%Y-%m-%d")
 
-        # اگر زمان ذخیره نشده بود
-        created_str = st.get("created_at")
+    q.edit_message_text("⏳ فایل خروجی در حال آماده شدن است...")
+    run_admin_job(context.bot, uid, "export", export_data, context.bot, uid, dataset, fmt, date_from)
 
-        if not created_str:
-            reset_user(uid)
-            context.bot.send_message(uid, "❌ خطا در سفارش. لطفاً دوباره تلاش کنید.")
-            return
 
-        created_at = datetime.strptime(created_str, "%Y-%m-%d %H:%M").replace(tzinfo=TIMEZONE)
+# ---------------- REMINDER ----------------
+@route("callback", "remind_cancel", admin=True)
+def on_reminder_cancel(update: Update, context: CallbackContext, q, uid, st):
+    q.edit_message_text("❌ ارسال یادآوری لغو شد")
 
-        # اگر بیشتر از ۵ دقیقه گذشته بود
-        if datetime.now(TIMEZONE) - created_at > timedelta(minutes=5):
-            q.answer("⏰ زمان پرداخت تمام شد", show_alert=True)
 
-            context.bot.send_message(
-                uid,
-                "⏰ سفارش شما لغو شد، به علت رعایت نکردن زمان پرداخت.\n\n"
-                "❗ اگر پرداخت انجام داده‌اید، مبلغ شما تا دقایقی دیگر بازگردانده می‌شود.\n"
-                "📩 در صورت نیاز با پشتیبانی تماس بگیرید."
-            )
+@route("callback", "remind_", admin=True)
+def on_reminder_confirm(update: Update, context: CallbackContext, q, uid, st):
+    _, target = q.data.split("_")
 
-            # 👇 این قسمت جدید (برای ادمین)
-            # ساخت متن غذاها 👇
-            foods_text = "\n".join(
-                f"🍽 {i['food_name']} × {i['qty']} | 🥄 {i.get('cutlery_qty', 0)}"
-                for i in st["items"]
-            )
+    # ارسال در پس‌زمینه؛ خلاصه نتیجه بعداً برای ادمین ارسال می‌شود
+    threading.Thread(
+        target=run_delivery_reminders,
+        args=(context.bot, uid, DELIVERY_DAY_FA[target]),
+        daemon=True
+    ).start()
 
-            # بعدش پیام ادمین 👇
-            context.bot.send_message(
-                ADMIN_CHAT_ID,
-                f"⚠️ پرداخت نامشخص\n\n"
-                f"👤 کاربر: {uid}\n"
-                f"💰 مبلغ: €{st.get('total')}\n"
-                f"📅 روز: {st.get('delivery_day')}\n"
-                f"⏰ بازه: {st.get('delivery_slot')}\n\n"
-                f"🍽 آیتم‌ها:\n{foods_text}\n\n"
-                "❗ کاربر بعد از ۵ دقیقه پرداخت را زده\n"
-                "👉 احتمال دارد پرداخت انجام شده باشد"
-            )
+    q.edit_message_text("⏳ ارسال یادآوری‌ها در پس‌زمینه شروع شد...")
 
-            reset_user(uid)
-            return
 
-        # جلوگیری از دابل کلیک
-        if st.get("paid"):
-            q.answer("⚠️ این سفارش قبلاً ثبت شده", show_alert=True)
-            return
+# ---------- CALLBACK HANDLER ----------
+def callbacks(update: Update, context: CallbackContext):
+    q = update.callback_query
+    uid = q.from_user.id
+    q.answer()
 
-        st["payment_method"] = "PayPal"
+    handler, allowed = resolve_callback_route(uid, q.data)
+    if not handler:
+        return
 
-        # بررسی اولین سفارش
-        cur.execute("SELECT COUNT(*) FROM orders WHERE user_id = ?", (uid,))
-        order_count = cur.fetchone()[0]
-        first_order = order_count == 0
-    
-        # هدیه اولین سفارش
-        if first_order:
-            st["items"].append({
-                "food_key": "gift_farani",
-                "food_name": "🍮 فرنی (هدیه اولین سفارش)",
-                "qty": 1,
-                "price": 0,
-                "food_total": 0,
-                "cutlery_qty": 0
-            })
-
-        # ثبت امن سفارش
-        success, result = safe_create_order(
-            uid,
-            st["items"],
-            st["delivery_day"],
-            st["delivery_slot"],
-            st["total"],
-            "PayPal",
-            st.get("discount_code")
-        )
-        
-        
-        if not success:
-            context.bot.send_message(uid, result)
-            reset_user(uid)
-            return
+    if not allowed:
+        q.answer("⛔ دسترسی ندارید", show_alert=True)
+        return
 
-            
-        cur.execute(
-            "INSERT INTO logs (user_id, action, created_at) VALUES (?, ?, ?)",
-            (uid, "paid", datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"))
-        )
-        conn.commit()
+    set_sql_route(handler.__name__.removeprefix("on_"))
+    handler(update, context, q, uid, user_state.get(uid))
 
-        # ✅ فقط بعد از موفقیت
-        st["paid"] = True
 
-        order_no = result
-        order_nos = [order_no]
+# ---------- TEXT ROUTES ----------
+@route("capture", "admin_cancel_reason", admin=True)
+def on_admin_cancel_reason(update: Update, context: CallbackContext, uid, text, st):
+    conn = get_conn()
+    cur = conn.cursor()
 
-        import copy
-        orders_runtime[order_no] = copy.deepcopy(st)
-        orders_runtime[order_no]["user_id"] = uid
+    reason = text
 
-        foods_text = "\n".join(
-            f"🍽 {i['food_name']} × {i['qty']} | 🥄 {i.get('cutlery_qty', 0)}"
-            for i in st["items"]
-        )
+    order_no = st["order_no"]
+    target_user = st["target_user"]
 
-        total_cutlery = sum(
-            i.get("cutlery_qty", 0) for i in st["items"]
-        )
+    close_order(order_no, "canceled")
 
-        discount_text = ""
-        if st.get("discount", 0) > 0:
-            discount_text = f"\n🎁 تخفیف: {st['discount']}٪ (-€{st.get('discount_amount', 0)})"
-        
-        base_total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
+    # گرفتن نوع پرداخت از دیتابیس
+    cur.execute("SELECT payment_method FROM order_headers WHERE order_no = ?", (order_no,))
+    payment_method = cur.fetchone()[0]
 
+    if payment_method == "Cash":
         msg = (
-            f"💳 پرداخت ثبت شد.\n"
-            f"🧾 شماره سفارش: {order_no}\n\n"
-            f"{foods_text}\n"
-            f"🥄 مجموع قاشق/چنگال: {total_cutlery}\n"
-            f"📅 روز تحویل: {st['delivery_day']}\n"
-            f"⏰ بازه تحویل: {st['delivery_slot']}\n\n"
-            f"💰 مبلغ اولیه: €{round(base_total,2)}\n"
+            f"❌ سفارش شما لغو شد.\n\n"
+            f"📌 دلیل: {reason}\n\n"
+            "در صورت تمایل می‌توانید مجدداً سفارش ثبت کنید 🙏"
         )
-
-        if st.get("discount", 0) > 0:
-            msg += f"🎁 تخفیف ({st['discount']}٪): -€{round(st.get('discount_amount',0),2)}\n"
-            
-        msg += f"💳 مبلغ نهایی پرداخت‌ شده: €{st['total']}\n\n"
-
-        msg += (
-            "⏳ سفارش شما ثبت شد و در انتظار تأیید است.\n\n"
-            "🕒 سفارش‌ها معمولاً در مدت کوتاهی تأیید می‌شوند.\n"
-            "⚠️ در صورت ثبت خارج از ساعات کاری، صبح روز بعد تأیید می‌شود 🙏"
+    else:
+        msg = (
+            f"❌ سفارش شما لغو شد.\n\n"
+            f"📌 دلیل: {reason}\n\n"
+            "💰 در صورت پرداخت، مبلغ تا دقایقی دیگر بازگردانده می‌شود."
         )
 
-        context.bot.send_message(uid, msg)
+    outbox.send(context.bot, target_user, msg)
 
-        # پیام ادمین
-        admin_foods_text = "\n".join(
-            f"🍽 {i['food_name']} × {i['qty']} | 🥄 {i.get('cutlery_qty', 0)}"
-            for i in st["items"]
-        )
+    update.message.reply_text("✅ سفارش لغو شد و دلیل ارسال شد.")
 
-        admin_total_cutlery = sum(
-            i.get("cutlery_qty", 0) for i in st["items"]
-        )
+    reset_user(uid)
 
-        discount_text = ""
-        if st.get("discount", 0) > 0:
-            discount_text = f"\n🎁 تخفیف: {st.get('discount',0)}٪ (-€{st.get('discount_amount',0)})"
-
-        base_total = st["food_total"] + (admin_total_cutlery * CUTLERY_PRICE)
-
-        admin_msg = (
-            f"🆕 سفارش جدید\n\n"
-            f"🧾 شماره سفارش: {order_no}\n"
-            f"👤 نام: {st['fullname']}\n"
-            f"📞 تلفن: {st['phone']}\n"
-            f"📍 آدرس: {st['address']}\n"
-            f"📮 کد پستی: {st['postcode']}\n"
-            f"📅 روز تحویل: {st['delivery_day']}\n"
-            f"⏰ بازه تحویل: {st['delivery_slot']}\n\n"
-            f"{admin_foods_text}\n"
-            f"🥄 مجموع قاشق/چنگال: {admin_total_cutlery}\n\n"
-            f"💰 مبلغ اولیه: €{round(base_total,2)}\n"
-        )
 
-        if st.get("discount", 0) > 0:
-            admin_msg += f"🎁 تخفیف ({st.get('discount',0)}٪): -€{round(st.get('discount_amount',0),2)}\n"
+@route("escape", "❌ لغو سفارش")
+def on_cancel_order(update: Update, context: CallbackContext, uid, text, st):
+    reset_user(uid)
+    update.message.reply_text("سفارش لغو شد.", reply_markup=PERSISTENT_MENU)
 
-        admin_msg += f"💳 مبلغ دریافتی: €{st['total']}"
 
-        context.bot.send_message(
-            ADMIN_CHAT_ID,
-            admin_msg,
-            reply_markup=admin_keyboard(order_no)
-        )
-        reset_user(uid)
-        return
+# --- ANALYTICS (ADMIN ONLY) ---
+@route("text", "📊 تحلیل رفتار", admin=True)
+def on_funnel_report(update: Update, context: CallbackContext, uid, text, st):
+    msg, markup = build_funnel_report(FUNNEL_WINDOWS[0])
+    update.message.reply_text(msg, reply_markup=markup)
 
-    # ---------------- DELIVERY SLOT ----------------
-    if q.data.startswith("slot_"):
-        _, start, end = q.data.split("_")
-        slot = f"{start} – {end}"
 
-        if get_slot_count(st["delivery_day"], slot) >= 3:
-            q.answer("❌ این بازه زمانی پر شده", show_alert=True)
-            return
+# --- BROADCAST (ADMIN ONLY) ---
+@route("text", "📣 ارسال پیام", admin=True)
+def on_broadcast_start(update: Update, context: CallbackContext, uid, text, st):
+    user_state[uid] = {"step": "broadcast"}
+    update.message.reply_text("✍️ متن پیام رو بفرست:")
 
-        st["delivery_slot"] = slot
 
-        cur.execute(
-            "INSERT INTO logs (user_id, action, created_at) VALUES (?, ?, ?)",
-            (uid, "go_to_payment", datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"))
-        )
-        conn.commit()
+@route("capture", "broadcast", admin=True)
+def on_broadcast_text(update: Update, context: CallbackContext, uid, text, st):
+    # ارسال در پس‌زمینه؛ پیشرفت در همان پیام ادمین به‌روز می‌شود
+    run_admin_job(context.bot, uid, "broadcast", start_broadcast, context.bot, uid, text)
 
-    # محاسبه مبلغ نهایی
-        total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
+    reset_user(uid)
 
-        base_total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
 
-        discount = st.get("discount", 0)
-        discount_amount = base_total * discount / 100
+@route("text", "🎁 مدیریت تخفیف", admin=True)
+def on_discount_create_start(update: Update, context: CallbackContext, uid, text, st):
+    user_state[uid] = {"step": "discount_code_create"}
+    update.message.reply_text("✍️ کد تخفیف را وارد کنید:")
 
-        total = base_total - discount_amount
 
-        st["discount_amount"] = round(discount_amount, 2)
-        st["total"] = round(total, 2)
-        
-        # بررسی وجود کد تخفیف
-        cur.execute("""
-        SELECT code FROM discount_codes
-        WHERE used_count < max_use
-        LIMIT 1
-        """)
+# حذف کد تخفیف
+@route("text", "❌ حذف کد تخفیف", admin=True)
+def on_discount_delete_start(update: Update, context: CallbackContext, uid, text, st):
+    user_state[uid] = {"step": "delete_discount"}
+    update.message.reply_text("🗑 کد موردنظر را وارد کنید:")
 
-        has_discount = cur.fetchone()
 
-        if has_discount:
-            st["step"] = "discount_code"
+@route("capture", "delete_discount", admin=True)
+def on_discount_delete(update: Update, context: CallbackContext, uid, text, st):
+    conn = get_conn()
+    cur = conn.cursor()
 
-            context.bot.send_message(
-                uid,
-                "🎁 اگر کد تخفیف دارید وارد کنید\nیا روی دکمه زیر بزنید",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ کد ندارم", callback_data="no_discount")]
-                ])
-            )
-            return
+    code = text.upper()
 
-        st["step"] = "choose_payment"
+    cur.execute("SELECT 1 FROM discount_codes WHERE code = ?", (code,))
+    exists = cur.fetchone()
 
-        context.bot.send_message(
-            uid,
-            "💳 روش پرداخت رو انتخاب کن:",
-            reply_markup=payment_method_keyboard()
-        )
+    if not exists:
+        update.message.reply_text("❌ چنین کدی وجود ندارد")
         return
 
-    # ---------------- ADD MORE OR CONTINUE ORDER ----------------
-    if q.data == "more_order":
-        st = user_state.get(uid)
-        if not st:
-            q.answer()
-            return
+    cur.execute("DELETE FROM discount_codes WHERE code = ?", (code,))
+    conn.commit()
 
-        st["step"] = "qty"
-        q.edit_message_text("🍽 لطفاً غذای بعدی را انتخاب کنید:")
-        context.bot.send_message(
-            uid,
-            "منوی غذا:",
-            reply_markup=food_keyboard()
-        )
+    update.message.reply_text("✅ کد حذف شد")
+    reset_user(uid)
+
+
+@route("capture", "discount_code_create", admin=True)
+def on_discount_code_create(update: Update, context: CallbackContext, uid, text, st):
+    st["code"] = text.upper()
+    st["step"] = "discount_percent"
+    update.message.reply_text("📊 درصد تخفیف (مثلاً 15):")
+
+
+@route("capture", "discount_percent", admin=True)
+def on_discount_percent(update: Update, context: CallbackContext, uid, text, st):
+    if not text.isdigit():
+        update.message.reply_text("❗ فقط عدد")
         return
 
-    if q.data == "continue_order":
-        st = user_state.get(uid)
-        if not st:
-            q.answer()
-            return
+    st["percent"] = int(text)
+    st["step"] = "discount_limit"
+    update.message.reply_text("🔢 تعداد استفاده:")
+
+
+@route("capture", "discount_limit", admin=True)
+def on_discount_limit(update: Update, context: CallbackContext, uid, text, st):
+    conn = get_conn()
+    cur = conn.cursor()
 
-        st["step"] = "postcode"
-        q.edit_message_text("📮 لطفاً کد پستی را وارد کنید:")
+    if not text.isdigit():
+        update.message.reply_text("❗ فقط عدد")
         return
-    
-    # ---------------- ADMIN APPROVAL ----------------
-    if q.data.startswith("admin_"):
 
-        # فقط ادمین
-        if uid != ADMIN_CHAT_ID:
-            q.answer("⛔ دسترسی ندارید", show_alert=True)
-            return
-            
-        _, action, order_no = q.data.split("_")
-        order = orders_runtime.get(order_no)
+    cur.execute("""
+        INSERT OR REPLACE INTO discount_codes (code, percent, max_use, used_count)
+        VALUES (?, ?, ?, 0)
+    """, (
+        st["code"],
+        st["percent"],
+        int(text)
+    ))
+    conn.commit()
 
-        if not order:
-            q.answer("❌ اطلاعات سفارش پیدا نشد", show_alert=True)
-            return
-        
+    update.message.reply_text("✅ کد تخفیف ساخته شد")
 
-        cur.execute("""
-            SELECT user_id, delivery_day, delivery_slot
-            FROM orders
-            WHERE order_no = ?
-        """, (order_no,))
-        row = cur.fetchone()
+    reset_user(uid)
 
-        if not row:
-            q.answer("❌ سفارش پیدا نشد", show_alert=True)
-            return
 
-        user_id = row[0]
+@route("capture", "discount_code")
+def on_discount_code(update: Update, context: CallbackContext, uid, text, st):
+    conn = get_conn()
+    cur = conn.cursor()
 
-        if action == "ok":
-            cur.execute("""
-                UPDATE orders
-                SET status = 'approved',
-                    payment_checked_at = ?
-                WHERE order_no = ?
-            """, (
-                datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"),
-                order_no
-            ))
-            conn.commit()
+    code = text.strip().upper()
 
-            delivery_text = (
-                "🚗 روش دریافت: ارسال"
-                if order["delivery_method"] == "delivery"
-                else f"🎒 روش دریافت: تحویل حضوری\n📍 آدرس: {PICKUP_ADDRESS_FULL}"
-            )
+    # ❌ کاربر کد ندارد (این باید همیشه اول چک شود)
 
-            approved_total_cutlery = sum(
-                i.get("cutlery_qty", 0) for i in order["items"]
-            )
+    if "ندارم" in code or "no" in code:
+        st["discount"] = 0
+        st["discount_code"] = None
 
-            foods_text = "\n".join(
-                f"🍽 {i['food_name']} × {i['qty']}"
-                for i in order["items"]
-            )
+        # محاسبه مبلغ
+        total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
+        total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
 
-            msg = (
-                "✅ سفارش شما تأیید شد 🙏\n\n"
-                "🧾 خلاصه سفارش:\n"
-                f"{foods_text}\n"
-                f"🥄 مجموع قاشق/چنگال: {approved_total_cutlery}\n"
-                f"📅 روز تحویل: {order['delivery_day']}\n"
-                f"⏰ بازه تحویل: {order['delivery_slot']}\n"
-                f"{delivery_text}\n"
-                f"🏠 آدرس: {order['address']}\n"
-                f"📞 تماس: {order['phone']}\n\n"
-                f"💶 مبلغ کل: €{order['total']}\n\n"
-                "🙏 ممنون از اعتماد شما"
-            )
+        st["discount_amount"] = 0
+        st["total"] = round(total, 2)
 
-            context.bot.send_message(user_id, msg)
-            q.edit_message_text(q.message.text + "\n\n✔️ تایید شد")
+        st["step"] = "payment"
+        send_payment_message(context, uid, st)
+        return
 
-            # ✅ فقط اینجا پاک کن
-            orders_runtime.pop(order_no, None)
-            q.answer("✅ انجام شد")
+    # فقط کدهای نامعتبر از سهمیه کم می‌کنند
+    if discount_limiter.exhausted(uid):
+        update.message.reply_text("⛔ تلاش بیش از حد. بعداً امتحان کنید")
+        return
 
-        else:
-            user_state[uid] = {
-                "step": "admin_cancel_reason",
-                "order_no": order_no,
-                "target_user": user_id
-            }
+    # ✅ بقیه کدها
+    cur.execute("""
+        SELECT percent, max_use, used_count
+        FROM discount_codes
+        WHERE code=?
+    """, (code,))
+    row = cur.fetchone()
+
+    if not row:
+        discount_limiter.check(uid)
+        update.message.reply_text("❌ کد نامعتبر")
+        return
 
-            q.edit_message_text(q.message.text + "\n\n📝 لطفاً دلیل لغو را بنویسید:")
+    percent, max_use, used = row
+    if used >= max_use:
+        update.message.reply_text("⛔ کد غیرفعال")
+        return
+
+                # ✅ مصرف فوری کد (حل مشکل)
+    cur.execute("""
+    UPDATE discount_codes
+    SET used_count = used_count + 1
+    WHERE code = ?
+    """, (code,))
+    conn.commit()
 
-            context.bot.send_message(uid, "✍️ لطفاً دلیل را بنویسید:")
+    # چک استفاده قبلی
+    cur.execute("""
+        SELECT 1 FROM discount_usage
+        WHERE user_id = ? AND code = ?
+    """, (uid, code))
+
+    if cur.fetchone():
+        st["step"] = "discount_code"
 
+        update.message.reply_text(
+            "⛔ شما قبلاً از این کد استفاده کرده‌اید\n\n"
+            "👉 اگر کد دیگری دارید وارد کنید\n"
+            "یا روی دکمه زیر بزنید 👇",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ کد ندارم", callback_data="no_discount")]
+            ])
+        )
         return
-    # ---------------- REMINDER ----------------
-    if q.data.startswith("remind_"):
-        _, target = q.data.split("_")
 
-        cur.execute("""
-            SELECT 
-                user_id,
-                food_name,
-                qty,
-                cutlery_qty,
-                delivery_day,
-                delivery_slot
-            FROM orders
-            WHERE delivery_day = ?
-              AND status = 'approved'
-            ORDER BY user_id
-        """, (
-            "دوشنبه" if target == "monday" else "پنج‌شنبه",
-        ))
-        rows = cur.fetchall()
+    if used >= max_use:
+        update.message.reply_text("⛔ کد غیرفعال")
+        return
 
-        if not rows:
-            q.edit_message_text("هیچ سفارش تأییدشده‌ای برای یادآوری وجود ندارد.")
-            return
+    # اعمال تخفیف
+    st["discount"] = percent
+    st["discount_code"] = code
 
-        orders_map = {}
+    # محاسبه مبلغ
+    total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
+    total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
 
-        for user_id, food, qty, cutlery, day, slot in rows:
-            key = (user_id, day, slot)
+    discount_amount = total * percent / 100
+    total = total - discount_amount
 
-            if key not in orders_map:
-                orders_map[key] = {
-                    "items": [],
-                    "day": day,
-                    "slot": slot
-                }
+    st["discount_amount"] = round(discount_amount, 2)
+    st["total"] = round(total, 2)
 
-            orders_map[key]["items"].append({
-                "food": food,
-                "qty": qty,
-                "cutlery": cutlery
-            })
+    update.message.reply_text(
+        f"✅ {percent}% تخفیف اعمال شد\n"
+        f"💰 مبلغ جدید: €{st['total']}"
+    )
 
-        sent = 0
+    send_payment_message(context, uid, st)
 
-        for (user_id, day, slot), data in orders_map.items():
-            delivery_label = f"فردا ({day})"
-            foods_text = "\n".join(
-                f"🍽 {i['food']} × {i['qty']} | 🥄 {i['cutlery']}"
-                for i in data["items"]
-            )
 
-            total_cutlery = sum(i["cutlery"] for i in data["items"])
+# فعال کردن پیام اضطراری
+@route("text", "⚠️ پیام اضطراری", admin=True)
+def on_emergency_start(update: Update, context: CallbackContext, uid, text, st):
+    update.message.reply_text("لطفاً متن پیام اضطراری را وارد کنید:")
+    user_state[uid] = {"step": "set_emergency"}
 
-            msg = (
-                "⏰ یادآوری تحویل غذا\n\n"
-                f"{foods_text}\n"
-                f"🥄 مجموع قاشق/چنگال: {total_cutlery}\n"
-                f"📅 تحویل: {delivery_label}\n"
-                f"⏰ بازه تحویل: {slot}\n\n"
-                "🙏 لطفاً در بازه انتخاب‌شده آماده باشید"
-            )
 
-            context.bot.send_message(user_id, msg)
-            sent += 1
+# حذف پیام اضطراری
+@route("text", "🟢 حذف پیام اضطراری", admin=True)
+def on_emergency_clear(update: Update, context: CallbackContext, uid, text, st):
+    global EMERGENCY_MESSAGE
+    EMERGENCY_MESSAGE = None
+    update.message.reply_text("🟢 پیام اضطراری حذف شد ، سفارش‌گیری فعال است")
 
-        q.edit_message_text(f"✅ یادآوری برای {sent} سفارش ارسال شد")
-        return
-    if q.data == "remind_cancel":
-        q.edit_message_text("❌ ارسال یادآوری لغو شد")
-        return
 
-# ---------- TEXT HANDLER ----------
-def handle_text(update: Update, context: CallbackContext):
+# دریافت متن پیام اضطراری
+@route("capture", "set_emergency", admin=True)
+def on_emergency_text(update: Update, context: CallbackContext, uid, text, st):
     global EMERGENCY_MESSAGE
-    global TEST_MODE
-    expire_pending_orders()
- 
-    uid = update.effective_user.id
-    text = update.message.text
-    st = user_state.get(uid)
-    if st and st.get("step") == "admin_cancel_reason":
-        reason = text
+    EMERGENCY_MESSAGE = text
+    reset_user(uid)
+    update.message.reply_text("⚠️ پیام اضطراری ثبت شد")
 
-        order_no = st["order_no"]
-        target_user = st["target_user"]
 
-        close_order(order_no, "canceled")
+# --- ADMIN: DISABLE TEST MODE ---
+@route("text", "⚪ غیرفعال‌کردن تست", admin=True)
+def on_test_mode_off(update: Update, context: CallbackContext, uid, text, st):
+    global TEST_MODE
+    TEST_MODE = False
+    update.message.reply_text("⚪ حالت تست غیرفعال شد")
 
-        # گرفتن نوع پرداخت از دیتابیس
-        cur.execute("SELECT payment_method FROM orders WHERE order_no = ?", (order_no,))
-        payment_method = cur.fetchone()[0]
 
-        if payment_method == "Cash":
-            msg = (
-                f"❌ سفارش شما لغو شد.\n\n"
-                f"📌 دلیل: {reason}\n\n"
-                "در صورت تمایل می‌توانید مجدداً سفارش ثبت کنید 🙏"
-            )
-        else:
-            msg = (
-                f"❌ سفارش شما لغو شد.\n\n"
-                f"📌 دلیل: {reason}\n\n"
-                "💰 در صورت پرداخت، مبلغ تا دقایقی دیگر بازگردانده می‌شود."
-            )
+# --- ADMIN: ENABLE TEST MODE ---
+@route("text", "🔵 فعال‌کردن تست", admin=True)
+def on_test_mode_on(update: Update, context: CallbackContext, uid, text, st):
+    global TEST_MODE
+    TEST_MODE = True
+    update.message.reply_text("🔵 حالت تست فعال شد")
 
-        context.bot.send_message(target_user, msg)
 
-        update.message.reply_text("✅ سفارش لغو شد و دلیل ارسال شد.")
+# --- REPORT (ADMIN ONLY) ---
+@route("text", "📊 ریپورت", "ریپورت", "report", "/report", admin=True)
+def on_sales_report(update: Update, context: CallbackContext, uid, text, st):
+    report, markup = build_report_page()
+    update.message.reply_text(report, reply_markup=markup)
 
-        reset_user(uid)
-        return
-        
-    if text == "❌ لغو سفارش":
-        reset_user(uid)
-        update.message.reply_text("سفارش لغو شد.", reply_markup=persistent_menu())
-        return
-    
-    
-    # --- ANALYTICS (ADMIN ONLY) ---
-    if uid == ADMIN_CHAT_ID and text == "📊 تحلیل رفتار":
 
-        cur.execute("""
-            SELECT action, COUNT(*) FROM logs
-            GROUP BY action
-        """)
-        rows = cur.fetchall()
+# --- ADMIN: RECONCILE STOCK / SLOT COUNTERS ---
+@route("text", "🧮 بازسازی موجودی", admin=True)
+def on_reconcile_counters(update: Update, context: CallbackContext, uid, text, st):
+    update.message.reply_text("⏳ بازسازی شمارنده‌ها شروع شد...")
+    run_admin_job(context.bot, uid, "reconcile", reconcile_and_report, context.bot, uid)
 
-        msg = "📊 تحلیل رفتار کاربران:\n\n"
 
-        for action, count in rows:
-            msg += f"{action} → {count}\n"
+def reconcile_and_report(bot, chat_id):
+    drift = reconcile_counters()
 
-        update.message.reply_text(msg)
+    if not drift:
+        bot.send_message(chat_id, "✅ شمارنده‌های موجودی و ظرفیت با سفارش‌ها یکسان است.")
         return
 
+    drift_text = "\n".join(
+        f"{day} | {key}: {old} → {new}" for day, key, old, new in drift
+    )
+    bot.send_message(
+        chat_id,
+        "🧮 شمارنده‌های موجودی و ظرفیت بازسازی شد.\n\n"
+        f"اختلاف‌ها:\n{drift_text}"
+    )
 
-    # --- BROADCAST (ADMIN ONLY) ---
-    if uid == ADMIN_CHAT_ID and text == "📣 ارسال پیام":
-        user_state[uid] = {"step": "broadcast"}
-        update.message.reply_text("✍️ متن پیام رو بفرست:")
-        return
 
+# --- ADMIN: BACKFILL SALES ROLLUPS ---
+@route("text", "📈 بازسازی آمار", admin=True)
+def on_rebuild_rollups(update: Update, context: CallbackContext, uid, text, st):
+    update.message.reply_text("⏳ بازسازی آمار فروش شروع شد...")
+    run_admin_job(context.bot, uid, "rebuild_rollups", rebuild_and_report, context.bot, uid)
 
-    if st and st.get("step") == "broadcast":
 
-        msg = text
+def rebuild_and_report(bot, chat_id):
+    rebuild_sales_rollups()
+    bot.send_message(chat_id, "✅ جدول‌های آمار فروش از روی سفارش‌ها بازسازی شد.")
 
-        cur.execute("SELECT user_id FROM users")
-        users = cur.fetchall()
 
-        sent = 0
+# --- SLOT CAPACITY (ADMIN ONLY) ---
+@route("text", "⏰ ظرفیت بازه‌ها", admin=True)
+def on_slot_capacity_start(update: Update, context: CallbackContext, uid, text, st):
+    user_state[uid] = {"step": "slot_capacity"}
+    update.message.reply_text(
+        f"{slot_capacity_text()}\n\n"
+        "✍️ روز، شروع بازه (یا all) و ظرفیت را بنویسید:\n"
+        "مثلاً: monday 12:30 5\n"
+        "یا: thursday all 4"
+    )
 
-        for u in users:
-            try:
-                context.bot.send_message(u[0], msg)
-                sent += 1
-            except:
-                pass
 
-        update.message.reply_text(f"✅ پیام به {sent} نفر ارسال شد")
+@route("capture", "slot_capacity", admin=True)
+def on_slot_capacity(update: Update, context: CallbackContext, uid, text, st):
+    parts = text.split()
+    starts = {start for start, _ in get_delivery_slots()}
 
-        reset_user(uid)
-        return
-    
-    if uid == ADMIN_CHAT_ID and text == "🎁 مدیریت تخفیف":
-        user_state[uid] = {"step": "discount_code_create"}
-        update.message.reply_text("✍️ کد تخفیف را وارد کنید:")
+    if (
+        len(parts) != 3
+        or parts[0] not in DELIVERY_DAY_FA
+        or (parts[1] != "all" and parts[1] not in starts)
+        or not parts[2].isdigit()
+    ):
+        update.message.reply_text("❗ قالب: monday 12:30 5")
         return
 
-    # حذف کد تخفیف
-    if uid == ADMIN_CHAT_ID and text == "❌ حذف کد تخفیف":
-        user_state[uid] = {"step": "delete_discount"}
-        update.message.reply_text("🗑 کد موردنظر را وارد کنید:")
-        return
+    day = DELIVERY_DAY_FA[parts[0]]
+    slots = set_slot_capacity(day, starts if parts[1] == "all" else {parts[1]}, int(parts[2]))
 
-    if st and st.get("step") == "delete_discount":
-        code = text.upper()
+    update.message.reply_text(f"✅ ظرفیت {len(slots)} بازه در {day} → {parts[2]}")
+    reset_user(uid)
 
-        cur.execute("SELECT 1 FROM discount_codes WHERE code = ?", (code,))
-        exists = cur.fetchone()
 
-        if not exists:
-            update.message.reply_text("❌ چنین کدی وجود ندارد")
-            return
+# --- SYSTEM STATUS (ADMIN ONLY) ---
+@route("text", "📈 وضعیت سیستم", admin=True)
+def on_system_status(update: Update, context: CallbackContext, uid, text, st):
+    update.message.reply_text(system_status_text())
 
-        cur.execute("DELETE FROM discount_codes WHERE code = ?", (code,))
-        conn.commit()
 
-        update.message.reply_text("✅ کد حذف شد")
-        reset_user(uid)
-        return
-    
-    if st and st.get("step") == "discount_code_create":
-        st["code"] = text.upper()
-        st["step"] = "discount_percent"
-        update.message.reply_text("📊 درصد تخفیف (مثلاً 15):")
-        return
-    
-    if st and st.get("step") == "discount_percent":
-        if not text.isdigit():
-            update.message.reply_text("❗ فقط عدد")
-            return
+@route("text", "🗄 آمار SQL", admin=True)
+def on_sql_stats(update: Update, context: CallbackContext, uid, text, st):
+    update.message.reply_text(sql_stats_text())
+
 
-        st["percent"] = int(text)
-        st["step"] = "discount_limit"
-        update.message.reply_text("🔢 تعداد استفاده:")
+def sql_command(update: Update, context: CallbackContext):
+    # /sql
+    if update.effective_user.id != ADMIN_CHAT_ID:
         return
-    
 
-    if st and st.get("step") == "discount_limit":
-        if not text.isdigit():
-            update.message.reply_text("❗ فقط عدد")
-            return
+    update.message.reply_text(sql_stats_text())
 
-        cur.execute("""
-            INSERT OR REPLACE INTO discount_codes (code, percent, max_use, used_count)
-            VALUES (?, ?, ?, 0)
-        """, (
-            st["code"],
-            st["percent"],
-            int(text)
-        ))
-        conn.commit()
 
-        update.message.reply_text("✅ کد تخفیف ساخته شد")
+# --- MENU CATALOG (ADMIN ONLY) ---
+@route("text", "🍽 ویرایش منو", admin=True)
+def on_menu_edit(update: Update, context: CallbackContext, uid, text, st):
+    user_state[uid] = {"step": "menu_upload"}
+    context.bot.send_document(
+        uid,
+        document=menu_catalog_json().encode("utf-8"),
+        filename="menu.json",
+        caption=(
+            "🍽 منوی فعلی\n\n"
+            "فایل را ویرایش و به‌صورت فایل JSON ارسال کنید.\n"
+            "کل منو در یک مرحله جایگزین می‌شود."
+        )
+    )
+
 
-        reset_user(uid)
-        return
-    
-    if st and st.get("step") == "discount_code":
-        code = text.strip().upper()
-        attempts = user_discount_attempts.get(uid, 0)
+# --- EXPORT (ADMIN ONLY) ---
+@route("text", "📤 خروجی داده", admin=True)
+def on_export_menu(update: Update, context: CallbackContext, uid, text, st):
+    update.message.reply_text(
+        "📤 نوع خروجی را انتخاب کنید:\n\n"
+        "برای بازه دلخواه:\n/export orders csv 2024-01-01 2024-02-01 approved",
+        reply_markup=export_keyboard()
+    )
 
-        if attempts >= 5:
-            update.message.reply_text("⛔ تلاش بیش از حد. بعداً امتحان کنید")
-            return
 
-        # ❌ کاربر کد ندارد (این باید همیشه اول چک شود)
+# --- REPORT TOMORROW FOOD ---
+@route("text", "📊 گزارش فردا", admin=True)
+def on_tomorrow_report(update: Update, context: CallbackContext, uid, text, st):
+    conn = get_conn()
+    cur = conn.cursor()
+
+    target = get_target_delivery_day()
+
+    if target == "monday":
+        day_fa = "دوشنبه"
+    elif target == "thursday":
+        day_fa = "پنج‌شنبه"
+    else:
+        update.message.reply_text("امروز گزارش فعالی وجود ندارد.")
+        return
+
+    cur.execute("""
+        SELECT food_name, SUM(qty), SUM(cutlery_qty)
+        FROM rollup_food
+        WHERE delivery_day = ?
+        AND status != 'canceled'
+        GROUP BY food_name
+        HAVING SUM(qty) > 0
+    """, (day_fa,))
 
-        if "ندارم" in code or "no" in code:
-            st["discount"] = 0
-            st["discount_code"] = None
+    rows = cur.fetchall()
 
-            # محاسبه مبلغ
-            total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
-            total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
+    if not rows:
+        update.message.reply_text("هیچ سفارشی ثبت نشده است.")
+        return
 
-            st["discount_amount"] = 0
-            st["total"] = round(total, 2)
+    foods_text = ""
+    total_cutlery = 0
+    total_orders = 0
 
-            # پاک کردن attempts
-            user_discount_attempts.pop(uid, None)
-            st["step"] = "payment"
-            send_payment_message(context, uid, st)
-            return
+    for food, qty, cutlery in rows:
+        foods_text += f"{food}: {qty}\n"
+        total_cutlery += cutlery or 0
+        total_orders += qty
 
-        # ✅ بقیه کدها
-        cur.execute("""
-            SELECT percent, max_use, used_count
-            FROM discount_codes
-            WHERE code=?
-        """, (code,))
-        row = cur.fetchone()
+    msg = (
+        f"📊 گزارش غذا برای تحویل {day_fa}\n\n"
+        f"{foods_text}\n"
+        f"🥄 مجموع قاشق/چنگال: {total_cutlery}\n"
+        f"📦 مجموع غذاها: {total_orders}"
+    )
 
-        if not row:
-            user_discount_attempts[uid] = attempts + 1
-            update.message.reply_text("❌ کد نامعتبر")
-            return
+    update.message.reply_text(msg)
 
-        percent, max_use, used = row
-        if used >= max_use:
-            update.message.reply_text("⛔ کد غیرفعال")
-            return
 
-                    # ✅ مصرف فوری کد (حل مشکل)
-        cur.execute("""
-        UPDATE discount_codes
-        SET used_count = used_count + 1
-        WHERE code = ?
-        """, (code,))
-        conn.commit()
+# --- ANALYTICS (ADMIN ONLY) ---
+@route("text", "📊 تحلیل", admin=True)
+def on_sales_analytics(update: Update, context: CallbackContext, uid, text, st):
+    conn = get_conn()
+    cur = conn.cursor()
 
-        # چک استفاده قبلی
-        cur.execute("""
-            SELECT 1 FROM discount_usage
-            WHERE user_id = ? AND code = ?
-        """, (uid, code))
-
-        if cur.fetchone():
-            st["step"] = "discount_code"
-
-            update.message.reply_text(
-                "⛔ شما قبلاً از این کد استفاده کرده‌اید\n\n"
-                "👉 اگر کد دیگری دارید وارد کنید\n"
-                "یا روی دکمه زیر بزنید 👇",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ کد ندارم", callback_data="no_discount")]
-                ])
-            )
-            return
+    # 1. غذای پرفروش
+    cur.execute("""
+        SELECT food_name, SUM(qty)
+        FROM rollup_food
+        WHERE status = 'approved'
+        GROUP BY food_name
+        HAVING SUM(qty) > 0
+        ORDER BY SUM(qty) DESC
+    """)
+    foods = cur.fetchall()
 
-        if used >= max_use:
-            update.message.reply_text("⛔ کد غیرفعال")
-            return
+    food_text = "\n".join(
+        f"{name} → {qty}" for name, qty in foods
+    ) or "ندارد"
 
-        # اعمال تخفیف
-        st["discount"] = percent
-        st["discount_code"] = code
+    # 2. تایم محبوب
+    cur.execute("""
+        SELECT delivery_slot, SUM(orders)
+        FROM rollup_slot
+        WHERE status = 'approved'
+        GROUP BY delivery_slot
+        HAVING SUM(orders) > 0
+        ORDER BY SUM(orders) DESC
+    """)
+    slots = cur.fetchall()
 
-        # محاسبه مبلغ
-        total_cutlery = sum(i.get("cutlery_qty", 0) for i in st["items"])
-        total = st["food_total"] + (total_cutlery * CUTLERY_PRICE)
+    slot_text = "\n".join(
+        f"{slot} → {count}" for slot, count in slots
+    ) or "ندارد"
 
-        discount_amount = total * percent / 100
-        total = total - discount_amount
+    # 3. روز پرفروش
+    cur.execute("""
+        SELECT delivery_day, SUM(orders)
+        FROM rollup_status
+        WHERE status = 'approved'
+        GROUP BY delivery_day
+        HAVING SUM(orders) > 0
+    """)
+    days = cur.fetchall()
+
+    day_text = "\n".join(
+        f"{day} → {count}" for day, count in days
+    ) or "ندارد"
+
+    # ارسال گزارش
+    msg = (
+        "📊 تحلیل فروش:\n\n"
+        "🍽 غذای پرفروش:\n"
+        f"{food_text}\n\n"
+        "⏰ تایم‌های محبوب:\n"
+        f"{slot_text}\n\n"
+        "📅 روزها:\n"
+        f"{day_text}"
+    )
 
-        st["discount_amount"] = round(discount_amount, 2)
-        st["total"] = round(total, 2)
+    update.message.reply_text(msg)
 
-        update.message.reply_text(
-            f"✅ {percent}% تخفیف اعمال شد\n"
-            f"💰 مبلغ جدید: €{st['total']}"
-        )
 
-        send_payment_message(context, uid, st)
-        return
-                        
-    
-    # ---------- ANTI-SPAM CHECK ----------
-    now = time.time()
+# --- ADMIN: SEND DELIVERY REMINDER ---
+@route("text", "📣 ارسال یادآوری تحویل", admin=True)
+def on_delivery_reminder(update: Update, context: CallbackContext, uid, text, st):
+    target = get_target_delivery_day()
 
-    # اگر کاربر سابقه ندارد → مقدار اولیه بساز
-    if uid not in user_last_msgs:
-        user_last_msgs[uid] = now
-        user_msg_count[uid] = 1
+    if target == "monday":
+        day_fa = "دوشنبه"
+    elif target == "thursday":
+        day_fa = "پنج‌شنبه"
     else:
-        # اگر پیام جدید در فاصله کوتاه ارسال شده
-        if now - user_last_msgs[uid] <= SPAM_WINDOW:
-            user_msg_count[uid] += 1
-        else:
-            # اگر فاصله زیاد بود → شمارنده ریست شود
-            user_msg_count[uid] = 1
+        update.message.reply_text("امروز روز تحویل نیست.")
+        return
 
-        # آخرین زمان پیام آپدیت شود
-        user_last_msgs[uid] = now
+    update.message.reply_text(
+        f"📣 ارسال پیام یادآوری برای تحویل {day_fa}\n"
+        "آیا مطمئن هستید؟",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ بله، ارسال کن", callback_data=f"remind_{target}")],
+            [InlineKeyboardButton("❌ لغو", callback_data="remind_cancel")]
+        ])
+    )
 
-    # اگر کاربر بیشتر از حد مجاز پیام بده
-    if uid != ADMIN_CHAT_ID and user_msg_count[uid] > SPAM_LIMIT:
-        update.message.reply_text("⚠️ لطفاً پیام‌ها را پشت‌سرهم ارسال نکنید 🙏")
-        return
-    
 
+# MENU
+@route("text", "🍽 شروع سفارش")
+def on_start_order(update: Update, context: CallbackContext, uid, text, st):
     # اگر پیام اضطراری فعال است، اجازه شروع سفارش نده
-    if EMERGENCY_MESSAGE and text == "🍽 شروع سفارش":
+    if EMERGENCY_MESSAGE:
         update.message.reply_text(EMERGENCY_MESSAGE)
         return
 
-    # فعال کردن پیام اضطراری
-    if uid == ADMIN_CHAT_ID and text == "⚠️ پیام اضطراری":
-        update.message.reply_text("لطفاً متن پیام اضطراری را وارد کنید:")
-        user_state[uid] = {"step": "set_emergency"}
+    log_event(uid, "start_order")
+    
+    if not is_user_member(context.bot, uid):
+        update.message.reply_text(
+            "📢 برای ثبت سفارش، ابتدا عضو کانال ما شوید 👇",
+            reply_markup=JOIN_CHANNEL_KEYBOARD
+        )
         return
-
-    # حذف پیام اضطراری
-    if uid == ADMIN_CHAT_ID and text == "🟢 حذف پیام اضطراری":
-        EMERGENCY_MESSAGE = None
-        update.message.reply_text("🟢 پیام اضطراری حذف شد ، سفارش‌گیری فعال است")
+        
+    if not is_working_time():
+        update.message.reply_text(
+        "📦 سفارش‌گیری بسته است.\n\n"
+        "🗓 لطفاً در روز و ساعت مجاز پیش‌سفارش اقدام فرمایید."
+        )
         return
 
-    # دریافت متن پیام اضطراری
-    if st and st.get("step") == "set_emergency":
-        EMERGENCY_MESSAGE = text
-        reset_user(uid)
-        update.message.reply_text("⚠️ پیام اضطراری ثبت شد")
-        return
+    target = get_target_delivery_day()
 
-    
-    # --- ADMIN: DISABLE TEST MODE ---
-    if uid == ADMIN_CHAT_ID and "تست" in text and "غیر" in text:
-        TEST_MODE = False
-        update.message.reply_text("⚪ حالت تست غیرفعال شد")
-        return
+    if target == "monday":
+        delivery_day = "دوشنبه"
+    elif target == "thursday":
+        delivery_day = "پنج‌شنبه"
+    else:
+        delivery_day = None
+
+    user_state[uid] = {
+        "step": "qty",
+        "items": [],
+        "delivery_day": delivery_day,
+        "created_at": datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M")
+    }
+    target = get_target_delivery_day()
 
-    # --- ADMIN: ENABLE TEST MODE ---
-    if uid == ADMIN_CHAT_ID and "تست" in text and "فعال" in text:
-        TEST_MODE = True
-        update.message.reply_text("🔵 حالت تست فعال شد")
+    if target == "monday":
+        day_name = "دوشنبه"
+    elif target == "thursday":
+        day_name = "پنج‌شنبه"
+    else:
+        update.message.reply_text("امکان ثبت سفارش در حال حاضر وجود ندارد.")
         return
 
+    update.message.reply_text(
+        "🎉 هدیه ویژه برای مشتریان جدید\n"
+        "🍮 با اولین سفارش یک فرنی رایگان دریافت کنید\n\n"
+        f"📋 منوی {day_name}\n"
+        f"⏰ لطفاً سفارش خود را قبل از روز تحویل ثبت کنید:"
+    )
 
-    # --- REPORT (ADMIN ONLY) ---
-    if uid == ADMIN_CHAT_ID and text.strip() in ["📊 ریپورت", "ریپورت", "report", "/report"]:
-        cur.execute("SELECT * FROM orders ORDER BY id DESC")
-        rows = cur.fetchall()
+    update.message.reply_text(
+    "لطفاً انتخاب کنید:",
+        reply_markup=food_keyboard()
+    )
 
-        if not rows:
-            update.message.reply_text("هیچ سفارشی ثبت نشده است.")
-            return
 
-        report = "📊 گزارش فروش:\n\n"
-        for r in rows:
-            report += (
-                f"📌 سفارش: {r[1]}\n"
-                f"👤 کاربر: {r[2]}\n"
-                f"🍽 غذا: {r[4]} × {r[5]}\n"
-                f"🥄 قاشق/چنگال: {r[6]}\n"
-                f"💳 پرداخت: {r[9]}\n"
-                f"💶 مبلغ: €{r[7]}\n"
-                f"📅 زمان: {r[10]}\n"
-                f"📦 وضعیت: {r[8]}\n"
-                "---------------------------\n"
-            )
+# CONTACT
+@route("text", "📞 تماس با ما")
+def on_contact(update: Update, context: CallbackContext, uid, text, st):
+    update.message.reply_text(
+        "ارتباط مستقیم:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("💬 چت تلگرام", url=f"https://t.me/{CONTACT_USERNAME}")]
+        ])
+    )
 
-        update.message.reply_text(report)
+
+# QTY
+@route("step", "qty")
+def on_qty(update: Update, context: CallbackContext, uid, text, st):
+    text = normalize_digits(text)
+    if not text.isdigit():
+        update.message.reply_text("لطفاً فقط عدد وارد کنید.")
         return
 
-    # --- REPORT TOMORROW FOOD ---
-    if uid == ADMIN_CHAT_ID and text == "📊 گزارش فردا":
+    qty = int(text)
+    item = st["current_item"]
+    # تعداد این غذا داخل همین سفارش فعلی
+    already_in_cart = sum(
+        i["qty"] for i in st["items"]
+        if i["food_key"] == item["food_key"]
+    )
 
-        target = get_target_delivery_day()
+    # روز تحویل هنوز انتخاب نشده ← روز هدف فعلی
+    delivery_day = st.get("delivery_day") or DELIVERY_DAY_FA.get(get_target_delivery_day())
+    remaining = get_remaining_stock(item["food_key"], delivery_day)
 
-        if target == "monday":
-            day_fa = "دوشنبه"
-        elif target == "thursday":
-            day_fa = "پنج‌شنبه"
+    remaining -= already_in_cart
+   
+# جلوگیری از فروش بیشتر از ظرفیت روزانه
+    if qty > remaining:
+        if remaining <= 0:
+            update.message.reply_text(f"🚫 موجودی {item['food_name']} تمام شد!")
         else:
-            update.message.reply_text("امروز گزارش فعالی وجود ندارد.")
-            return
+            update.message.reply_text(f"⚠️ فقط {remaining} عدد {item['food_name']} باقی مانده است.")
+        return
 
-        cur.execute("""
-            SELECT food_name, SUM(qty), SUM(cutlery_qty)
-            FROM orders
-            WHERE delivery_day = ?
-            AND status != 'canceled'
-            GROUP BY food_name
-        """, (day_fa,))
+    capacity = get_food_capacity(item["food_key"], delivery_day)
+    if qty <= 0 or qty > capacity:
+        update.message.reply_text(f"حداکثر سفارش: {capacity}")
+        return
 
-        rows = cur.fetchall()
+    item = st["current_item"]
+    item["qty"] = qty
+    item["food_total"] = qty * item["price"]
+    item["cutlery_qty"] = None
 
-        if not rows:
-            update.message.reply_text("هیچ سفارشی ثبت نشده است.")
-            return
+    st["items"].append(item)
+    st.pop("current_item")
 
-        foods_text = ""
-        total_cutlery = 0
-        total_orders = 0
+    st["food_total"] = sum(i["food_total"] for i in st["items"])
+    st["step"] = "cutlery_choice"
 
-        for food, qty, cutlery in rows:
-            foods_text += f"{food}: {qty}\n"
-            total_cutlery += cutlery or 0
-            total_orders += qty
+    update.message.reply_text(
+        f"🥄 نیاز به قاشق/چنگال دارید؟ (هر عدد: €{CUTLERY_PRICE})",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("بله", callback_data="cutlery_yes"),
+             InlineKeyboardButton("خیر", callback_data="cutlery_no")]
+        ])
+    )
 
-        msg = (
-            f"📊 گزارش غذا برای تحویل {day_fa}\n\n"
-            f"{foods_text}\n"
-            f"🥄 مجموع قاشق/چنگال: {total_cutlery}\n"
-            f"📦 مجموع غذاها: {total_orders}"
-        )
 
-        update.message.reply_text(msg)
+# CUTLERY QTY
+@route("step", "cutlery_qty")
+def on_cutlery_qty(update: Update, context: CallbackContext, uid, text, st):
+    text = normalize_digits(text)
+    if not text.isdigit():
+        update.message.reply_text("لطفاً فقط عدد وارد کنید.")
         return
-    
-    # --- ANALYTICS (ADMIN ONLY) ---
-    if uid == ADMIN_CHAT_ID and text == "📊 تحلیل":
 
-        # 1. غذای پرفروش
-        cur.execute("""
-            SELECT food_name, SUM(qty)
-            FROM orders
-            WHERE status = 'approved'
-            GROUP BY food_name
-            ORDER BY SUM(qty) DESC
-        """)
-        foods = cur.fetchall()
+    c = int(text)
 
-        food_text = "\n".join(
-            f"{name} → {qty}" for name, qty in foods
-        ) or "ندارد"
+# محدودیت تعداد قاشق/چنگال
+    current_qty = st["items"][-1]["qty"]
 
-        # 2. تایم محبوب
-        cur.execute("""
-            SELECT delivery_slot, COUNT(*)
-            FROM orders
-            WHERE status = 'approved'
-            GROUP BY delivery_slot
-            ORDER BY COUNT(*) DESC
-        """)
-        slots = cur.fetchall()
+    if c < 0 or c > current_qty:
+        update.message.reply_text("❗ تعداد قاشق/چنگال نمی‌تواند بیشتر از تعداد همین غذا باشد.")
+        return
 
-        slot_text = "\n".join(
-            f"{slot} → {count}" for slot, count in slots
-        ) or "ندارد"
+    st["items"][-1]["cutlery_qty"] = c
+    st["step"] = "ask_more"
 
-        # 3. روز پرفروش
-        cur.execute("""
-            SELECT delivery_day, COUNT(*)
-            FROM orders
-            WHERE status = 'approved'
-            GROUP BY delivery_day
-        """)
-        days = cur.fetchall()
+    update.message.reply_text(
+        "🛒 آیا سفارش دیگری دارید؟",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("➕ سفارش دیگر", callback_data="more_order")],
+            [InlineKeyboardButton("✅ ادامه خرید", callback_data="continue_order")]
+        ])
+    )
 
-        day_text = "\n".join(
-            f"{day} → {count}" for day, count in days
-        ) or "ندارد"
 
-        # ارسال گزارش
-        msg = (
-            "📊 تحلیل فروش:\n\n"
-            "🍽 غذای پرفروش:\n"
-            f"{food_text}\n\n"
-            "⏰ تایم‌های محبوب:\n"
-            f"{slot_text}\n\n"
-            "📅 روزها:\n"
-            f"{day_text}"
-        )
+# POSTCODE
+@route("step", "postcode")
+def on_postcode(update: Update, context: CallbackContext, uid, text, st):
+    pc = normalize_digits(text)
 
-        update.message.reply_text(msg)
+    if not pc.isdigit() or len(pc) != 5:
+        update.message.reply_text("📮 کد پستی باید دقیقاً ۵ رقم و فقط عدد باشد.")
         return
 
-    
-    # --- ADMIN: SEND DELIVERY REMINDER ---
-    if uid == ADMIN_CHAT_ID and text == "📣 ارسال یادآوری تحویل":
-        target = get_target_delivery_day()
-
-        if target == "monday":
-            day_fa = "دوشنبه"
-        elif target == "thursday":
-            day_fa = "پنج‌شنبه"
-        else:
-            update.message.reply_text("امروز روز تحویل نیست.")
-            return
+    st["postcode"] = pc
 
-        update.message.reply_text(
-            f"📣 ارسال پیام یادآوری برای تحویل {day_fa}\n"
-            "آیا مطمئن هستید؟",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ بله، ارسال کن", callback_data=f"remind_{target}")],
-                [InlineKeyboardButton("❌ لغو", callback_data="remind_cancel")]
-            ])
-        )
-        return    
-
-       
-    # MENU
-    if text == "🍽 شروع سفارش":
-        cur.execute(
-            "INSERT INTO logs (user_id, action, created_at) VALUES (?, ?, ?)",
-            (uid, "start_order", datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M"))
-        )
-        conn.commit()
-        
-        if not is_user_member(context.bot, uid):
-            update.message.reply_text(
-                "📢 برای ثبت سفارش، ابتدا عضو کانال ما شوید 👇",
-                reply_markup=join_channel_keyboard()
-            )
-            return
-            
-        if not is_working_time():
-            update.message.reply_text(
-            "📦 سفارش‌گیری بسته است.\n\n"
-            "🗓 لطفاً در روز و ساعت مجاز پیش‌سفارش اقدام فرمایید."
-            )
-            return
+    if pc == "30163":
+        st["delivery_method"] = "delivery"
+        st["step"] = "fullname"
+        update.message.reply_text("👤 لطفاً نام کامل وارد کنید:")
+        return
 
-        target = get_target_delivery_day()
+    if pc == "30165":
+        st["delivery_method"] = "check_street"
+        st["step"] = "street"
+        update.message.reply_text("📌 لطفاً نام خیابان را وارد کنید:")
+        return
 
-        if target == "monday":
-            delivery_day = "دوشنبه"
-        elif target == "thursday":
-            delivery_day = "پنج‌شنبه"
-        else:
-            delivery_day = None
+    st["delivery_method"] = "pickup"
+    st["step"] = "pickup_confirm"
+    update.message.reply_text(
+        f"🚫 خارج از محدوده ارسال.\n"
+        f"🎒 تحویل حضوری از: {PICKUP_ADDRESS_SHORT}\n"
+        "می‌خواهید ادامه دهید؟",
+        reply_markup=PICKUP_KEYBOARD
+    )
 
-        user_state[uid] = {
-            "step": "qty",
-            "items": [],
-            "delivery_day": delivery_day,
-            "created_at": datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M")
-        }
-        target = get_target_delivery_day()
 
-        if target == "monday":
-            day_name = "دوشنبه"
-        elif target == "thursday":
-            day_name = "پنج‌شنبه"
-        else:
-            update.message.reply_text("امکان ثبت سفارش در حال حاضر وجود ندارد.")
-            return
+# STREET CHECK
+@route("step", "street")
+def on_street(update: Update, context: CallbackContext, uid, text, st):
+    street = text.lower().replace("ß", "ss").replace(" ", "")
+    valid = False
 
-        update.message.reply_text(
-            "🎉 هدیه ویژه برای مشتریان جدید\n"
-            "🍮 با اولین سفارش یک فرنی رایگان دریافت کنید\n\n"
-            f"📋 منوی {day_name}\n"
-            f"⏰ لطفاً سفارش خود را قبل از روز تحویل ثبت کنید:"
-        )
+    for s in LOCAL_STREETS_30165:
+        if street == s.lower().replace(" ", ""):
+            valid = True
+            break
 
-        update.message.reply_text(
-        "لطفاً انتخاب کنید:",
-            reply_markup=food_keyboard()
-        )
+    if valid:
+        st["delivery_method"] = "delivery"
+        st["step"] = "fullname"
+        update.message.reply_text("👤 لطفاً نام کامل وارد کنید:")
         return
 
-    # CANCEL
-    if text == "❌ لغو سفارش":
-        reset_user(uid)
-        update.message.reply_text("سفارش لغو شد.", reply_markup=persistent_menu())
-        return
+    st["delivery_method"] = "pickup"
+    st["step"] = "pickup_confirm"
+    update.message.reply_text(
+        "🚫 این خیابان در محدوده نیست.\n"
+        f"🎒 تحویل حضوری از {PICKUP_ADDRESS_SHORT}",
+        reply_markup=PICKUP_KEYBOARD
+    )
 
-    # CONTACT
-    if text == "📞 تماس با ما":
+
+# FULLNAME
+@route("step", "fullname")
+def on_fullname(update: Update, context: CallbackContext, uid, text, st):
+    st["fullname"] = text
+    st["step"] = "phone"
+    update.message.reply_text("📞 لطفاً شماره تماس را وارد کنید:")
+
+
+# PHONE
+@route("step", "phone")
+def on_phone(update: Update, context: CallbackContext, uid, text, st):
+    phone = normalize_digits(text)
+
+    if not phone.isdigit() or len(phone) < 8 or len(phone) > 15:
         update.message.reply_text(
-            "ارتباط مستقیم:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("💬 چت تلگرام", url=f"https://t.me/{CONTACT_USERNAME}")]
-            ])
+        "📞 لطفاً شماره تماس معتبر وارد کنید.\n"
+        "✔️ فقط عدد\n"
+        "✔️ حداقل ۸ رقم"
         )
         return
 
-    # NO STATE
-    if not st:
-        update.message.reply_text("برای شروع از منوی پایین استفاده کنید.")
+    st["phone"] = phone
+
+    if st["delivery_method"] == "delivery":
+        st["step"] = "address"
+        update.message.reply_text("🏠 لطفاً آدرس کامل را وارد کنید:")
         return
+    else:
+        st["address"] = "تحویل حضوری"
+        st["step"] = "delivery_slot"
 
-    # QTY
-    if st["step"] == "qty":
-        text = normalize_digits(text)
-        if not text.isdigit():
-            update.message.reply_text("لطفاً فقط عدد وارد کنید.")
-            return
+        target = get_target_delivery_day()
+        if target == "monday":
+            st["delivery_day"] = "دوشنبه"
+        elif target == "thursday":
+            st["delivery_day"] = "پنج‌شنبه"
 
-        qty = int(text)
-        item = st["current_item"]
-        # تعداد این غذا داخل همین سفارش فعلی
-        already_in_cart = sum(
-            i["qty"] for i in st["items"]
-            if i["food_key"] == item["food_key"]
+        update.message.reply_text(
+            f"⏰ لطفاً بازه زمانی تحویل غذا برای {st['delivery_day']} را انتخاب کنید:",
+            reply_markup=delivery_slot_keyboard(st["delivery_day"])
         )
+        return
 
-        remaining = get_remaining_stock(
-            item["food_key"],
-            st.get("delivery_day")
-        )
 
-        remaining -= already_in_cart
-       
-    # جلوگیری از فروش بیشتر از ظرفیت روزانه
-        if qty > remaining:
-            if remaining <= 0:
-                update.message.reply_text(f"🚫 موجودی {item['food_name']} تمام شد!")
-            else:
-                update.message.reply_text(f"⚠️ فقط {remaining} عدد {item['food_name']} باقی مانده است.")
-            return
+# ADDRESS
+@route("step", "address")
+def on_address(update: Update, context: CallbackContext, uid, text, st):
+    st["address"] = text
+    st["step"] = "delivery_slot"
 
-        if qty <= 0 or qty > MAX_DAILY:
-            update.message.reply_text(f"حداکثر سفارش: {MAX_DAILY}")
-            return
+    target = get_target_delivery_day()
+    if target == "monday":
+        st["delivery_day"] = "دوشنبه"
+    elif target == "thursday":
+        st["delivery_day"] = "پنج‌شنبه"
+    else:
+        update.message.reply_text("امکان ثبت سفارش در حال حاضر وجود ندارد.")
+        reset_user(uid)
+        return
 
-        item = st["current_item"]
-        item["qty"] = qty
-        item["food_total"] = qty * item["price"]
-        item["cutlery_qty"] = None
+    update.message.reply_text(
+        f"⏰ لطفاً بازه زمانی تحویل غذا برای {st['delivery_day']} را انتخاب کنید:",
+        reply_markup=delivery_slot_keyboard(st["delivery_day"])
+    )
+    return
 
-        st["items"].append(item)
-        st.pop("current_item")
 
-        st["food_total"] = sum(i["food_total"] for i in st["items"])
-        st["step"] = "cutlery_choice"
+# ---------- TEXT HANDLER ----------
+def handle_text(update: Update, context: CallbackContext):
+    uid = update.effective_user.id
+    text = update.message.text
+    st = user_state.get(uid)
 
-        update.message.reply_text(
-            f"🥄 نیاز به قاشق/چنگال دارید؟ (هر عدد: €{CUTLERY_PRICE})",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("بله", callback_data="cutlery_yes"),
-                 InlineKeyboardButton("خیر", callback_data="cutlery_no")]
-            ])
-        )
+    handler = resolve_text_route(uid, text, st)
+    if handler:
+        set_sql_route(handler.__name__.removeprefix("on_"))
+        handler(update, context, uid, text, st)
         return
 
-    # CUTLERY QTY
-    if st["step"] == "cutlery_qty":
-        text = normalize_digits(text)
-        if not text.isdigit():
-            update.message.reply_text("لطفاً فقط عدد وارد کنید.")
-            return
-
-        c = int(text)
+    # NO STATE
+    if not st:
+        update.message.reply_text("برای شروع از منوی پایین استفاده کنید.")
 
-    # محدودیت تعداد قاشق/چنگال
-        current_qty = st["items"][-1]["qty"]
 
-        if c < 0 or c > current_qty:
-            update.message.reply_text("❗ تعداد قاشق/چنگال نمی‌تواند بیشتر از تعداد همین غذا باشد.")
-            return
+# ----------- UPDATE SCHEDULER -----------
+# آپدیت‌های هر کاربر همیشه به یک shard می‌روند: برای یک کاربر به ترتیب و تک‌به‌تک
+# (دوبار زدن pay_cash با هم اجرا نمی‌شود) ، کاربرهای مختلف موازی
+class UpdateScheduler:
+    def __init__(self, process, shards):
+        self.process = process
+        self.queues = [queue.Queue() for _ in range(shards)]
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=2000)     # زمان انتظار اخیر (ثانیه)
+        self.processed = 0
+        self.max_wait = 0
+        self.threads = []
+
+    def submit(self, update):
+        user = getattr(update, "effective_user", None)
+        chat = getattr(update, "effective_chat", None)
+        key = user.id if user else chat.id if chat else 0
+        self.queues[key % len(self.queues)].put((time.monotonic(), update))
+
+    def _worker(self, q):
+        while True:
+            enqueued_at, update = q.get()
+            if update is None:
+                return
+
+            wait = time.monotonic() - enqueued_at
+            with self.lock:
+                self.waits.append(wait)
+                self.processed += 1
+                self.max_wait = max(self.max_wait, wait)
 
-        st["items"][-1]["cutlery_qty"] = c
-        st["step"] = "ask_more"
+            try:
+                self.process(update)
+            except Exception as e:
+                print(f"update processing failed: {e}")
+            finally:
+                set_sql_route(None)
+
+    def start(self):
+        for i, q in enumerate(self.queues):
+            t = threading.Thread(target=self._worker, args=(q,), name=f"update-shard-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self, timeout=10):
+        # آپدیت‌های در صف پردازش می‌شوند و بعد threadها تمام می‌شوند
+        for q in self.queues:
+            q.put((time.monotonic(), None))
+        for t in self.threads:
+            t.join(timeout)
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def stats(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            processed = self.processed
+            max_wait = self.max_wait
+
+        p50 = waits[len(waits) // 2] if waits else 0
+        p95 = waits[int(len(waits) * 0.95)] if waits else 0
+        return {
+            "depth": self.depth(),
+            "max_shard_depth": max(q.qsize() for q in self.queues),
+            "processed": processed,
+            "wait_p50_ms": round(p50 * 1000, 1),
+            "wait_p95_ms": round(p95 * 1000, 1),
+            "wait_max_ms": round(max_wait * 1000, 1),
+        }
 
-        update.message.reply_text(
-            "🛒 آیا سفارش دیگری دارید؟",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("➕ سفارش دیگر", callback_data="more_order")],
-                [InlineKeyboardButton("✅ ادامه خرید", callback_data="continue_order")]
-            ])
-        )
-        return
 
-    # POSTCODE
-    if st["step"] == "postcode":
-        pc = normalize_digits(text)
+class ShardedDispatcher(Dispatcher):
+    # dispatcher فقط آپدیت را به shard کاربر می‌دهد ؛ هندلرها در threadهای shard اجرا می‌شوند
+    def __init__(self, *args, shards=UPDATE_SHARDS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = UpdateScheduler(super().process_update, shards)
 
-        if not pc.isdigit() or len(pc) != 5:
-            update.message.reply_text("📮 کد پستی باید دقیقاً ۵ رقم و فقط عدد باشد.")
-            return
+    def process_update(self, update):
+        self.scheduler.submit(update)
 
-        st["postcode"] = pc
 
-        if pc == "30163":
-            st["delivery_method"] = "delivery"
-            st["step"] = "fullname"
-            update.message.reply_text("👤 لطفاً نام کامل وارد کنید:")
-            return
+update_scheduler = None
 
-        if pc == "30165":
-            st["delivery_method"] = "check_street"
-            st["step"] = "street"
-            update.message.reply_text("📌 لطفاً نام خیابان را وارد کنید:")
-            return
+def pending_updates():
+    # صف dispatcher + صف shardها
+    pending = webhook_dispatcher.update_queue.qsize() if webhook_dispatcher else 0
+    return pending + (update_scheduler.depth() if update_scheduler else 0)
 
-        st["delivery_method"] = "pickup"
-        st["step"] = "pickup_confirm"
-        update.message.reply_text(
-            f"🚫 خارج از محدوده ارسال.\n"
-            f"🎒 تحویل حضوری از: {PICKUP_ADDRESS_SHORT}\n"
-            "می‌خواهید ادامه دهید؟",
-            reply_markup=pickup_keyboard()
-        )
-        return
 
-    # STREET CHECK
-    if st["step"] == "street":
-        street = text.lower().replace("ß", "ss").replace(" ", "")
-        valid = False
+# ----------- WEBHOOK MODE -----------
+# BOT_MODE=webhook → آپدیت‌ها از Flask می‌آیند ؛ در غیر این صورت polling
+# تست محلی (بدون WEBHOOK_URL ، وبهوک در تلگرام ثبت نمی‌شود):
+#   curl -X POST localhost:$PORT/telegram/webhook \
+#        -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -H "Content-Type: application/json" -d @update.json
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")              # آدرس عمومی سرویس ، مثلاً https://x.onrender.com
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")        # A-Z a-z 0-9 _ - (حداکثر 256)
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_QUEUE_MAX = int(os.environ.get("WEBHOOK_QUEUE_MAX", 1000))   # بیشتر از این ← 503 و تلگرام بعداً دوباره می‌فرستد
 
-        for s in LOCAL_STREETS_30165:
-            if street == s.lower().replace(" ", ""):
-                valid = True
-                break
+webhook_dispatcher = None
+webhook_stats = {"accepted": 0, "shed": 0, "forbidden": 0, "invalid": 0}
 
-        if valid:
-            st["delivery_method"] = "delivery"
-            st["step"] = "fullname"
-            update.message.reply_text("👤 لطفاً نام کامل وارد کنید:")
-            return
+@app.route(WEBHOOK_PATH, methods=["POST"])
+def telegram_webhook():
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET):
+        webhook_stats["forbidden"] += 1
+        return "forbidden", 403
 
-        st["delivery_method"] = "pickup"
-        st["step"] = "pickup_confirm"
-        update.message.reply_text(
-            "🚫 این خیابان در محدوده نیست.\n"
-            f"🎒 تحویل حضوری از {PICKUP_ADDRESS_SHORT}",
-            reply_markup=pickup_keyboard()
-        )
-        return
+    if webhook_dispatcher is None:
+        return "not ready", 503
 
-    # FULLNAME
-    if st["step"] == "fullname":
-        st["fullname"] = text
-        st["step"] = "phone"
-        update.message.reply_text("📞 لطفاً شماره تماس را وارد کنید:")
-        return
+    # صف dispatcher خودش نامحدود است ؛ حد را همین‌جا اعمال می‌کنیم
+    if pending_updates() >= WEBHOOK_QUEUE_MAX:
+        webhook_stats["shed"] += 1
+        return "busy", 503
 
-    # PHONE
-    if st["step"] == "phone":
-        phone = normalize_digits(text)
+    # بدنه خراب → 400 ؛ با 5xx تلگرام همان بدنه را دوباره و دوباره می‌فرستد
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        webhook_stats["invalid"] += 1
+        return "bad request", 400
 
-        if not phone.isdigit() or len(phone) < 8 or len(phone) > 15:
-            update.message.reply_text(
-            "📞 لطفاً شماره تماس معتبر وارد کنید.\n"
-            "✔️ فقط عدد\n"
-            "✔️ حداقل ۸ رقم"
-            )
-            return
+    try:
+        update = Update.de_json(data, webhook_dispatcher.bot)
+    except (TypeError, ValueError, KeyError, AttributeError):
+        update = None
 
-        st["phone"] = phone
+    if update is None:
+        webhook_stats["invalid"] += 1
+        return "bad request", 400
 
-        if st["delivery_method"] == "delivery":
-            st["step"] = "address"
-            update.message.reply_text("🏠 لطفاً آدرس کامل را وارد کنید:")
-            return
-        else:
-            st["address"] = "تحویل حضوری"
-            st["step"] = "delivery_slot"
-
-            target = get_target_delivery_day()
-            if target == "monday":
-                st["delivery_day"] = "دوشنبه"
-            elif target == "thursday":
-                st["delivery_day"] = "پنج‌شنبه"
-
-            update.message.reply_text(
-                f"⏰ لطفاً بازه زمانی تحویل غذا برای {st['delivery_day']} را انتخاب کنید:",
-                reply_markup=delivery_slot_keyboard(st["delivery_day"])
-            )
-            return
-   # ADDRESS
-    if st["step"] == "address":
-        st["address"] = text
-        st["step"] = "delivery_slot"
+    webhook_dispatcher.update_queue.put(update)
+    webhook_stats["accepted"] += 1
+    return "ok"
 
-        target = get_target_delivery_day()
-        if target == "monday":
-            st["delivery_day"] = "دوشنبه"
-        elif target == "thursday":
-            st["delivery_day"] = "پنج‌شنبه"
-        else:
-            update.message.reply_text("امکان ثبت سفارش در حال حاضر وجود ندارد.")
-            reset_user(uid)
-            return
 
-        update.message.reply_text(
-            f"⏰ لطفاً بازه زمانی تحویل غذا برای {st['delivery_day']} را انتخاب کنید:",
-            reply_markup=delivery_slot_keyboard(st["delivery_day"])
-        )
-        return
 # ----------- polling MODE -----------
 import threading
 import time
 
-def expire_loop():
-    while True:
-        try:
-            expire_pending_orders()
-        except:
-            pass
-        time.sleep(60)
-
 def run_web():
     port = int(os.environ.get("PORT", 10000))
     app.run(host="0.0.0.0", port=port)
 
 
-def main():
-    updater = Updater(BOT_TOKEN, use_context=True)
-    dp = updater.dispatcher
+def build_updater():
+    global update_scheduler
+    # هر shard ممکن است همزمان به تلگرام درخواست بدهد
+    request = Request(con_pool_size=max(DISPATCHER_WORKERS, UPDATE_SHARDS) + 4)
+    dp = ShardedDispatcher(Bot(BOT_TOKEN, request=request), queue.Queue(), workers=DISPATCHER_WORKERS)
+    updater = Updater(dispatcher=dp, workers=None)
+    update_scheduler = dp.scheduler
+    dp.add_handler(TypeHandler(Update, rate_limit_gate), group=-1)
 
     dp.add_handler(CommandHandler("start", start))
+    dp.add_handler(CommandHandler("export", export_command))
+    dp.add_handler(CommandHandler("sql", sql_command))
     dp.add_handler(CallbackQueryHandler(callbacks))
     dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_text))
+    dp.add_handler(MessageHandler(Filters.document, handle_menu_upload))
+    dp.add_handler(TypeHandler(Update, persist_session), group=1)
+    return updater
 
-    updater.bot.delete_webhook()
 
-    threading.Thread(target=run_web, daemon=True).start()
-    
+def main():
+    global webhook_dispatcher
+    updater = build_updater()
+    dp = updater.dispatcher
+    update_scheduler.start()
+
     threading.Thread(target=expire_loop, daemon=True).start()
-    
-    print("Bot is running...")
 
-    updater.start_polling()
-    updater.idle()
+    threading.Thread(target=log_writer_loop, daemon=True).start()
+
+    threading.Thread(target=session_sweeper_loop, daemon=True).start()
+
+    resume_broadcasts(updater.bot)
+
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        print("BOT_MODE=webhook needs WEBHOOK_SECRET, falling back to polling")
+
+    if BOT_MODE == "webhook" and WEBHOOK_SECRET:
+        if WEBHOOK_URL:
+            updater.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                api_kwargs={"secret_token": WEBHOOK_SECRET}
+            )
+
+        webhook_dispatcher = dp
+        threading.Thread(target=dp.start, daemon=True).start()
+
+        print("Bot is running (webhook)...")
+
+        # Flask در thread اصلی ؛ تنها حلقه شبکه
+        run_web()
+        dp.stop()
+        update_scheduler.stop()
+        outbox.drain()
+    else:
+        updater.bot.delete_webhook()
+
+        threading.Thread(target=run_web, daemon=True).start()
+
+        print("Bot is running...")
+
+        updater.start_polling()
+        updater.idle()
+        update_scheduler.stop()
+        outbox.drain()
+
+    user_state.flush_evicted()
+    flush_logs()
 
 
 if __name__ == "__main__":
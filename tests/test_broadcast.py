@@ -0,0 +1,149 @@
+import os
+import time
+import tempfile
+import threading
+import sqlite3
+import unittest
+from unittest import mock
+
+# bot.py در import به این‌ها نیاز دارد ؛ دیتابیس موقت
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("ADMIN_CHAT_ID", "1")
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="chaschni-test-"), "test.db")
+
+from telegram.error import RetryAfter, Unauthorized
+
+import bot
+
+
+class StubMessage:
+    message_id = 1
+
+
+class StubBot:
+    # به‌جای تلگرام: هر چت می‌تواند یک لیست خطا داشته باشد که به ترتیب پرتاب می‌شوند
+    def __init__(self, errors=None):
+        self.errors = {chat_id: list(errs) for chat_id, errs in (errors or {}).items()}
+        self.calls = []
+        self.edits = []
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            self.calls.append((time.monotonic(), chat_id, text))
+            errs = self.errors.get(chat_id)
+            if errs:
+                raise errs.pop(0)
+        return StubMessage()
+
+    def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+    def sent_to(self, chat_id):
+        return [call for call in self.calls if call[1] == chat_id]
+
+
+def add_users(user_ids):
+    conn = bot.get_conn()
+    conn.executemany("INSERT OR IGNORE INTO users (user_id) VALUES (?)", [(uid,) for uid in user_ids])
+    conn.commit()
+
+
+def recipient_states(broadcast_id):
+    cur = bot.get_conn().cursor()
+    cur.execute(
+        "SELECT user_id, state FROM broadcast_recipients WHERE broadcast_id = ?",
+        (broadcast_id,)
+    )
+    return dict(cur.fetchall())
+
+
+def wait_for_done(broadcast_id, timeout=15):
+    deadline = time.monotonic() + timeout
+    cur = bot.get_conn().cursor()
+    while time.monotonic() < deadline:
+        cur.execute("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,))
+        if cur.fetchone()[0] != "running":
+            return
+        time.sleep(0.05)
+    raise AssertionError(f"broadcast #{broadcast_id} did not finish")
+
+
+class BroadcastTest(unittest.TestCase):
+    def setUp(self):
+        conn = bot.get_conn()
+        conn.execute("DELETE FROM users")
+        conn.execute("DELETE FROM broadcast_recipients")
+        conn.execute("UPDATE broadcasts SET status = 'done'")
+        conn.commit()
+
+    def test_retry_after_backs_off_and_resends(self):
+        add_users([101, 102])
+        stub = StubBot({101: [RetryAfter(1)]})
+
+        broadcast_id = bot.start_broadcast(stub, 1, "hello")
+        wait_for_done(broadcast_id)
+
+        attempts = stub.sent_to(101)
+        self.assertEqual(len(attempts), 2)
+        self.assertGreaterEqual(attempts[1][0] - attempts[0][0], 0.9)
+        self.assertEqual(recipient_states(broadcast_id), {101: "sent", 102: "sent"})
+
+    def test_blocked_users_are_pruned(self):
+        add_users([201, 202])
+        stub = StubBot({202: [Unauthorized("Forbidden: bot was blocked by the user")]})
+
+        broadcast_id = bot.start_broadcast(stub, 1, "hello")
+        wait_for_done(broadcast_id)
+
+        self.assertEqual(recipient_states(broadcast_id), {201: "sent", 202: "blocked"})
+        cur = bot.get_conn().cursor()
+        cur.execute("SELECT user_id FROM users ORDER BY user_id")
+        self.assertEqual(cur.fetchall(), [(201,)])
+
+    def test_unexpected_errors_fail_the_recipient_not_the_broadcast(self):
+        add_users([401, 402, 403])
+        stub = StubBot({401: [ValueError("boom")]})
+        deliver = bot._deliver_broadcast
+
+        def flaky_deliver(bot_, broadcast_id, user_id, text):
+            if user_id == 402:
+                raise sqlite3.OperationalError("database is locked")
+            return deliver(bot_, broadcast_id, user_id, text)
+
+        with mock.patch.object(bot, "_deliver_broadcast", flaky_deliver):
+            broadcast_id = bot.start_broadcast(stub, 1, "hello")
+            wait_for_done(broadcast_id)
+
+        cur = bot.get_conn().cursor()
+        cur.execute("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,))
+        self.assertEqual(cur.fetchone()[0], "done")
+        self.assertEqual(recipient_states(broadcast_id), {401: "failed", 402: "failed", 403: "sent"})
+        self.assertIn("تمام شد", stub.edits[-1])
+
+    def test_resume_sends_only_pending_recipients(self):
+        # وضعیت بعد از کرش وسط ارسال: دو نفر گرفته‌اند ، دو نفر مانده‌اند
+        conn = bot.get_conn()
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO broadcasts (text, status, admin_chat_id, created_at)
+            VALUES ('hello', 'running', 1, '2024-01-01 10:00')
+        """)
+        broadcast_id = cur.lastrowid
+        cur.executemany(
+            "INSERT INTO broadcast_recipients (broadcast_id, user_id, state) VALUES (?, ?, ?)",
+            [(broadcast_id, 301, "sent"), (broadcast_id, 302, "sent"),
+             (broadcast_id, 303, "pending"), (broadcast_id, 304, "pending")]
+        )
+        conn.commit()
+
+        stub = StubBot()
+        bot.resume_broadcasts(stub)
+        wait_for_done(broadcast_id)
+
+        self.assertEqual(sorted(chat_id for _, chat_id, _ in stub.calls), [303, 304])
+        self.assertEqual(set(recipient_states(broadcast_id).values()), {"sent"})
+
+
+if __name__ == "__main__":
+    unittest.main()